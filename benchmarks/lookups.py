@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Time the hot lookups of the routes with and without their indexes.
+
+Fills an empty database with synthetic rows at production counts (scaled
+by ``--scale``), then runs each lookup with the indexes added in migrations
+b116ea8cccbe and d4e1f07a9c32 dropped and again with them created, and
+prints the mean time per lookup.
+
+    python benchmarks/lookups.py --database postgresql://wptdash@localhost/bench
+    python benchmarks/lookups.py --scale 0.05
+
+Point ``--database`` at a scratch database: its tables are dropped and
+recreated. The default is a temporary SQLite file.
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, func, select, text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__
+))))
+
+from wptdash.database import db  # noqa: E402
+import wptdash.models as models  # noqa: E402
+
+# Approximate production row counts
+PULL_REQUESTS = 10000
+BUILDS_PER_PULL = 4
+JOBS_PER_BUILD = 8
+TESTS = 100000
+# Jobs with stability results, and results per such job
+RESULT_JOBS = 20000
+RESULTS_PER_JOB = 100
+INCONSISTENT_SHARE = 0.02
+
+INDEXES = ('ix_pull_request_number', 'ix_pull_request_created_at_id',
+           'ix_build_number', 'ix_build_pull_request_id', 'ix_job_number',
+           'ix_job_build_id', 'ix_job_result_test_id', 'ix_test_parent_id',
+           'ix_job_result_inconsistent')
+CHUNK_SIZE = 10000
+
+
+def insert(connection, table, rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            connection.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        connection.execute(table.insert(), chunk)
+
+
+def populate(engine, scale):
+    pulls = max(1, int(PULL_REQUESTS * scale))
+    builds = pulls * BUILDS_PER_PULL
+    jobs = builds * JOBS_PER_BUILD
+    tests = max(RESULTS_PER_JOB, int(TESTS * scale))
+    result_jobs = min(jobs, max(1, int(RESULT_JOBS * scale)))
+    created = datetime(2017, 1, 1)
+    histogram = (0,) * models.StatusHistogram.size
+
+    with engine.begin() as connection:
+        insert(connection, models.GitHubUser.__table__,
+               [{'id': 1, 'login': 'bench'}])
+        insert(connection, models.Repository.__table__,
+               [{'id': 1, 'name': 'web-platform-tests', 'owner_id': 1}])
+        insert(connection, models.Commit.__table__,
+               [{'sha': 'bench', 'user_id': 1}])
+        insert(connection, models.Product.__table__,
+               [{'id': 1, 'name': 'firefox:nightly'}])
+        insert(connection, models.PullRequest.__table__, (
+            {'id': pr, 'number': pr, 'title': 'PR %d' % pr,
+             'state': models.PRStatus.OPEN, 'head_sha': 'bench',
+             'base_sha': 'bench', 'head_repo_id': 1, 'base_repo_id': 1,
+             'head_branch': 'head', 'base_branch': 'master',
+             'created_at': created + timedelta(minutes=pr),
+             'updated_at': created + timedelta(minutes=pr), 'merged': False}
+            for pr in range(1, pulls + 1)
+        ))
+        insert(connection, models.Build.__table__, (
+            {'id': build, 'number': build,
+             'pull_request_id': (build - 1) // BUILDS_PER_PULL + 1,
+             'status': models.BuildStatus.PASSED, 'result_count': 0,
+             'inconsistent_count': 0, 'status_totals': histogram}
+            for build in range(1, builds + 1)
+        ))
+        insert(connection, models.Job.__table__, (
+            {'id': job, 'build_id': (job - 1) // JOBS_PER_BUILD + 1,
+             'number': '%d.%d' % ((job - 1) // JOBS_PER_BUILD + 1,
+                                  (job - 1) % JOBS_PER_BUILD + 1),
+             'product_id': 1, 'state': models.JobStatus.PASSED,
+             'allow_failure': False, 'result_count': 0,
+             'inconsistent_count': 0, 'status_totals': histogram}
+            for job in range(1, jobs + 1)
+        ))
+        # Every other test is a subtest of the one before it.
+        insert(connection, models.Test.__table__, (
+            {'id': test, 'path': '/test/%d.html' % test,
+             'tree_path': '/test/%d.html' % test,
+             'parent_id': test - 1 if test % 2 == 0 else None}
+            for test in range(1, tests + 1)
+        ))
+        random.seed(0)
+        insert(connection, models.JobResult.__table__, (
+            {'job_id': job, 'test_id': (job * 7 + offset) % tests + 1,
+             'iterations': 10, 'status_counts': histogram,
+             'consistent': random.random() >= INCONSISTENT_SHARE}
+            for job in range(jobs - result_jobs + 1, jobs + 1)
+            for offset in range(RESULTS_PER_JOB)
+        ))
+    return {'pull_request': pulls, 'build': builds, 'job': jobs,
+            'test': tests, 'job_result': result_jobs * RESULTS_PER_JOB}
+
+
+def lookups(counts):
+    """Return ``(name, statement, parameter factory)`` for each lookup."""
+    pull_request = models.PullRequest.__table__
+    build = models.Build.__table__
+    job = models.Job.__table__
+    job_result = models.JobResult.__table__
+    test = models.Test.__table__
+    result_jobs = counts['job_result'] // RESULTS_PER_JOB
+
+    def between(low, high):
+        return lambda: random.randint(low, high)
+
+    return [
+        ('pull request by number',
+         select([pull_request]).where(pull_request.c.number == text(':key')),
+         between(1, counts['pull_request'])),
+        ('latest pull requests',
+         select([pull_request]).order_by(
+             pull_request.c.created_at.desc(), pull_request.c.id.desc()
+         ).limit(100),
+         None),
+        ('build by number',
+         select([build]).where(build.c.number == text(':key')),
+         between(1, counts['build'])),
+        ('builds of pull request',
+         select([build]).where(build.c.pull_request_id == text(':key')),
+         between(1, counts['pull_request'])),
+        ('job by number',
+         select([job]).where(job.c.number == text(':key')),
+         lambda: '%d.%d' % (random.randint(1, counts['build']),
+                            random.randint(1, JOBS_PER_BUILD))),
+        ('jobs of build',
+         select([job]).where(job.c.build_id == text(':key')),
+         between(1, counts['build'])),
+        ('results of test',
+         select([func.count()]).select_from(job_result).where(
+             job_result.c.test_id == text(':key')
+         ),
+         between(1, counts['test'])),
+        ('subtests of test',
+         select([test]).where(test.c.parent_id == text(':key')),
+         between(1, counts['test'])),
+        ('unstable results of job',
+         select([job_result]).where(
+             (job_result.c.job_id == text(':key')) & ~job_result.c.consistent
+         ),
+         between(counts['job'] - result_jobs + 1, counts['job'])),
+    ]
+
+
+def time_lookups(engine, counts, repeat):
+    random.seed(1)
+    timings = {}
+    with engine.connect() as connection:
+        for name, statement, key in lookups(counts):
+            started = time.perf_counter()
+            for _ in range(repeat):
+                params = {'key': key()} if key else {}
+                connection.execute(statement, params).fetchall()
+            timings[name] = (time.perf_counter() - started) / repeat * 1000
+    return timings
+
+
+def set_indexes(engine, create):
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in INDEXES:
+                if create:
+                    index.create(engine)
+                else:
+                    index.drop(engine)
+    with engine.begin() as connection:
+        connection.execute(text('ANALYZE'))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time hot lookups with and without their indexes.'
+    )
+    parser.add_argument('--database',
+                        help='Scratch database URI (default: temporary '
+                             'SQLite file); its tables are recreated')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Fraction of production row counts to create')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='Lookups timed per query')
+    args = parser.parse_args()
+
+    database = args.database
+    if not database:
+        handle, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        database = 'sqlite:///%s' % path
+    engine = create_engine(database)
+
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    started = time.perf_counter()
+    counts = populate(engine, args.scale)
+    print('Created %s rows in %.0f s' % (
+        ', '.join('%d %s' % (count, table) for table, count in counts.items()),
+        time.perf_counter() - started
+    ))
+
+    set_indexes(engine, create=False)
+    before = time_lookups(engine, counts, args.repeat)
+    set_indexes(engine, create=True)
+    after = time_lookups(engine, counts, args.repeat)
+
+    print('%-26s %12s %12s %9s' % ('Lookup', 'Before (ms)', 'After (ms)',
+                                  'Speedup'))
+    for name in before:
+        print('%-26s %12.3f %12.3f %8.0fx' % (
+            name, before[name], after[name],
+            before[name] / after[name] if after[name] else float('inf')
+        ))
+
+    if not args.database:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
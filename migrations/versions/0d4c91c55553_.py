@@ -0,0 +1,82 @@
+"""integer surrogate key for test
+
+Revision ID: 0d4c91c55553
+Revises: 220c490361bf
+Create Date: 2026-10-18 11:58:12.270341
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0d4c91c55553'
+down_revision = '220c490361bf'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Text keys are renamed out of the way, integer ids are assigned to
+    # every test, and references are translated with one join each.
+    op.execute("""
+        ALTER TABLE job_result DROP CONSTRAINT job_result_test_id_fkey;
+        ALTER TABLE job_result DROP CONSTRAINT job_result_pkey;
+        ALTER TABLE test DROP CONSTRAINT test_parent_id_fkey;
+        ALTER TABLE test DROP CONSTRAINT test_pkey;
+
+        ALTER TABLE test RENAME COLUMN id TO path;
+        ALTER TABLE test RENAME COLUMN parent_id TO parent_path;
+        ALTER TABLE test ADD COLUMN id SERIAL PRIMARY KEY;
+        ALTER TABLE test ADD CONSTRAINT test_path_key UNIQUE (path);
+        ALTER TABLE test ADD COLUMN parent_id INTEGER;
+        UPDATE test t SET parent_id = p.id
+            FROM test p WHERE p.path = t.parent_path;
+        ALTER TABLE test DROP COLUMN parent_path;
+        ALTER TABLE test ADD CONSTRAINT test_parent_id_fkey
+            FOREIGN KEY (parent_id) REFERENCES test (id);
+
+        ALTER TABLE job_result RENAME COLUMN test_id TO test_path;
+        ALTER TABLE job_result ADD COLUMN test_id INTEGER;
+        UPDATE job_result r SET test_id = t.id
+            FROM test t WHERE t.path = r.test_path;
+        ALTER TABLE job_result DROP COLUMN test_path;
+        ALTER TABLE job_result ALTER COLUMN test_id SET NOT NULL;
+        ALTER TABLE job_result ADD CONSTRAINT job_result_pkey
+            PRIMARY KEY (job_id, test_id);
+        ALTER TABLE job_result ADD CONSTRAINT job_result_test_id_fkey
+            FOREIGN KEY (test_id) REFERENCES test (id);
+    """)
+
+
+def downgrade():
+    op.execute("""
+        ALTER TABLE job_result DROP CONSTRAINT job_result_test_id_fkey;
+        ALTER TABLE job_result DROP CONSTRAINT job_result_pkey;
+        ALTER TABLE test DROP CONSTRAINT test_parent_id_fkey;
+
+        ALTER TABLE job_result RENAME COLUMN test_id TO test_key;
+        ALTER TABLE job_result ADD COLUMN test_id TEXT;
+        UPDATE job_result r SET test_id = t.path
+            FROM test t WHERE t.id = r.test_key;
+        ALTER TABLE job_result DROP COLUMN test_key;
+        ALTER TABLE job_result ALTER COLUMN test_id SET NOT NULL;
+
+        ALTER TABLE test RENAME COLUMN parent_id TO parent_key;
+        ALTER TABLE test ADD COLUMN parent_id TEXT;
+        UPDATE test t SET parent_id = p.path
+            FROM test p WHERE p.id = t.parent_key;
+        ALTER TABLE test DROP COLUMN parent_key;
+        ALTER TABLE test DROP CONSTRAINT test_pkey;
+        ALTER TABLE test DROP CONSTRAINT test_path_key;
+        ALTER TABLE test DROP COLUMN id;
+        ALTER TABLE test RENAME COLUMN path TO id;
+        ALTER TABLE test ADD CONSTRAINT test_pkey PRIMARY KEY (id);
+        ALTER TABLE test ADD CONSTRAINT test_parent_id_fkey
+            FOREIGN KEY (parent_id) REFERENCES test (id);
+
+        ALTER TABLE job_result ADD CONSTRAINT job_result_pkey
+            PRIMARY KEY (job_id, test_id);
+        ALTER TABLE job_result ADD CONSTRAINT job_result_test_id_fkey
+            FOREIGN KEY (test_id) REFERENCES test (id);
+    """)
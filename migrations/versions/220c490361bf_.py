@@ -0,0 +1,68 @@
+"""pack stability statuses into a histogram on job_result
+
+Revision ID: 220c490361bf
+Revises: e1bdfb48455b
+Create Date: 2026-10-18 11:20:36.604915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '220c490361bf'
+down_revision = 'e1bdfb48455b'
+branch_labels = None
+depends_on = None
+
+# Histogram slot order; slot n holds the count for TestStatus value n + 1.
+STATUSES = ('PASS', 'FAIL', 'OK', 'TIMEOUT', 'ERROR', 'NOTRUN', 'CRASH')
+
+
+def upgrade():
+    op.add_column('job_result',
+                  sa.Column('status_counts', postgresql.ARRAY(sa.Integer()),
+                            nullable=True))
+    slots = ', '.join(
+        "COALESCE(SUM(count) FILTER (WHERE status = '%s'), 0)" % status
+        for status in STATUSES
+    )
+    op.execute("""
+        UPDATE job_result r
+        SET status_counts = s.status_counts
+        FROM (
+            SELECT job_id, test_id, ARRAY[%s] AS status_counts
+            FROM stability_status
+            GROUP BY job_id, test_id
+        ) s
+        WHERE r.job_id = s.job_id AND r.test_id = s.test_id
+    """ % slots)
+    op.execute("""
+        UPDATE job_result SET status_counts = '{0,0,0,0,0,0,0}'
+        WHERE status_counts IS NULL
+    """)
+    op.alter_column('job_result', 'status_counts', nullable=False)
+    op.drop_table('stability_status')
+
+
+def downgrade():
+    op.create_table('stability_status',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('job_id', sa.Integer(), nullable=False),
+    sa.Column('test_id', sa.Text(), nullable=False),
+    sa.Column('status', postgresql.ENUM(*STATUSES, name='teststatus',
+                                        create_type=False), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('job_id', 'test_id', 'status',
+                        name='stability_status_job_id_test_id_status_key')
+    )
+    op.execute("""
+        INSERT INTO stability_status (job_id, test_id, status, count)
+        SELECT r.job_id, r.test_id,
+               (ARRAY[%s]::teststatus[])[slot.n], r.status_counts[slot.n]
+        FROM job_result r, generate_series(1, %d) AS slot(n)
+        WHERE r.status_counts[slot.n] > 0
+    """ % (', '.join("'%s'" % status for status in STATUSES), len(STATUSES)))
+    op.drop_column('job_result', 'status_counts')
@@ -0,0 +1,76 @@
+"""result counters on job and build
+
+Revision ID: 4633d22eb8d5
+Revises: cef34c5a3b24
+Create Date: 2026-10-18 13:05:22.418830
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '4633d22eb8d5'
+down_revision = 'cef34c5a3b24'
+branch_labels = None
+depends_on = None
+
+STATUS_SLOTS = 7
+
+
+def upgrade():
+    for table in ('job', 'build'):
+        op.add_column(table, sa.Column('result_count', sa.Integer(),
+                                       server_default='0', nullable=False))
+        op.add_column(table, sa.Column('inconsistent_count', sa.Integer(),
+                                       server_default='0', nullable=False))
+        op.add_column(table, sa.Column('status_totals',
+                                       postgresql.ARRAY(sa.Integer()),
+                                       server_default='{0,0,0,0,0,0,0}',
+                                       nullable=False))
+
+    def totals(column):
+        return 'ARRAY[%s]' % ', '.join(
+            'COALESCE(SUM(%s[%d]), 0)' % (column, slot)
+            for slot in range(1, STATUS_SLOTS + 1)
+        )
+
+    op.execute("""
+        UPDATE job j
+        SET result_count = r.result_count,
+            inconsistent_count = r.inconsistent_count,
+            status_totals = r.status_totals
+        FROM (
+            SELECT job_id,
+                   COUNT(*) AS result_count,
+                   COUNT(*) FILTER (WHERE NOT consistent)
+                       AS inconsistent_count,
+                   %s AS status_totals
+            FROM job_result
+            GROUP BY job_id
+        ) r
+        WHERE j.id = r.job_id
+    """ % totals('status_counts'))
+    op.execute("""
+        UPDATE build b
+        SET result_count = j.result_count,
+            inconsistent_count = j.inconsistent_count,
+            status_totals = j.status_totals
+        FROM (
+            SELECT build_id,
+                   SUM(result_count) AS result_count,
+                   SUM(inconsistent_count) AS inconsistent_count,
+                   %s AS status_totals
+            FROM job
+            GROUP BY build_id
+        ) j
+        WHERE b.id = j.build_id
+    """ % totals('status_totals'))
+
+
+def downgrade():
+    for table in ('build', 'job'):
+        op.drop_column(table, 'status_totals')
+        op.drop_column(table, 'inconsistent_count')
+        op.drop_column(table, 'result_count')
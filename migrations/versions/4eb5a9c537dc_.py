@@ -0,0 +1,39 @@
+"""unique stability status per job result
+
+Revision ID: 4eb5a9c537dc
+Revises: 5831feaf2ee0
+Create Date: 2026-10-18 10:02:41.118304
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4eb5a9c537dc'
+down_revision = '5831feaf2ee0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Bulk ingest upserts on (job_id, test_id, status), which needs a unique
+    # constraint to conflict on. Drop any duplicates left by racing requests
+    # first, keeping the most recently written row.
+    op.execute("""
+        DELETE FROM stability_status s
+        USING stability_status newer
+        WHERE s.job_id = newer.job_id AND
+              s.test_id = newer.test_id AND
+              s.status = newer.status AND
+              s.id < newer.id
+    """)
+    op.create_unique_constraint(
+        'stability_status_job_id_test_id_status_key', 'stability_status',
+        ['job_id', 'test_id', 'status']
+    )
+
+
+def downgrade():
+    op.drop_constraint('stability_status_job_id_test_id_status_key',
+                       'stability_status', type_='unique')
@@ -0,0 +1,26 @@
+"""digest of the last posted comment on pull_request
+
+Revision ID: 543557566388
+Revises: 4633d22eb8d5
+Create Date: 2026-10-18 13:52:07.135602
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '543557566388'
+down_revision = '4633d22eb8d5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('pull_request', sa.Column('comment_digest',
+                                            sa.String(length=64),
+                                            nullable=True))
+
+
+def downgrade():
+    op.drop_column('pull_request', 'comment_digest')
@@ -0,0 +1,50 @@
+"""index hot lookups and inconsistent results
+
+Revision ID: b116ea8cccbe
+Revises: 543557566388
+Create Date: 2026-10-18 15:02:44.918310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b116ea8cccbe'
+down_revision = '543557566388'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_pull_request_number'), 'pull_request',
+                    ['number'], unique=False)
+    op.create_index(op.f('ix_pull_request_created_at'), 'pull_request',
+                    ['created_at'], unique=False)
+    op.create_index(op.f('ix_build_number'), 'build', ['number'],
+                    unique=False)
+    op.create_index(op.f('ix_build_pull_request_id'), 'build',
+                    ['pull_request_id'], unique=False)
+    op.create_index(op.f('ix_job_number'), 'job', ['number'], unique=False)
+    op.create_index(op.f('ix_job_build_id'), 'job', ['build_id'],
+                    unique=False)
+    op.create_index(op.f('ix_job_result_test_id'), 'job_result', ['test_id'],
+                    unique=False)
+    op.create_index(op.f('ix_test_parent_id'), 'test', ['parent_id'],
+                    unique=False)
+    op.create_index('ix_job_result_inconsistent', 'job_result',
+                    ['job_id', 'test_id'], unique=False,
+                    postgresql_where=sa.text('NOT consistent'))
+
+
+def downgrade():
+    op.drop_index('ix_job_result_inconsistent', table_name='job_result')
+    op.drop_index(op.f('ix_test_parent_id'), table_name='test')
+    op.drop_index(op.f('ix_job_result_test_id'), table_name='job_result')
+    op.drop_index(op.f('ix_job_build_id'), table_name='job')
+    op.drop_index(op.f('ix_job_number'), table_name='job')
+    op.drop_index(op.f('ix_build_pull_request_id'), table_name='build')
+    op.drop_index(op.f('ix_build_number'), table_name='build')
+    op.drop_index(op.f('ix_pull_request_created_at'),
+                  table_name='pull_request')
+    op.drop_index(op.f('ix_pull_request_number'), table_name='pull_request')
@@ -0,0 +1,38 @@
+"""materialized tree path for test
+
+Revision ID: cef34c5a3b24
+Revises: 0d4c91c55553
+Create Date: 2026-10-18 12:31:49.804172
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'cef34c5a3b24'
+down_revision = '0d4c91c55553'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Byte-order collation keeps the separator sorting before printable
+    # characters and lets prefix LIKE queries use the index.
+    op.add_column('test', sa.Column('tree_path',
+                                    postgresql.TEXT(collation='C'),
+                                    nullable=True))
+    op.execute("UPDATE test SET tree_path = path WHERE parent_id IS NULL")
+    op.execute("""
+        UPDATE test t SET tree_path = p.path || E'\\x1f' || t.path
+        FROM test p WHERE t.parent_id = p.id
+    """)
+    op.alter_column('test', 'tree_path', nullable=False)
+    op.create_index(op.f('ix_test_tree_path'), 'test', ['tree_path'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_test_tree_path'), table_name='test')
+    op.drop_column('test', 'tree_path')
@@ -0,0 +1,29 @@
+"""index pull requests on their page key
+
+Revision ID: d4e1f07a9c32
+Revises: b116ea8cccbe
+Create Date: 2026-10-18 16:20:11.402687
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4e1f07a9c32'
+down_revision = 'b116ea8cccbe'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_pull_request_created_at_id', 'pull_request',
+                    ['created_at', 'id'], unique=False)
+    op.drop_index(op.f('ix_pull_request_created_at'),
+                  table_name='pull_request')
+
+
+def downgrade():
+    op.create_index(op.f('ix_pull_request_created_at'), 'pull_request',
+                    ['created_at'], unique=False)
+    op.drop_index('ix_pull_request_created_at_id', table_name='pull_request')
@@ -0,0 +1,25 @@
+"""stability payload digest on job
+
+Revision ID: e1bdfb48455b
+Revises: 4eb5a9c537dc
+Create Date: 2026-10-18 10:41:07.523981
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1bdfb48455b'
+down_revision = '4eb5a9c537dc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('job', sa.Column('payload_digest', sa.String(length=64),
+                                   nullable=True))
+
+
+def downgrade():
+    op.drop_column('job', 'payload_digest')
@@ -4,17 +4,72 @@ from copy import deepcopy
 from datetime import datetime
 import json
 import pytest
+import requests
+import time
 from urllib.parse import urlencode
+from sqlalchemy import event
 from pytest_mock import mocker
 
 from jsonschema.exceptions import ValidationError
-from wptdash.github import GitHub
+from wptdash import ingest
+from wptdash.blueprints import routes
+from wptdash.github import GitHub, RateLimiter
+from wptdash.pagecache import LRUBackend, PageCache
+from wptdash.spool import DeferredPayloads
 import wptdash.models as models
 from tests.blueprints.fixtures.payloads import (github_webhook_payload,
                                                 travis_webhook_payload,
                                                 stability_payload)
 
 
+def exhaust_rate_limit(mocker):
+    """Leave only the comment reserve of the GitHub quota, for 600s."""
+    limiter = RateLimiter(reserve=10)
+    limiter.update({'X-RateLimit-Limit': '5000',
+                    'X-RateLimit-Remaining': '10',
+                    'X-RateLimit-Reset': str(int(time.time()) + 600)})
+    mocker.patch('wptdash.github.LIMITER', limiter)
+
+
+def add_build(session, finished_at):
+    """Add pull request 1 with build 123 and its job 123.1."""
+    owner = models.GitHubUser(login='foo')
+    pull_request = models.PullRequest(state=models.PRStatus.OPEN, number=1,
+                                      merged=False, head_sha='abcdef12345',
+                                      base_sha='12345abcdef', title='abc',
+                                      creator=owner,
+                                      head_repository=models.Repository(
+                                          name='bar', owner=owner),
+                                      base_repository=models.Repository(
+                                          name='baz', owner=owner),
+                                      head_branch='foo', base_branch='bar',
+                                      created_at=datetime.now(),
+                                      updated_at=datetime.now(), id=1)
+    build = models.Build(id=3, number=123, pull_request=pull_request,
+                         status=models.BuildStatus.PASSED,
+                         started_at=datetime(2017, 1, 1),
+                         finished_at=finished_at)
+    session.add(models.Job(id=2, number='123.1', build=build,
+                           product=models.Product(name='chrome:unstable'),
+                           state=models.JobStatus.PASSED,
+                           allow_failure=True))
+    session.commit()
+
+
+def count_queries(session, client, url, **kwargs):
+    """GET ``url``; return the number of queries it ran and the response."""
+    statements = []
+
+    def record(*args):
+        statements.append(args[2])
+    event.listen(session.get_bind(), 'before_cursor_execute', record)
+    try:
+        rv = client.get(url, **kwargs)
+    finally:
+        event.remove(session.get_bind(), 'before_cursor_execute', record)
+    return len(statements), rv
+
+
 class TestRoot(object):
 
     """Test the application root route."""
@@ -39,6 +94,69 @@ class TestRoot(object):
         rv = client.get('/')
         assert b'Pull Request' in rv.data
 
+    def test_latest_build(self, client, session):
+        """Each pull request shows its latest build."""
+        pull_request = models.PullRequest(state=models.PRStatus.OPEN, number=1,
+                                          merged=False, head_sha='abcdef12345',
+                                          base_sha='12345abcdef', title='abc',
+                                          head_repo_id=1, base_repo_id=1,
+                                          head_branch='foo', base_branch='bar',
+                                          created_at=datetime.now(),
+                                          updated_at=datetime.now())
+        pull_request.builds = [
+            models.Build(number=123, status=models.BuildStatus.BROKEN,
+                         started_at=datetime(2017, 1, 1), result_count=50,
+                         inconsistent_count=7),
+            models.Build(number=122, status=models.BuildStatus.PASSED,
+                         started_at=datetime(2016, 12, 31)),
+        ]
+        session.add(pull_request)
+        session.commit()
+
+        rv = client.get('/')
+        assert b'/build/123' in rv.data
+        assert b'/build/122' not in rv.data
+        assert b'7 of 50' in rv.data
+
+    def test_pages(self, client, session):
+        """Older pull requests are reached through page links."""
+        count = models.PULL_REQUEST_PAGE_SIZE + 1
+        session.add_all([
+            models.PullRequest(state=models.PRStatus.OPEN, number=number,
+                               merged=False, head_sha='abcdef12345',
+                               base_sha='12345abcdef', title='abc',
+                               head_repo_id=1, base_repo_id=1,
+                               head_branch='foo', base_branch='bar',
+                               created_at=datetime(2017, 1, 1, 0, number // 60,
+                                                   number % 60),
+                               updated_at=datetime.now())
+            for number in range(1, count + 1)
+        ])
+        session.commit()
+
+        rv = client.get('/')
+        assert b'/pull/%d"' % count in rv.data
+        assert b'/pull/1"' not in rv.data
+        assert b'Newer' not in rv.data
+        older = models.encode_cursor(session.query(models.PullRequest).get(2))
+        assert ('?before=%s' % older).encode() in rv.data
+
+        rv = client.get('/?before=%s' % older)
+        assert b'/pull/1"' in rv.data
+        assert b'/pull/2"' not in rv.data
+        assert b'Older' not in rv.data
+        newer = models.encode_cursor(session.query(models.PullRequest).get(1))
+        assert ('?after=%s' % newer).encode() in rv.data
+
+        rv = client.get('/?after=%s' % newer)
+        assert b'/pull/%d"' % count in rv.data
+        assert b'/pull/1"' not in rv.data
+
+    def test_invalid_cursor(self, client, session):
+        """Malformed page cursors are rejected."""
+        rv = client.get('/?before=yesterday')
+        assert rv.status_code == 400
+
 
 class TestPullDetail(object):
 
@@ -155,6 +273,267 @@ class TestBuildDetail(object):
         assert b'Job Number' in rv.data
 
 
+class TestJobDetail(object):
+
+    """Test the job detail page."""
+
+    def test_no_data(self, client, session):
+        """Job detail route says "No information" when no job in DB."""
+        rv = client.get('/job/1.1')
+        assert b'No information' in rv.data
+
+    def test_results(self, client, session):
+        """Subtest results are listed under their parent test."""
+        owner = models.GitHubUser(login='foo')
+        pull_request = models.PullRequest(state=models.PRStatus.OPEN, number=1,
+                                          merged=False, head_sha='abcdef12345',
+                                          base_sha='12345abcdef', title='abc',
+                                          head_repository=models.Repository(
+                                              name='bar', owner=owner),
+                                          base_repository=models.Repository(
+                                              name='baz', owner=owner),
+                                          head_branch='foo', base_branch='bar',
+                                          created_at=datetime.now(),
+                                          updated_at=datetime.now())
+        build = models.Build(number=123, status=models.BuildStatus.PENDING,
+                             started_at=datetime.now(), id=1,
+                             pull_request=pull_request)
+        job = models.Job(id=2, number='123.1', build=build,
+                         product=models.Product(name='firefox:nightly'),
+                         state=models.JobStatus.PASSED, allow_failure=False,
+                         started_at=datetime.now())
+        session.add(job)
+        session.flush()
+        counts = ingest.add_stability_results(session, 2, 10,
+                                              stability_payload['results'])
+        ingest.update_counters(session, 2, counts)
+        session.commit()
+
+        rv = client.get('/job/123.1')
+
+        assert b'Unstable Results' in rv.data
+        assert rv.data.index(b'walk the dog') < rv.data.index(b'curb the dog')
+
+
+class TestPageQueries(object):
+
+    """Test that pages issue a fixed number of queries."""
+
+    # Upper bound on queries per page, whatever the amount of data
+    MAX_QUERIES = {'index': 2, 'pull': 2, 'build': 2, 'job': 3}
+
+    def add_builds(self, session, count):
+        owner = models.GitHubUser(login='foo')
+        pull_request = models.PullRequest(state=models.PRStatus.OPEN, number=1,
+                                          merged=True, head_sha='abcdef12345',
+                                          base_sha='12345abcdef', title='abc',
+                                          creator=owner, merger=owner,
+                                          head_repository=models.Repository(
+                                              name='bar', owner=owner),
+                                          base_repository=models.Repository(
+                                              name='baz', owner=owner),
+                                          head_branch='foo', base_branch='bar',
+                                          created_at=datetime.now(),
+                                          updated_at=datetime.now())
+        for number in range(1, count + 1):
+            build = models.Build(number=number, id=number,
+                                 status=models.BuildStatus.PENDING,
+                                 started_at=datetime.now(),
+                                 pull_request=pull_request)
+            for index in range(count):
+                job_id = number * 100 + index
+                session.add(models.Job(
+                    id=job_id, number='%d.%d' % (number, index), build=build,
+                    product=models.Product(name='firefox:%d' % job_id),
+                    state=models.JobStatus.PASSED, allow_failure=False
+                ))
+        session.flush()
+        for job_id in range(100, 100 + min(count, 2)):
+            counts = ingest.add_stability_results(
+                session, job_id, 10, stability_payload['results']
+            )
+            ingest.update_counters(session, job_id, counts)
+        session.commit()
+
+    @pytest.mark.parametrize('count', [1, 5])
+    def test_query_counts(self, client, session, count):
+        """Pages load their data with a bounded number of queries."""
+        self.add_builds(session, count)
+
+        for page, url in (('index', '/'), ('pull', '/pull/1'),
+                          ('build', '/build/1'), ('job', '/job/1.0')):
+            queries, rv = count_queries(session, client, url)
+            assert rv.status_code == 200
+            assert b'No information' not in rv.data
+            assert queries <= self.MAX_QUERIES[page]
+
+
+class TestPageCache(object):
+
+    """Test serving build and job pages from the page cache."""
+
+    @pytest.fixture
+    def page_cache(self, app, mocker):
+        cache = PageCache(LRUBackend())
+        mocker.patch.dict(app.extensions, {'page_cache': cache})
+        return cache
+
+    def test_finished_build(self, client, session, page_cache):
+        """Pages of finished builds are served without the database."""
+        add_build(session, datetime(2017, 1, 2))
+
+        for url in ('/build/123', '/job/123.1'):
+            queries, rv = count_queries(session, client, url)
+            assert rv.status_code == 200
+            assert queries > 0
+            queries, cached = count_queries(session, client, url)
+            assert (queries, cached.data) == (0, rv.data)
+        assert page_cache.stats()['hits'] == 2
+
+    def test_unfinished_build(self, client, session, page_cache):
+        """Pages of running builds are rendered every time."""
+        add_build(session, None)
+
+        for url in ('/build/123', '/job/123.1'):
+            client.get(url)
+            queries, rv = count_queries(session, client, url)
+            assert rv.status_code == 200
+            assert queries > 0
+        assert page_cache.stats()['stored'] == 0
+
+    def test_evicted_not_modified(self, client, session, page_cache):
+        """A 304 for an evicted finished page keeps its max-age."""
+        add_build(session, datetime(2017, 1, 2))
+
+        for kind, number, url in (('build', 123, '/build/123'),
+                                  ('job', '123.1', '/job/123.1')):
+            etag = client.get(url).headers['ETag']
+            stamp = page_cache.stamp(kind, number)
+            page_cache.backend.delete(
+                page_cache._page_key(kind, number, stamp)
+            )
+
+            rv = client.get(url, headers={'If-None-Match': etag})
+            assert rv.status_code == 304
+            assert rv.cache_control.public
+            assert rv.cache_control.max_age == routes.FINISHED_PAGE_MAX_AGE
+            assert page_cache.get(kind, number, stamp) is not None
+
+    def test_stability_invalidates(self, client, session, page_cache,
+                                   mocker):
+        """Stability results arriving late replace the cached pages."""
+        mocker.patch('wptdash.blueprints.routes.update_github_comment',
+                     return_value=('OK', 200))
+        add_build(session, datetime(2017, 1, 2))
+        build_page = client.get('/build/123').data
+        job_page = client.get('/job/123.1').data
+        assert b'walk the dog' not in job_page
+
+        rv = client.post('/api/stability', data=json.dumps(stability_payload),
+                         content_type='application/json')
+        assert rv.status_code == 200
+
+        assert client.get('/build/123').data != build_page
+        assert b'walk the dog' in client.get('/job/123.1').data
+
+
+class TestConditionalRequests(object):
+
+    """Test validators and caching headers of the detail pages."""
+
+    @pytest.fixture
+    def page_cache(self, app, mocker):
+        cache = PageCache(LRUBackend(), version='v1')
+        mocker.patch.dict(app.extensions, {'page_cache': cache})
+        return cache
+
+    def test_finished_build(self, client, session):
+        """Finished builds may be reused and are revalidated by ETag."""
+        add_build(session, datetime(2017, 1, 2))
+
+        for url in ('/build/123', '/job/123.1'):
+            rv = client.get(url)
+            assert rv.headers['ETag']
+            assert rv.cache_control.public
+            assert rv.cache_control.max_age == routes.FINISHED_PAGE_MAX_AGE
+
+            rv = client.get(url, headers={
+                'If-None-Match': rv.headers['ETag']
+            })
+            assert rv.status_code == 304
+            assert rv.data == b''
+            assert rv.cache_control.max_age == routes.FINISHED_PAGE_MAX_AGE
+
+    def test_max_age(self, app, client, session, mocker):
+        """FINISHED_PAGE_MAX_AGE sets how long finished pages are reused."""
+        mocker.patch.dict(app.config, {'FINISHED_PAGE_MAX_AGE': 60})
+        add_build(session, datetime(2017, 1, 2))
+
+        assert client.get('/build/123').cache_control.max_age == 60
+
+    def test_unfinished_build(self, client, session):
+        """Pages of running builds must be revalidated."""
+        add_build(session, None)
+
+        rv = client.get('/build/123')
+        assert rv.cache_control.no_cache
+        assert rv.cache_control.max_age is None
+
+    def test_pull_last_modified(self, client, session):
+        """Pull request pages carry the pull request's update time."""
+        add_build(session, None)
+        pull_request = session.query(models.PullRequest).one()
+        pull_request.updated_at = datetime(2017, 1, 3, 12, 30)
+        session.commit()
+
+        rv = client.get('/pull/1')
+        assert rv.headers['Last-Modified'] == 'Tue, 03 Jan 2017 12:30:00 GMT'
+        assert rv.cache_control.no_cache
+
+        rv = client.get('/pull/1', headers={
+            'If-None-Match': rv.headers['ETag']
+        })
+        assert rv.status_code == 304
+
+    def test_if_modified_since_ignored(self, client, session):
+        """Pages are sent in full when only If-Modified-Since is given."""
+        add_build(session, None)
+
+        rv = client.get('/pull/1', headers={
+            'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'
+        })
+        assert rv.status_code == 200
+
+    def test_cached_not_modified(self, client, session, page_cache):
+        """With the page cache, 304s need no database queries."""
+        add_build(session, None)
+
+        for url in ('/pull/1', '/build/123', '/job/123.1'):
+            etag = client.get(url).headers['ETag']
+            assert etag.strip('"').startswith('v1-')
+            queries, rv = count_queries(session, client, url,
+                                        headers={'If-None-Match': etag})
+            assert rv.status_code == 304
+            assert queries == 0
+
+    def test_cached_changed(self, client, session, page_cache, mocker):
+        """ETags change when ingest changes what a page shows."""
+        mocker.patch('wptdash.blueprints.routes.update_github_comment',
+                     return_value=('OK', 200))
+        add_build(session, datetime(2017, 1, 2))
+        etags = {url: client.get(url).headers['ETag']
+                 for url in ('/pull/1', '/build/123', '/job/123.1')}
+
+        rv = client.post('/api/stability', data=json.dumps(stability_payload),
+                         content_type='application/json')
+        assert rv.status_code == 200
+
+        for url, etag in etags.items():
+            rv = client.get(url, headers={'If-None-Match': etag})
+            assert rv.status_code == 200
+            assert rv.headers['ETag'] != etag
+
+
 class TestAddPullRequest(object):
 
     """Test endpoint for adding pull request data from GitHub."""
@@ -545,6 +924,37 @@ class TestAddStabilityCheck(object):
 
         assert GitHub.get_pr.call_count == 1
 
+    def test_no_pr_rate_limited(self, client, session, mocker):
+        """Keeps the payload for after the reset if the PR lookup is deferred."""
+        exhaust_rate_limit(mocker)
+        request = mocker.patch('requests.Session.request')
+        defer = mocker.patch.object(DeferredPayloads, 'defer',
+                                    return_value=True)
+
+        rv = client.post('/api/stability', data=json.dumps(stability_payload),
+                         content_type='application/json')
+
+        assert rv.status_code == 202
+        kind, content_type, body, delay = defer.call_args[0]
+        assert (kind, content_type) == ('stability', 'application/json')
+        body.seek(0)
+        assert json.loads(body.read().decode('utf-8')) == stability_payload
+        assert 590 <= delay <= 600
+        assert not request.called
+        assert session.query(models.Build).count() == 0
+
+    def test_no_pr_rate_limited_queue_full(self, client, session, mocker):
+        """Returns HTTP 503 with Retry-After if no more payloads fit."""
+        exhaust_rate_limit(mocker)
+        mocker.patch('requests.Session.request')
+        mocker.patch.object(DeferredPayloads, 'defer', return_value=False)
+
+        rv = client.post('/api/stability', data=json.dumps(stability_payload),
+                         content_type='application/json')
+
+        assert rv.status_code == 503
+        assert 590 <= int(rv.headers['Retry-After']) <= 600
+
     def test_complete_payload(self, client, session):
         pull_request = models.PullRequest(state=models.PRStatus.OPEN, number=1,
                                           merged=False, head_sha='abcdef12345',
@@ -559,9 +969,302 @@ class TestAddStabilityCheck(object):
         rv = client.post('/api/stability', data=json.dumps(stability_payload),
                          content_type='application/json')
 
-        stability_statuses = session.query(models.StabilityStatus).filter(
-            models.StabilityStatus.job_id == 2,
-            models.StabilityStatus.test_id == 'curb the dog'
+        job_result = session.query(models.JobResult).join(
+            models.Test
+        ).filter(
+            models.JobResult.job_id == 2,
+            models.Test.path == 'curb the dog'
+        ).one()
+
+        assert len(job_result.statuses) == 2
+
+    def test_resubmitted_payload(self, client, session, mocker):
+        """Resubmitting a payload updates results instead of duplicating."""
+        mocker.patch('wptdash.blueprints.routes.update_github_comment',
+                     return_value=('OK', 200))
+        pull_request = models.PullRequest(state=models.PRStatus.OPEN, number=1,
+                                          merged=False, head_sha='abcdef12345',
+                                          base_sha='12345abcdef', title='abc',
+                                          head_repo_id=1, base_repo_id=1,
+                                          head_branch='foo', base_branch='bar',
+                                          created_at=datetime.now(),
+                                          updated_at=datetime.now(), id=1)
+        session.add(pull_request)
+        session.commit()
+
+        client.post('/api/stability', data=json.dumps(stability_payload),
+                    content_type='application/json')
+        rv = client.post('/api/stability', data=json.dumps(stability_payload),
+                         content_type='application/json')
+
+        assert rv.status_code == 200
+        job_results = session.query(models.JobResult).filter(
+            models.JobResult.job_id == 2
         ).all()
+        assert len(job_results) == 2
+        assert sum(len(result.statuses) for result in job_results) == 4
+        job = session.query(models.Job).get(2)
+        assert (job.result_count, job.inconsistent_count) == (2, 2)
+        assert job.build.result_count == 2
+
+
+class TestCoalescedComments(object):
+
+    """Test queueing comment updates with COMMENT_COALESCE_WINDOW."""
+
+    def test_stability_queued(self, app, client, session, mocker):
+        """The comment is updated once, after the changes are committed."""
+        mocker.patch.dict(app.config, {'COMMENT_COALESCE_WINDOW': 0.5})
+        mocker.patch.dict(app.extensions)
+        update = mocker.patch(
+            'wptdash.blueprints.routes.update_github_comment_for'
+        )
+        commit = mocker.spy(session, 'commit')
+        pull_request = models.PullRequest(state=models.PRStatus.OPEN, number=1,
+                                          merged=False, head_sha='abcdef12345',
+                                          base_sha='12345abcdef', title='abc',
+                                          head_repo_id=1, base_repo_id=1,
+                                          head_branch='foo', base_branch='bar',
+                                          created_at=datetime.now(),
+                                          updated_at=datetime.now(), id=1)
+        session.add(pull_request)
+        session.commit()
+
+        payload = deepcopy(stability_payload)
+        for count in range(3):
+            payload['results'][0]['result']['status'] = {'pass': count}
+            rv = client.post('/api/stability', data=json.dumps(payload),
+                             content_type='application/json')
+            assert rv.status_code == 202
+        assert commit.call_count == 4
+
+        assert app.extensions['comment_coalescer'].wait_idle(5)
+        update.assert_called_once_with(app, 1)
+
+    def test_workers(self, app, client, session, mocker):
+        """With COMMENT_WORKERS alone the update runs in the background."""
+        mocker.patch.dict(app.config, {'COMMENT_WORKERS': 2})
+        mocker.patch.dict(app.extensions)
+        update = mocker.patch(
+            'wptdash.blueprints.routes.update_github_comment_for'
+        )
+        pull_request = models.PullRequest(state=models.PRStatus.OPEN, number=1,
+                                          merged=False, head_sha='abcdef12345',
+                                          base_sha='12345abcdef', title='abc',
+                                          head_repo_id=1, base_repo_id=1,
+                                          head_branch='foo', base_branch='bar',
+                                          created_at=datetime.now(),
+                                          updated_at=datetime.now(), id=1)
+        session.add(pull_request)
+        session.commit()
+
+        rv = client.post('/api/stability', data=json.dumps(stability_payload),
+                         content_type='application/json')
+
+        assert rv.status_code == 202
+        assert app.extensions['comment_coalescer'].wait_idle(5)
+        update.assert_called_once_with(app, 1)
+
+
+class TestAddStabilityCheckNDJSON(object):
+
+    """Test streaming newline-delimited JSON stability submissions."""
+
+    @staticmethod
+    def ndjson(payload):
+        header = dict(payload)
+        results = header.pop('results')
+        return '\n'.join(json.dumps(line) for line in [header] + results)
+
+    def test_no_header(self, client, session):
+        """An empty body throws jsonschema ValidationError."""
+        with pytest.raises(ValidationError):
+            client.post('/api/stability', data='',
+                        content_type='application/x-ndjson')
+
+    def test_invalid_result(self, client, session):
+        """A result line missing its test throws ValidationError."""
+        pull_request = models.PullRequest(state=models.PRStatus.OPEN, number=1,
+                                          merged=False, head_sha='abcdef12345',
+                                          base_sha='12345abcdef', title='abc',
+                                          head_repo_id=1, base_repo_id=1,
+                                          head_branch='foo', base_branch='bar',
+                                          created_at=datetime.now(),
+                                          updated_at=datetime.now(), id=1)
+        session.add(pull_request)
+        session.commit()
+        payload = deepcopy(stability_payload)
+        payload['results'][0].pop('test')
+        with pytest.raises(ValidationError):
+            client.post('/api/stability', data=self.ndjson(payload),
+                        content_type='application/x-ndjson')
+
+    def test_no_pr_rate_limited(self, client, session, mocker):
+        """The whole stream is kept if the PR lookup is deferred."""
+        exhaust_rate_limit(mocker)
+        mocker.patch('requests.Session.request')
+        defer = mocker.patch.object(DeferredPayloads, 'defer',
+                                    return_value=True)
+        data = self.ndjson(stability_payload)
+
+        rv = client.post('/api/stability', data=data,
+                         content_type='application/x-ndjson')
+
+        assert rv.status_code == 202
+        body = defer.call_args[0][2]
+        body.seek(0)
+        assert body.read() == data.encode('utf-8')
+
+    def test_complete_payload(self, client, session, mocker):
+        """Results are ingested in batches from the request stream."""
+        mocker.patch('wptdash.blueprints.routes.update_github_comment',
+                     return_value=('OK', 200))
+        mocker.patch('wptdash.blueprints.routes.STABILITY_BATCH_SIZE', 1)
+        mocker.spy(ingest, 'add_stability_results')
+        mocker.spy(ingest, 'update_counters')
+        pull_request = models.PullRequest(state=models.PRStatus.OPEN, number=1,
+                                          merged=False, head_sha='abcdef12345',
+                                          base_sha='12345abcdef', title='abc',
+                                          head_repo_id=1, base_repo_id=1,
+                                          head_branch='foo', base_branch='bar',
+                                          created_at=datetime.now(),
+                                          updated_at=datetime.now(), id=1)
+        session.add(pull_request)
+        session.commit()
+        payload = deepcopy(stability_payload)
+        payload['results'].append({'test': 'feed the dog',
+                                   'result': {'status': {'ok': 10}}})
+
+        rv = client.post('/api/stability', data=self.ndjson(payload),
+                         content_type='application/x-ndjson')
+
+        assert rv.status_code == 200
+        assert ingest.add_stability_results.call_count == 2
+        assert session.query(models.JobResult).filter(
+            models.JobResult.job_id == 2
+        ).count() == 3
+        # The counters are updated once, with the sum of every batch.
+        assert ingest.update_counters.call_count == 1
+        assert session.query(models.Job).get(2).result_count == 3
+
+
+class TestStabilityDeduplication(object):
+
+    """Test short-circuiting of repeated stability submissions."""
+
+    @pytest.fixture
+    def pull_request(self, session):
+        pull_request = models.PullRequest(state=models.PRStatus.OPEN, number=1,
+                                          merged=False, head_sha='abcdef12345',
+                                          base_sha='12345abcdef', title='abc',
+                                          head_repo_id=1, base_repo_id=1,
+                                          head_branch='foo', base_branch='bar',
+                                          created_at=datetime.now(),
+                                          updated_at=datetime.now(), id=1)
+        session.add(pull_request)
+        session.commit()
+        return pull_request
+
+    @staticmethod
+    def posted(pr):
+        pr.comment_digest = 'posted'
+        return 'OK', 200
+
+    def test_duplicate_payload(self, client, session, pull_request, mocker):
+        """An identical resubmission does not touch results or comment."""
+        comment = mocker.patch(
+            'wptdash.blueprints.routes.update_github_comment',
+            side_effect=self.posted
+        )
+        mocker.spy(ingest, 'add_stability_results')
+        body = json.dumps(stability_payload)
+
+        client.post('/api/stability', data=body,
+                    content_type='application/json')
+        rv = client.post('/api/stability', data=body,
+                         content_type='application/json')
+
+        assert rv.status_code == 200
+        assert ingest.add_stability_results.call_count == 1
+        assert comment.call_count == 1
+        job = session.query(models.Job).filter(models.Job.id == 2).one()
+        assert len(job.payload_digest) == 64
+
+    def test_changed_payload(self, client, session, pull_request, mocker):
+        """A changed resubmission goes through the full update path."""
+        comment = mocker.patch(
+            'wptdash.blueprints.routes.update_github_comment',
+            side_effect=self.posted
+        )
+        payload = deepcopy(stability_payload)
+
+        client.post('/api/stability', data=json.dumps(payload),
+                    content_type='application/json')
+        payload['results'][0]['result']['status'] = {'pass': 10}
+        client.post('/api/stability', data=json.dumps(payload),
+                    content_type='application/json')
+
+        assert comment.call_count == 2
+        job_result = session.query(models.JobResult).join(
+            models.Test
+        ).filter(models.Test.path == 'walk the dog').one()
+        assert job_result.statuses == [(models.TestStatus.PASS, 10)]
+
+    def test_duplicate_ndjson(self, client, session, pull_request, mocker):
+        """A streamed resubmission does not update the comment again."""
+        comment = mocker.patch(
+            'wptdash.blueprints.routes.update_github_comment',
+            side_effect=self.posted
+        )
+        body = TestAddStabilityCheckNDJSON.ndjson(stability_payload)
+
+        for _ in range(2):
+            rv = client.post('/api/stability', data=body,
+                             content_type='application/x-ndjson')
+
+        assert rv.status_code == 200
+        assert comment.call_count == 1
+
+    def test_duplicate_after_failed_comment(self, client, session,
+                                            pull_request, mocker):
+        """A resubmission after GitHub failed updates the comment."""
+        post_comment = mocker.patch('wptdash.commenter.GitHub.post_comment')
+        post_comment.side_effect = [
+            requests.HTTPError('502 Bad Gateway'), mocker.DEFAULT
+        ]
+        post_comment.return_value.json.return_value = {
+            'url': 'https://api.github.com/comments/1'
+        }
+        body = json.dumps(stability_payload)
+
+        rv = client.post('/api/stability', data=body,
+                         content_type='application/json')
+        assert rv.status_code == 500
+        rv = client.post('/api/stability', data=body,
+                         content_type='application/json')
+
+        assert rv.status_code == 200
+        assert post_comment.call_count == 2
+        session.refresh(pull_request)
+        assert pull_request.comment_digest is not None
+
+    def test_duplicate_ndjson_after_failed_comment(self, client, session,
+                                                   pull_request, mocker):
+        """A streamed resubmission after GitHub failed updates the comment."""
+        def fail_once(pr):
+            if comment.call_count == 1:
+                pr.comment_digest = None
+                return 'Bad Gateway', 500
+            return self.posted(pr)
+        comment = mocker.patch(
+            'wptdash.blueprints.routes.update_github_comment',
+            side_effect=fail_once
+        )
+        body = TestAddStabilityCheckNDJSON.ndjson(stability_payload)
+
+        for _ in range(2):
+            client.post('/api/stability', data=body,
+                        content_type='application/x-ndjson')
+
+        assert comment.call_count == 2
 
-        assert len(stability_statuses) == 2
@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from datetime import datetime
+import threading
+
+import pytest
+import requests
+from sqlalchemy import event
+
+from wptdash import commenter
+from wptdash.commenter import CommentCoalescer
+from wptdash.github import RateLimited
+import wptdash.models as models
+
+
+class TestCommentCoalescer(object):
+
+    """Test coalescing of comment updates per pull request."""
+
+    def test_burst(self):
+        """Updates within the window collapse into one per pull request."""
+        updated = []
+        coalescer = CommentCoalescer(0.05, updated.append)
+
+        for pr_number in (1, 2, 1, 1, 2):
+            coalescer.schedule(pr_number)
+
+        assert coalescer.wait_idle(5)
+        assert sorted(updated) == [1, 2]
+        assert coalescer.stats() == {'scheduled': 5, 'coalesced': 3,
+                                     'pending': 0, 'running': 0,
+                                     'retried': 0, 'failed': 0}
+
+    def test_schedule_while_running(self):
+        """A request during a running update queues exactly one more."""
+        started = threading.Event()
+        release = threading.Event()
+        updated = []
+
+        def update(pr_number):
+            updated.append(pr_number)
+            started.set()
+            release.wait(5)
+
+        coalescer = CommentCoalescer(0.01, update)
+        coalescer.schedule(1)
+        assert started.wait(5)
+        coalescer.schedule(1)
+        coalescer.schedule(1)
+        release.set()
+
+        assert coalescer.wait_idle(5)
+        assert updated == [1, 1]
+
+    def test_failed_update(self):
+        """An update that raises does not stop the dispatcher."""
+        updated = []
+
+        def update(pr_number):
+            updated.append(pr_number)
+            if pr_number == 1:
+                raise ValueError(pr_number)
+
+        coalescer = CommentCoalescer(0.01, update, retries=0)
+        coalescer.schedule(1)
+        coalescer.schedule(2)
+
+        assert coalescer.wait_idle(5)
+        assert sorted(updated) == [1, 2]
+        assert coalescer.stats()['failed'] == 1
+
+    def test_retry(self):
+        """Failed updates are retried until they succeed."""
+        updated = []
+
+        def update(pr_number):
+            updated.append(pr_number)
+            if len(updated) < 3:
+                raise ValueError(pr_number)
+
+        coalescer = CommentCoalescer(0, update, retries=3, backoff=0.01)
+        coalescer.schedule(1)
+
+        assert coalescer.wait_idle(5)
+        assert updated == [1, 1, 1]
+        stats = coalescer.stats()
+        assert (stats['retried'], stats['failed']) == (2, 0)
+
+    def test_retries_exhausted(self):
+        """An update is given up after its retries."""
+        updated = []
+
+        def update(pr_number):
+            updated.append(pr_number)
+            raise ValueError(pr_number)
+
+        coalescer = CommentCoalescer(0, update, retries=2, backoff=0.01)
+        coalescer.schedule(1)
+
+        assert coalescer.wait_idle(5)
+        assert updated == [1, 1, 1]
+        assert coalescer.stats()['failed'] == 1
+
+    def test_rate_limited(self):
+        """Updates deferred by the rate limit are queued again."""
+        updated = []
+
+        def update(pr_number):
+            updated.append(pr_number)
+            if len(updated) == 1:
+                raise RateLimited(0.01)
+
+        coalescer = CommentCoalescer(0, update, retries=0)
+        coalescer.schedule(1)
+
+        assert coalescer.wait_idle(5)
+        assert updated == [1, 1]
+        assert coalescer.stats()['failed'] == 0
+
+    def test_workers(self):
+        """Pull requests are updated in parallel, each one serially."""
+        lock = threading.Lock()
+        running = []
+        overlaps = []
+        release = threading.Event()
+
+        def update(pr_number):
+            with lock:
+                if pr_number in running:
+                    overlaps.append(pr_number)
+                running.append(pr_number)
+                if len(running) == 2:
+                    release.set()
+            release.wait(5)
+            with lock:
+                running.remove(pr_number)
+
+        coalescer = CommentCoalescer(0, update, workers=2)
+        coalescer.schedule(1)
+        coalescer.schedule(2)
+        coalescer.schedule(1)
+
+        assert coalescer.wait_idle(5)
+        assert release.is_set()
+        assert overlaps == []
+        assert coalescer.stats()['scheduled'] == 3
+
+
+class TestUpdateGitHubComment(object):
+
+    """Test posting the rendered comment to GitHub."""
+
+    @pytest.fixture
+    def pull_request(self, session):
+        pull_request = models.PullRequest(state=models.PRStatus.OPEN, number=1,
+                                          merged=False, head_sha='abcdef12345',
+                                          base_sha='12345abcdef', title='abc',
+                                          head_repo_id=1, base_repo_id=1,
+                                          head_branch='foo', base_branch='bar',
+                                          created_at=datetime.now(),
+                                          updated_at=datetime.now(), id=1)
+        pull_request.builds = [
+            models.Build(id=1, number=1, status=models.BuildStatus.PENDING,
+                         started_at=datetime.now())
+        ]
+        session.add(pull_request)
+        session.commit()
+        return pull_request
+
+    @pytest.fixture
+    def post_comment(self, mocker):
+        post_comment = mocker.patch('wptdash.commenter.GitHub.post_comment')
+        post_comment.return_value.json.return_value = {
+            'url': 'https://api.github.com/comments/1'
+        }
+        return post_comment
+
+    def test_unchanged_skipped(self, pull_request, post_comment):
+        """A render identical to the posted comment is not sent again."""
+        before = commenter.COMMENT_STATS.stats()
+
+        commenter.update_github_comment(pull_request)
+        commenter.update_github_comment(pull_request)
+
+        assert post_comment.call_count == 1
+        after = commenter.COMMENT_STATS.stats()
+        assert after['sent'] - before['sent'] == 1
+        assert after['skipped'] - before['skipped'] == 1
+
+    def test_changed_sent(self, pull_request, post_comment):
+        """A changed render updates the existing comment."""
+        commenter.update_github_comment(pull_request)
+        pull_request.builds[0].status = models.BuildStatus.PASSED
+
+        commenter.update_github_comment(pull_request)
+
+        assert post_comment.call_count == 2
+        assert post_comment.call_args[0][2] == \
+            'https://api.github.com/comments/1'
+
+    def test_failure_clears_digest(self, pull_request, post_comment):
+        """A failed post leaves the comment marked as out of date."""
+        commenter.update_github_comment(pull_request)
+        pull_request.builds[0].status = models.BuildStatus.PASSED
+        post_comment.side_effect = requests.HTTPError('502 Bad Gateway')
+
+        assert commenter.update_github_comment(pull_request)[1] == 500
+        assert pull_request.comment_digest is None
+
+
+class TestGetCommentData(object):
+
+    """Test assembling the comment data for a pull request."""
+
+    @pytest.fixture
+    def pull_request(self, session):
+        pull_request = models.PullRequest(state=models.PRStatus.OPEN, number=1,
+                                          merged=False, head_sha='abcdef12345',
+                                          base_sha='12345abcdef', title='abc',
+                                          head_repo_id=1, base_repo_id=1,
+                                          head_branch='foo', base_branch='bar',
+                                          created_at=datetime.now(),
+                                          updated_at=datetime.now(), id=1)
+        firefox = models.Product(id=1, name='firefox:nightly')
+        chrome = models.Product(id=2, name='chrome:dev')
+        pull_request.builds = [
+            models.Build(id=1, number=1, status=models.BuildStatus.FAILED,
+                         started_at=datetime(2017, 1, 1)),
+            models.Build(id=2, number=2, status=models.BuildStatus.FAILED,
+                         started_at=datetime(2017, 1, 2), inconsistent_count=2,
+                         jobs=[
+                             models.Job(id=10, number='2.1', product=firefox,
+                                        state=models.JobStatus.FAILED,
+                                        allow_failure=False,
+                                        inconsistent_count=2),
+                             models.Job(id=11, number='2.2', product=chrome,
+                                        state=models.JobStatus.PASSED,
+                                        allow_failure=True),
+                         ]),
+        ]
+        session.add(pull_request)
+        session.commit()
+        return pull_request
+
+    def add_results(self, session, tests):
+        """Add a result for each ``(path, parent, consistent)`` to job 10."""
+        added = {}
+        for path, parent, consistent in tests:
+            test = models.Test(path=path, parent=added.get(parent),
+                               tree_path=path if parent is None
+                               else parent + '\x1f' + path)
+            session.add(test)
+            session.flush()
+            added[path] = test
+            session.add(models.JobResult(
+                job_id=10, test_id=test.id, iterations=10,
+                consistent=consistent, messages='["flaky"]',
+                status_counts=models.StatusHistogram.from_counts({
+                    models.TestStatus.PASS: 6, models.TestStatus.FAIL: 4
+                })
+            ))
+        session.commit()
+
+    @staticmethod
+    def count_queries(session, function):
+        statements = []
+
+        def record(*args):
+            statements.append(args[2])
+        event.listen(session.get_bind(), 'before_cursor_execute', record)
+        try:
+            result = function()
+        finally:
+            event.remove(session.get_bind(), 'before_cursor_execute', record)
+        return result, len(statements)
+
+    @staticmethod
+    def read_unstable_jobs(data):
+        """Read the lazily fetched unstable jobs and results of ``data``."""
+        return [job._replace(results=list(job.results))
+                for job in data.unstable_jobs]
+
+    def test_no_builds(self, session):
+        """Pull requests without builds have nothing to comment."""
+        pull_request = models.PullRequest(state=models.PRStatus.OPEN,
+                                          number=2, merged=False,
+                                          head_sha='abc', base_sha='def',
+                                          title='abc', head_repo_id=1,
+                                          base_repo_id=1, head_branch='foo',
+                                          base_branch='bar',
+                                          created_at=datetime.now(),
+                                          updated_at=datetime.now(), id=2)
+        session.add(pull_request)
+        session.commit()
+
+        assert commenter.get_comment_data(session, pull_request) is None
+
+    def test_latest_build(self, session, pull_request):
+        """The latest build's failing and unstable jobs are returned."""
+        self.add_results(session, [('/a.html', None, False),
+                                   ('a1', '/a.html', False),
+                                   ('/b.html', None, True),
+                                   ('b1', '/b.html', False)])
+
+        data = commenter.get_comment_data(session, pull_request)
+
+        assert data.build.number == 2
+        assert data.failing_jobs == ['firefox:nightly']
+        unstable_jobs = self.read_unstable_jobs(data)
+        assert len(unstable_jobs) == 1
+        job = unstable_jobs[0]
+        assert (job.id, job.product) == (10, 'firefox:nightly')
+        assert [(group.result.path,
+                 [sub.path for sub in group.subresults])
+                for group in job.results] == [('/a.html', ['a1'])]
+        result = job.results[0].result
+        assert result.messages == ['flaky']
+        assert result.statuses == [
+            models.StatusCount(models.TestStatus.PASS, 6),
+            models.StatusCount(models.TestStatus.FAIL, 4),
+        ]
+
+    def test_unstarted_build(self, session, pull_request):
+        """A build not yet reported by Travis CI is the latest."""
+        pull_request.builds.append(models.Build(
+            id=3, number=3, status=models.BuildStatus.PENDING
+        ))
+        session.commit()
+
+        data = commenter.get_comment_data(session, pull_request)
+
+        assert data.build.number == 3
+
+    def test_query_count(self, session, pull_request):
+        """The number of queries does not grow with consistent results."""
+        self.add_results(session, [('/a.html', None, False)])
+        session.refresh(pull_request)
+        _, few = self.count_queries(
+            session,
+            lambda: self.read_unstable_jobs(
+                commenter.get_comment_data(session, pull_request)
+            )
+        )
+        self.add_results(session, [('/c%d.html' % index, None, True)
+                                   for index in range(50)])
+        session.refresh(pull_request)
+
+        unstable_jobs, many = self.count_queries(
+            session,
+            lambda: self.read_unstable_jobs(
+                commenter.get_comment_data(session, pull_request)
+            )
+        )
+
+        assert few == many == 3
+        assert len(unstable_jobs[0].results) == 1
+
+    def test_truncated_stops_reading(self, app, session, pull_request,
+                                     mocker):
+        """Results past the comment length limit are not read."""
+        self.add_results(session, [('/c%03d.html' % index, None, False)
+                                   for index in range(100)])
+        read = []
+        result_groups = commenter._result_groups
+
+        def counted(rows):
+            for item in result_groups(rows):
+                read.append(item)
+                yield item
+        mocker.patch.object(commenter, '_result_groups', counted)
+        data = commenter.get_comment_data(session, pull_request)
+
+        _, truncated = commenter.render_comment(data, 5000)
+
+        assert truncated
+        assert 0 < len(read) < 100
+
+    def test_rendered(self, session, pull_request, mocker):
+        """The comment lists unstable results of the latest build."""
+        post_comment = mocker.patch('wptdash.commenter.GitHub.post_comment')
+        self.add_results(session, [('/a.html', None, False),
+                                   ('a1', '/a.html', False)])
+
+        commenter.update_github_comment(pull_request)
+
+        comment = post_comment.call_args[0][1]
+        assert '<li>firefox:nightly</li>' in comment
+        assert 'Browser: "Firefox Nightly"' in comment
+        assert '<code>a1</code>' in comment
+        assert '<code>flaky</code>' in comment
+        assert 'Chrome' not in comment
+
+
+class TestRenderComment(object):
+
+    """Test rendering the comment within GitHub's length limit."""
+
+    build = commenter.CommentBuild(1, 1, models.BuildStatus.FAILED,
+                                   datetime(2017, 1, 1), datetime(2017, 1, 1),
+                                   10)
+
+    def data(self, count):
+        statuses = [models.StatusCount(models.TestStatus.PASS, 1),
+                    models.StatusCount(models.TestStatus.FAIL, 1)]
+        results = [
+            models.ResultGroup(
+                commenter.CommentResult('/test%d.html' % index, statuses, []),
+                [commenter.CommentResult('subtest', statuses, ['flaky'])]
+            )
+            for index in range(count)
+        ]
+        job = commenter.CommentJob(10, '1.1', 'firefox:nightly', False,
+                                   results)
+        return commenter.CommentData(self.build, ['firefox:nightly'], [job])
+
+    def test_within_limit(self, app):
+        """Every row is rendered when the comment fits."""
+        comment, truncated = commenter.render_comment(self.data(3), 65536)
+
+        assert not truncated
+        assert comment.count('<code>subtest</code>') == 3
+        assert comment.count('<table>') == comment.count('</table>') == 1
+        assert 'truncated' not in comment
+
+    def test_truncated(self, app):
+        """Rows stop at the limit and a notice with links is appended."""
+        comment, truncated = commenter.render_comment(self.data(100), 5000)
+
+        assert truncated
+        assert len(comment) < 5000
+        assert 0 < comment.count('<code>subtest</code>') < 100
+        assert comment.count('<table>') == comment.count('</table>') == 1
+        assert '(5000 characters)' in comment
+        assert '/build/1)' in comment
+
+    def test_stable(self, app):
+        """Builds without unstable results link to the full results."""
+        data = self.data(0)._replace(build=self.build._replace(
+            inconsistent_count=0
+        ))
+
+        comment, truncated = commenter.render_comment(data, 65536)
+
+        assert not truncated
+        assert 'Unstable Results' not in comment
+        assert '/build/1)' in comment
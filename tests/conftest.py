@@ -3,6 +3,7 @@
 import os
 import pytest
 
+from wptdash import ingest
 from wptdash.factory import create_app
 from wptdash.database import db as _db
 
@@ -64,6 +65,8 @@ def session(db, request):
         transaction.rollback()
         connection.close()
         session.remove()
+        # Committed test ids were rolled back with the outer transaction.
+        ingest.TEST_IDS.clear()
 
     request.addfinalizer(teardown)
     return session
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import stat
+
+from wptdash.factory import BytecodeCache, create_app
+
+
+def make_app(cache_dir):
+    return create_app(dict(
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        SQLALCHEMY_DATABASE_URI='sqlite://',
+        JINJA_BYTECODE_CACHE_DIR=cache_dir
+    ))
+
+
+class TestTemplateCache(object):
+
+    """Test the template bytecode cache and warm-up."""
+
+    def test_warm_up(self, tmpdir):
+        """Every template is compiled at startup and written to the cache."""
+        app = make_app(str(tmpdir))
+        cache = app.jinja_env.bytecode_cache
+
+        assert isinstance(cache, BytecodeCache)
+        assert cache.misses == len(app.jinja_env.list_templates())
+        assert len(os.listdir(str(tmpdir))) == cache.misses
+
+    def test_restart(self, tmpdir):
+        """A restarted app loads its templates from the cache."""
+        make_app(str(tmpdir))
+
+        cache = make_app(str(tmpdir)).jinja_env.bytecode_cache
+
+        assert cache.misses == 0
+        assert cache.hits > 0
+
+    def test_disabled(self):
+        """An empty cache directory disables the bytecode cache."""
+        assert make_app('').jinja_env.bytecode_cache is None
+
+    def test_default_directory_private(self):
+        """The default cache directory belongs to this user alone."""
+        cache = make_app(None).jinja_env.bytecode_cache
+
+        status = os.stat(cache.directory)
+        assert status.st_uid == os.getuid()
+        assert stat.S_IMODE(status.st_mode) & 0o077 == 0
+
+    def test_directory_created_private(self, tmpdir):
+        """A configured cache directory is created private."""
+        directory = str(tmpdir.join('cache'))
+        make_app(directory)
+
+        assert stat.S_IMODE(os.stat(directory).st_mode) & 0o077 == 0
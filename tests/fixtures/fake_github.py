@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A local stand-in for the GitHub API with scripted responses."""
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+
+class FakeGitHub(object):
+
+    """
+    Serve queued responses over HTTP on a free local port.
+
+    Responses are served in the order they were added, falling back to an
+    empty 200. If ``rate_limit`` is set, every response carries
+    ``X-RateLimit-*`` headers counting down from ``rate_remaining``.
+    """
+
+    def __init__(self):
+        self.responses = deque()
+        self.requests = []
+        self.rate_limit = None
+        self.rate_remaining = None
+        self.rate_reset = None
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.05,), daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server.server_port
+
+    def add_response(self, status=200, body=None, headers=None):
+        self.responses.append((status, body or {}, headers or {}))
+
+    def set_rate_limit(self, remaining, limit=5000, reset_in=3600):
+        self.rate_limit = limit
+        self.rate_remaining = remaining
+        self.rate_reset = int(time.time()) + reset_in
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _respond(self, handler):
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else b''
+        with self._lock:
+            self.requests.append((handler.command, handler.path, body))
+            if self.responses:
+                status, data, headers = self.responses.popleft()
+            else:
+                status, data, headers = 200, {}, {}
+            headers = dict(headers)
+            if self.rate_limit is not None:
+                self.rate_remaining = max(0, self.rate_remaining - 1)
+                headers.setdefault('X-RateLimit-Limit', str(self.rate_limit))
+                headers.setdefault('X-RateLimit-Remaining',
+                                   str(self.rate_remaining))
+                headers.setdefault('X-RateLimit-Reset', str(self.rate_reset))
+
+        payload = json.dumps(data).encode('utf-8')
+        handler.send_response(status)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                fake._respond(self)
+
+            do_POST = do_PATCH = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pytest
+import requests
+
+from wptdash import github as github_module
+from wptdash.github import (GitHub, PRIORITY_BACKFILL, PRIORITY_COMMENT,
+                            RateLimited, RateLimiter)
+from tests.fixtures.fake_github import FakeGitHub
+
+
+@pytest.fixture
+def fake_github():
+    fake = FakeGitHub()
+    yield fake
+    fake.close()
+
+
+@pytest.fixture
+def github(fake_github, mocker):
+    """GitHub client pointed at the fake API, with sleeps skipped."""
+    mocker.patch('wptdash.github.time.sleep')
+    mocker.patch.object(github_module, 'LIMITER', RateLimiter(reserve=10))
+    github = GitHub(session=requests.Session())
+    github.base_url = fake_github.url + '/repos/w3c/web-platform-tests/'
+    return github
+
+
+class TestGitHubRequest(object):
+
+    """Test retries, timeouts and stats of GitHub API calls."""
+
+    def test_get(self, github, fake_github):
+        """A successful call is made once and its body returned."""
+        fake_github.add_response(body={'number': 1})
+
+        assert github.get_pr(1) == {'number': 1}
+        assert fake_github.requests[0][:2] == (
+            'GET', '/repos/w3c/web-platform-tests/pulls/1'
+        )
+
+    def test_retry_gateway_error(self, github, fake_github):
+        """Idempotent calls are retried with backoff on 502."""
+        fake_github.add_response(status=502)
+        fake_github.add_response(status=502)
+        fake_github.add_response(body={'number': 1})
+
+        assert github.get_pr(1) == {'number': 1}
+        assert len(fake_github.requests) == 3
+        assert [call[0][0] for call in github_module.time.sleep.call_args_list
+                ] == [0.5, 1.0]
+
+    def test_retries_exhausted(self, github, fake_github):
+        """The last error is raised once retries run out."""
+        for _ in range(github_module.MAX_RETRIES + 1):
+            fake_github.add_response(status=503)
+
+        with pytest.raises(requests.HTTPError):
+            github.get_pr(1)
+        assert len(fake_github.requests) == github_module.MAX_RETRIES + 1
+
+    def test_post_not_retried(self, github, fake_github):
+        """Creating a comment is not repeated, so it cannot be duplicated."""
+        fake_github.add_response(status=502)
+
+        with pytest.raises(requests.HTTPError):
+            github.post_comment(1, 'body')
+        assert len(fake_github.requests) == 1
+
+    def test_patch_retried(self, github, fake_github):
+        """Updating an existing comment is retried."""
+        fake_github.add_response(status=504)
+
+        github.post_comment(1, 'body', fake_github.url + '/comments/1')
+
+        assert [request[0] for request in fake_github.requests] == [
+            'PATCH', 'PATCH'
+        ]
+
+    def test_retry_after(self, github, fake_github):
+        """A secondary rate limit is waited out using Retry-After."""
+        fake_github.add_response(status=403, headers={'Retry-After': '7'})
+
+        github.get_pr(1)
+
+        github_module.time.sleep.assert_called_once_with(7.0)
+
+    def test_retry_after_too_long(self, github, fake_github):
+        """Waits longer than MAX_RETRY_WAIT fail instead of blocking."""
+        fake_github.add_response(status=429, headers={'Retry-After': '3600'})
+
+        with pytest.raises(requests.HTTPError):
+            github.get_pr(1)
+        assert not github_module.time.sleep.called
+
+    def test_forbidden_not_retried(self, github, fake_github):
+        """A plain 403 is not retried."""
+        fake_github.add_response(status=403)
+
+        with pytest.raises(requests.HTTPError):
+            github.get_pr(1)
+        assert len(fake_github.requests) == 1
+
+    def test_timeout(self, github, mocker):
+        """Every call is bounded by a timeout."""
+        request = mocker.spy(github.session, 'request')
+
+        github.get_pr(1)
+
+        assert request.call_args[1]['timeout'] == github_module.TIMEOUT
+
+    def test_stats(self, github, fake_github, mocker):
+        """Latency and the rate limit headers are recorded."""
+        mocker.patch.object(github_module, 'STATS',
+                            github_module.GitHubStats())
+        fake_github.set_rate_limit(remaining=100)
+        fake_github.add_response(status=502)
+
+        github.get_pr(1)
+
+        stats = github_module.STATS.stats()
+        assert stats['calls'] == 2
+        assert stats['errors'] == 1
+        assert stats['retries'] == 1
+        assert stats['rate_remaining'] == 98
+        assert stats['rate_limit'] == 5000
+        assert stats['latency_max'] >= stats['latency_p50'] > 0
+
+    def test_shared_session(self):
+        """Clients share one pooled session by default."""
+        assert GitHub().session is GitHub().session
+
+
+class FakeClock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def rate_limit_headers(remaining, reset, limit=5000):
+    return {'X-RateLimit-Limit': str(limit),
+            'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': str(reset)}
+
+
+class TestRateLimiter(object):
+
+    """Test the token bucket in front of GitHub API calls."""
+
+    def test_unknown_quota(self):
+        """Calls go through before any rate limit headers have been seen."""
+        limiter = RateLimiter(reserve=10)
+
+        limiter.acquire(PRIORITY_BACKFILL)
+
+        assert limiter.tokens is None
+
+    def test_backfill_keeps_reserve(self):
+        """Backfill calls are deferred once only the reserve is left."""
+        clock = FakeClock()
+        limiter = RateLimiter(reserve=10, clock=clock)
+        limiter.update(rate_limit_headers(11, 1600))
+
+        limiter.acquire(PRIORITY_BACKFILL)
+        with pytest.raises(RateLimited) as excinfo:
+            limiter.acquire(PRIORITY_BACKFILL)
+
+        assert excinfo.value.retry_after == 600
+        assert limiter.tokens == 10
+
+    def test_comment_uses_reserve(self, mocker):
+        """Comment updates may spend the reserve."""
+        limiter = RateLimiter(reserve=10, clock=FakeClock())
+        limiter.update(rate_limit_headers(1, 1600))
+
+        limiter.acquire(PRIORITY_COMMENT)
+
+        assert limiter.tokens == 0
+
+    def test_comment_waits_for_reset(self, mocker):
+        """Comment updates wait out a reset that is close enough."""
+        clock = FakeClock()
+
+        def sleep(seconds):
+            clock.now += seconds
+        sleep = mocker.patch('wptdash.github.time.sleep', side_effect=sleep)
+        limiter = RateLimiter(reserve=10, clock=clock)
+        limiter.update(rate_limit_headers(0, 1030))
+
+        limiter.acquire(PRIORITY_COMMENT)
+
+        sleep.assert_called_once_with(30)
+        assert limiter.tokens == 4999
+
+    def test_comment_deferred_past_max_wait(self, mocker):
+        """Comment updates are deferred rather than blocked for long."""
+        sleep = mocker.patch('wptdash.github.time.sleep')
+        limiter = RateLimiter(reserve=10, clock=FakeClock())
+        limiter.update(rate_limit_headers(0, 4600))
+
+        with pytest.raises(RateLimited) as excinfo:
+            limiter.acquire(PRIORITY_COMMENT)
+
+        assert excinfo.value.retry_after == 3600
+        assert not sleep.called
+
+    def test_refill_after_reset(self):
+        """The bucket is refilled to the limit once the window resets."""
+        clock = FakeClock()
+        limiter = RateLimiter(reserve=10, clock=clock)
+        limiter.update(rate_limit_headers(0, 1600))
+        clock.now = 1600
+
+        limiter.acquire(PRIORITY_BACKFILL)
+
+        assert limiter.tokens == 4999
+
+    def test_reserve_scales_with_limit(self):
+        """Small limits keep back a share of the limit, not the reserve."""
+        limiter = RateLimiter(clock=FakeClock())
+        limiter.update(rate_limit_headers(7, 1600, limit=60))
+
+        limiter.acquire(PRIORITY_BACKFILL)
+        with pytest.raises(RateLimited):
+            limiter.acquire(PRIORITY_BACKFILL)
+
+        assert limiter.tokens == 6
+
+    def test_unknown_reset(self):
+        """Calls go through when the reset time is not known."""
+        limiter = RateLimiter(reserve=10, clock=FakeClock())
+        limiter.update({'X-RateLimit-Remaining': '0'})
+
+        limiter.acquire(PRIORITY_BACKFILL)
+        limiter.acquire(PRIORITY_COMMENT)
+
+        assert limiter.tokens == 0
+
+
+class TestGitHubRateLimit(object):
+
+    """Test prioritized calls against an API reporting its rate limit."""
+
+    def test_backfill_deferred(self, github, fake_github):
+        """Pull request lookups stop at the reserve without calling out."""
+        fake_github.set_rate_limit(remaining=11)
+        fake_github.add_response(body={'number': 1})
+        github.get_pr(1)
+
+        with pytest.raises(RateLimited):
+            github.get_pr(2)
+        assert len(fake_github.requests) == 1
+
+    def test_comment_prioritized(self, github, fake_github):
+        """Comment updates go through while lookups are deferred."""
+        fake_github.set_rate_limit(remaining=5)
+        github.post_comment(1, 'body')
+
+        with pytest.raises(RateLimited):
+            github.get_pr(1)
+        github.post_comment(1, 'body', fake_github.url + '/comments/1')
+
+        assert [request[0] for request in fake_github.requests] == [
+            'POST', 'PATCH'
+        ]
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from copy import deepcopy
+
+import wptdash.models as models
+from wptdash import ingest
+from tests.blueprints.fixtures.payloads import stability_payload
+
+
+class TestCollectStabilityRows(object):
+
+    """Test flattening of stability results into table rows."""
+
+    def test_rows(self):
+        """Parents, subtests and results are all collected."""
+        parents, subtests, job_results = \
+            ingest.collect_stability_rows(2, 10, stability_payload['results'])
+
+        assert parents == [{'path': 'walk the dog',
+                            'tree_path': 'walk the dog'}]
+        assert subtests == [{'path': 'curb the dog',
+                             'parent_path': 'walk the dog',
+                             'tree_path': 'walk the dog\x1fcurb the dog'}]
+        assert len(job_results) == 2
+
+    def test_status_counts(self):
+        """Status counts are packed into a histogram indexed by status."""
+        results = [{'test': 'foo', 'result': {'status': {'pass': 3,
+                                                         'crash': 7}}}]
+
+        _, _, job_results = ingest.collect_stability_rows(2, 10, results)
+
+        assert job_results[0]['status_counts'] == (3, 0, 0, 0, 0, 0, 7)
+
+    def test_inconsistent_subtest_marks_parent(self):
+        """A parent is inconsistent when any of its subtests is."""
+        results = deepcopy(stability_payload['results'])
+        results[0]['result']['status'] = {'pass': 10}
+
+        _, _, job_results = ingest.collect_stability_rows(2, 10, results)
+
+        consistent = {row['test_path']: row['consistent']
+                      for row in job_results}
+        assert consistent == {'walk the dog': False, 'curb the dog': False}
+
+    def test_consistent(self):
+        """Statuses with every iteration agreeing are consistent."""
+        results = [{'test': 'foo', 'result': {'status': {'ok': 10}}}]
+
+        _, _, job_results = ingest.collect_stability_rows(2, 10, results)
+
+        assert job_results[0]['consistent']
+
+
+class TestAddStabilityResults(object):
+
+    """Test bulk upsert of stability results."""
+
+    def test_insert(self, session):
+        """Rows are created for every test, result and status."""
+        ingest.add_stability_results(session, 2, 10,
+                                     stability_payload['results'])
+
+        subtest = session.query(models.Test).filter_by(
+            path='curb the dog'
+        ).one()
+        assert subtest.parent.path == 'walk the dog'
+        job_result = session.query(models.JobResult).filter_by(
+            test_id=subtest.id
+        ).one()
+        assert job_result.status_counts == (5, 5, 0, 0, 0, 0, 0)
+        assert session.query(models.JobResult).count() == 2
+
+    def test_update(self, session):
+        """Resubmitted results overwrite the existing rows."""
+        ingest.add_stability_results(session, 2, 10,
+                                     stability_payload['results'])
+        results = deepcopy(stability_payload['results'])
+        results[0]['result']['subtests'][0]['result']['status'] = {'pass': 10}
+        results[0]['result']['status'] = {'pass': 10}
+
+        ingest.add_stability_results(session, 2, 10, results)
+
+        job_results = session.query(models.JobResult).all()
+        assert len(job_results) == 2
+        assert all(result.consistent for result in job_results)
+        subtest_result = session.query(models.JobResult).join(
+            models.Test
+        ).filter(models.Test.path == 'curb the dog').one()
+        assert subtest_result.status_counts == (10, 0, 0, 0, 0, 0, 0)
+
+    def test_unchanged_rows_skipped(self, session, mocker):
+        """Tests and results that already match are not written again."""
+        ingest.add_stability_results(session, 2, 10,
+                                     stability_payload['results'])
+        mocker.spy(ingest, 'upsert')
+
+        ingest.add_stability_results(session, 2, 10,
+                                     stability_payload['results'])
+
+        written = {call[0][1].name: call[0][2]
+                   for call in ingest.upsert.call_args_list
+                   if call[0][2]}
+        assert not written
+
+    def test_counts(self, session):
+        """The change to the job's counters is returned."""
+        counts = ingest.add_stability_results(session, 2, 10,
+                                              stability_payload['results'])
+
+        assert counts == ingest.ResultCounts(2, 2, (10, 10, 0, 0, 0, 0, 0))
+
+    def test_counts_delta(self, session):
+        """Rewritten results only count the difference."""
+        ingest.add_stability_results(session, 2, 10,
+                                     stability_payload['results'])
+        results = deepcopy(stability_payload['results'])
+        results[0]['result']['subtests'][0]['result']['status'] = {'pass': 10}
+
+        counts = ingest.add_stability_results(session, 2, 10, results)
+
+        assert counts == ingest.ResultCounts(0, -1, (5, -5, 0, 0, 0, 0, 0))
+
+    def test_job_locked_before_preload(self, session, mocker):
+        """Existing results are read only once the job is locked."""
+        calls = []
+        mocker.patch.object(ingest, '_lock', side_effect=lambda *args:
+                            calls.append('lock'))
+        mocker.patch.object(ingest, 'preload_job_results',
+                            side_effect=lambda *args: calls.append('preload')
+                            or {})
+
+        ingest.add_stability_results(session, 2, 10,
+                                     stability_payload['results'])
+
+        assert calls == ['lock', 'preload']
+        assert ingest._lock.call_args[0][1:] == (models.Job, 2)
+
+    def test_batches(self, session):
+        """Payloads larger than one statement are split into batches."""
+        results = [{'test': 'test %s' % i, 'result': {'status': {'ok': 1}}}
+                   for i in range(1000)]
+
+        ingest.add_stability_results(session, 2, 1, results)
+
+        assert session.query(models.Test).count() == 1000
+        assert session.query(models.JobResult).count() == 1000
+
+    def test_reparent_subtest(self, session):
+        """A subtest reported under a new parent is moved to it."""
+        ingest.add_stability_results(session, 2, 10,
+                                     stability_payload['results'])
+        results = deepcopy(stability_payload['results'])
+        results[0]['test'] = 'feed the dog'
+
+        ingest.add_stability_results(session, 2, 10, results)
+
+        subtest = session.query(models.Test).filter_by(
+            path='curb the dog'
+        ).one()
+        assert subtest.parent.path == 'feed the dog'
+        assert subtest.tree_path == 'feed the dog\x1fcurb the dog'
+
+
+class TestUpdateCounters(object):
+
+    """Test maintenance of the job and build counters."""
+
+    def test_job_and_build(self, session):
+        """Counts are added to both the job and its build."""
+        build = models.Build(id=1, number=1,
+                             status=models.BuildStatus.PENDING)
+        jobs = [models.Job(id=job_id, build=build, allow_failure=False,
+                           product=models.Product(name='firefox'))
+                for job_id in (2, 3)]
+        session.add_all(jobs)
+        session.commit()
+
+        ingest.update_counters(session, 2,
+                               ingest.ResultCounts(2, 1, (1,) * 7))
+        ingest.update_counters(session, 3,
+                               ingest.ResultCounts(3, 0, (2,) * 7))
+        session.commit()
+
+        assert (jobs[0].result_count, jobs[0].inconsistent_count,
+                jobs[0].status_totals) == (2, 1, (1,) * 7)
+        assert (build.result_count, build.inconsistent_count,
+                build.status_totals) == (5, 1, (3,) * 7)
+
+
+    def test_sum_counts(self):
+        """Counts from several batches add up."""
+        total = ingest.sum_counts([ingest.ResultCounts(2, 1, (1,) * 7),
+                                   ingest.ResultCounts(3, -1, (2,) * 7)])
+
+        assert total == ingest.ResultCounts(5, 0, (3,) * 7)
+        assert ingest.sum_counts([]) == ingest.ResultCounts(0, 0, (0,) * 7)
+
+
+class TestTestIdCache(object):
+
+    """Test interning of test paths into ids."""
+
+    def test_promoted_on_commit(self, session):
+        """Ids enter the cache only once their transaction commits."""
+        ingest.add_stability_results(session, 2, 10,
+                                     stability_payload['results'])
+        assert ingest.TEST_IDS.get('walk the dog') is None
+
+        session.commit()
+
+        parent = session.query(models.Test).filter_by(
+            path='walk the dog'
+        ).one()
+        assert ingest.TEST_IDS.get('walk the dog') == (parent.id, None)
+        assert ingest.TEST_IDS.get('curb the dog') == (
+            parent.subtests[0].id, parent.id
+        )
+
+    def test_discarded_on_rollback(self, session):
+        """Ids from a rolled back transaction are never cached."""
+        ingest.add_stability_results(session, 2, 10,
+                                     stability_payload['results'])
+
+        session.rollback()
+        session.commit()
+
+        assert len(ingest.TEST_IDS) == 0
+
+    def test_cached_ids_skip_lookup(self, session, mocker):
+        """Known paths are resolved without querying the test table."""
+        ingest.add_stability_results(session, 2, 10,
+                                     stability_payload['results'])
+        session.commit()
+        mocker.spy(session, 'query')
+
+        ingest.add_stability_results(session, 3, 10,
+                                     stability_payload['results'])
+
+        queried = [call[0][0] for call in session.query.call_args_list]
+        assert models.Test.path not in queried
+
+    def test_lru_eviction(self):
+        """The least recently used path is evicted first."""
+        cache = ingest.TestIdCache(2)
+        cache.update({'a': (1, None), 'b': (2, None)})
+        cache.get('a')
+        cache.update({'c': (3, None)})
+
+        assert cache.get('b') is None
+        assert cache.get('a') == (1, None)
+        assert cache.get('c') == (3, None)
@@ -132,7 +132,7 @@ class TestJobResult(object):
 
     def test_job_result_no_job_id(self, session):
         """A job_result without job_id should throw Integrity Error."""
-        job_result = models.JobResult(test_id='foo', iterations=10)
+        job_result = models.JobResult(test_id=1, iterations=10)
 
         session.add(job_result)
         with pytest.raises(sqlalchemy.exc.IntegrityError):
@@ -148,7 +148,7 @@ class TestJobResult(object):
 
     def test_job_result_no_iterations(self, session):
         """A job_result without iterations should throw Integrity Error."""
-        job_result = models.JobResult(job_id=1, test_id='foo')
+        job_result = models.JobResult(job_id=1, test_id=1)
 
         session.add(job_result)
         with pytest.raises(sqlalchemy.exc.IntegrityError):
@@ -156,7 +156,7 @@ class TestJobResult(object):
 
     def test_job_result_no_consistent(self, session):
         """A job_result without iterations should throw Integrity Error."""
-        job_result = models.JobResult(job_id=1, test_id='foo', iterations=10)
+        job_result = models.JobResult(job_id=1, test_id=1, iterations=10)
 
         session.add(job_result)
         with pytest.raises(sqlalchemy.exc.IntegrityError):
@@ -164,7 +164,7 @@ class TestJobResult(object):
 
     def test_job_result_complete(self, session):
         """A job_result with all required fields should be added to DB."""
-        job_result = models.JobResult(job_id=1, test_id='foo', iterations=10,
+        job_result = models.JobResult(job_id=1, test_id=1, iterations=10,
                                       consistent=False)
 
         session.add(job_result)
@@ -177,11 +177,41 @@ class TestJobResult(object):
                                job_result_db.iterations)
         assert job_result_tuple == job_result_db_tuple
 
+    def test_job_result_status_counts(self, session):
+        """Status counts round-trip and are exposed as (status, count)."""
+        counts = {models.TestStatus.PASS: 4, models.TestStatus.TIMEOUT: 6}
+        job_result = models.JobResult(
+            job_id=1, test_id=1, iterations=10, consistent=False,
+            status_counts=models.StatusHistogram.from_counts(counts)
+        )
+
+        session.add(job_result)
+        session.commit()
+        session.expire_all()
+
+        job_result_db = models.JobResult.query.one()
+        assert job_result_db.status_counts == (4, 0, 0, 6, 0, 0, 0)
+        assert [(status.status, status.count)
+                for status in job_result_db.statuses] == [
+            (models.TestStatus.PASS, 4), (models.TestStatus.TIMEOUT, 6)
+        ]
+
+    def test_job_result_default_status_counts(self, session):
+        """A job_result without status counts has an empty histogram."""
+        job_result = models.JobResult(job_id=1, test_id=1, iterations=10,
+                                      consistent=True)
+
+        session.add(job_result)
+        session.commit()
+
+        assert job_result.status_counts == (0,) * 7
+        assert job_result.statuses == []
+
     def test_job_result_duplicate(self, session):
         """job_result with duplicate job_id & test_id should not be allowed."""
-        job_result = models.JobResult(job_id=1, test_id='foo', iterations=10,
+        job_result = models.JobResult(job_id=1, test_id=1, iterations=10,
                                       consistent=False)
-        job_result_2 = models.JobResult(job_id=1, test_id='foo', iterations=1,
+        job_result_2 = models.JobResult(job_id=1, test_id=1, iterations=1,
                                         consistent=True)
 
         session.add(job_result)
@@ -192,16 +222,16 @@ class TestJobResult(object):
 
     def test_job_result_some_duplicate(self, session):
         """job_result with same job_id, but different test_id is allowed."""
-        job_result_1 = models.JobResult(job_id=1, test_id='foo', iterations=10,
+        job_result_1 = models.JobResult(job_id=1, test_id=1, iterations=10,
                                         consistent=False)
-        job_result_2 = models.JobResult(job_id=1, test_id='foo2', iterations=1,
+        job_result_2 = models.JobResult(job_id=1, test_id=2, iterations=1,
                                         consistent=True)
 
         session.add(job_result_1)
         session.add(job_result_2)
 
-        job_result_1_db = models.JobResult.query.filter(models.JobResult.test_id == 'foo').one()
-        job_result_2_db = models.JobResult.query.filter(models.JobResult.test_id == 'foo2').one()
+        job_result_1_db = models.JobResult.query.filter(models.JobResult.test_id == 1).one()
+        job_result_2_db = models.JobResult.query.filter(models.JobResult.test_id == 2).one()
         job_result_1_tuple = (job_result_1.job_id, job_result_1.test_id,
                               job_result_1.iterations)
         job_result_1_db_tuple = (job_result_1_db.job_id, job_result_1_db.test_id,
@@ -454,84 +484,178 @@ class TestRepository(object):
         assert repository in repositories
 
 
-class TestStabilityStatus(object):
+class TestTest(object):
 
-    """Test the StabilityStatus model class."""
+    """Test the Test model class."""
 
-    def test_stability_status_no_job_id(self, session):
-        """A stability_status without job_id should throw Integrity Error."""
-        stability_status = models.StabilityStatus(
-            test_id=1, status=models.TestStatus.PASS, count=10
-        )
+    def test_stability_status_no_count(self, session):
+        """A test without path should throw Integrity Error."""
+        test = models.Test()
 
-        session.add(stability_status)
+        session.add(test)
         with pytest.raises(sqlalchemy.exc.IntegrityError):
             session.commit()
 
-    def test_stability_status_no_test_id(self, session):
-        """A stability_status without test_id should throw Integrity Error."""
-        stability_status = models.StabilityStatus(
-            job_id=1, status=models.TestStatus.PASS, count=10
-        )
-
-        session.add(stability_status)
-        with pytest.raises(sqlalchemy.exc.IntegrityError):
-            session.commit()
+    def test_repository_complete(self, session):
+        """A test with all required fields should be added to DB."""
+        test = models.Test(path='foo')
 
-    def test_stability_status_no_status(self, session):
-        """A stability_status without status should throw Integrity Error."""
-        stability_status = models.StabilityStatus(
-            job_id=1, test_id=1, count=10
-        )
+        session.add(test)
+        session.commit()
 
-        session.add(stability_status)
-        with pytest.raises(sqlalchemy.exc.IntegrityError):
-            session.commit()
+        tests = session.query(models.Test).all()
+        assert test in tests
 
-    def test_stability_status_no_count(self, session):
-        """A stability_status without count should throw Integrity Error."""
-        stability_status = models.StabilityStatus(
-            job_id=1, test_id=1, status=models.TestStatus.PASS
-        )
+    def test_test_duplicate_path(self, session):
+        """Two tests with the same path should not be allowed."""
+        session.add_all([models.Test(path='foo'), models.Test(path='foo')])
 
-        session.add(stability_status)
         with pytest.raises(sqlalchemy.exc.IntegrityError):
             session.commit()
 
-    def test_stability_status_complete(self, session):
-        """A stability_status with all required fields should be added to DB."""
-        stability_status = models.StabilityStatus(
-            job_id=1, test_id=1, status=models.TestStatus.PASS, count=10
-        )
 
-        session.add(stability_status)
-        session.commit()
+class TestGetJobResults(object):
 
-        statuses = session.query(models.StabilityStatus).all()
-        assert stability_status in statuses
+    """Test the get_job_results and get_tests_under functions."""
 
+    @pytest.fixture
+    def results(self, session):
+        css = models.Test(path='/css/a.html', tree_path='/css/a.html')
+        css_subtest = models.Test(path='a1', parent=css,
+                                  tree_path='/css/a.html\x1fa1')
+        css_sibling = models.Test(path='/css/a.html.ini',
+                                  tree_path='/css/a.html.ini')
+        dom = models.Test(path='/dom/b.html', tree_path='/dom/b.html')
+        tests = [dom, css_sibling, css_subtest, css]
+        session.add_all(tests)
+        session.flush()
+        session.add_all([
+            models.JobResult(job_id=1, test_id=test.id, iterations=10,
+                             consistent=test is not css_sibling)
+            for test in tests
+        ])
+        session.commit()
 
-class TestTest(object):
+    def test_grouped(self, session, results):
+        """Subtest results follow their parent in tree path order."""
+        groups = models.get_job_results(session, 1)
+
+        assert [(group.result.test.path,
+                 [sub.test.path for sub in group.subresults])
+                for group in groups] == [('/css/a.html', ['a1']),
+                                         ('/css/a.html.ini', []),
+                                         ('/dom/b.html', [])]
+
+    def test_prefix(self, session, results):
+        """Only results under the prefix are returned."""
+        groups = models.get_job_results(session, 1, prefix='/dom/')
+
+        assert [group.result.test.path for group in groups] == ['/dom/b.html']
+
+    def test_consistent(self, session, results):
+        """Results can be filtered on consistency."""
+        groups = models.get_job_results(session, 1, consistent=False)
+
+        assert [group.result.test.path for group in groups] == [
+            '/css/a.html.ini'
+        ]
+
+    def test_tests_under(self, session, results):
+        """Tests and subtests under a directory are returned in order."""
+        tests = models.get_tests_under(session, '/css/').all()
+
+        assert [test.path for test in tests] == ['/css/a.html', 'a1',
+                                                 '/css/a.html.ini']
+
+    def test_tests_under_escaped(self, session, results):
+        """LIKE wildcards in the prefix match literally."""
+        assert models.get_tests_under(session, '/c_s/').count() == 0
+
+
+class TestGetPullRequestPage(object):
+
+    """Test the get_pull_request_page function."""
+
+    @pytest.fixture
+    def pulls(self, session):
+        # Pull requests 2 and 3 were opened at the same time.
+        created = [datetime(2017, 1, day) for day in (1, 2, 2, 3, 4)]
+        session.add_all([
+            models.PullRequest(id=number, number=number,
+                               state=models.PRStatus.OPEN, merged=False,
+                               head_sha='abcdef12345', base_sha='12345abcdef',
+                               title='abc', head_repo_id=1, base_repo_id=1,
+                               head_branch='foo', base_branch='bar',
+                               created_at=created_at, updated_at=created_at)
+            for number, created_at in enumerate(created, 1)
+        ])
+        session.add_all([
+            models.Build(id=1, number=1, pull_request_id=4,
+                         status=models.BuildStatus.FAILED,
+                         started_at=datetime(2017, 1, 5)),
+            models.Build(id=2, number=2, pull_request_id=4,
+                         status=models.BuildStatus.PASSED,
+                         started_at=datetime(2017, 1, 6)),
+            models.Build(id=3, number=3, pull_request_id=4,
+                         status=models.BuildStatus.PENDING),
+            models.Build(id=4, number=4, pull_request_id=2,
+                         status=models.BuildStatus.ERRORED,
+                         started_at=datetime(2017, 1, 5)),
+        ])
+        session.commit()
 
-    """Test the Test model class."""
+    @staticmethod
+    def numbers(page):
+        return [pull.number for pull in page.pulls]
+
+    def test_first_page(self, session, pulls):
+        """The first page holds the newest pull requests."""
+        page = models.get_pull_request_page(session, limit=2)
+
+        assert self.numbers(page) == [5, 4]
+        assert page.newer is None
+        assert page.older == models.encode_cursor(page.pulls[-1])
+
+    def test_walk_older(self, session, pulls):
+        """Older pages follow on, breaking created_at ties by id."""
+        page = models.get_pull_request_page(session, limit=2)
+        page = models.get_pull_request_page(session, before=page.older,
+                                            limit=2)
+        assert self.numbers(page) == [3, 2]
+        assert page.newer and page.older
+
+        page = models.get_pull_request_page(session, before=page.older,
+                                            limit=2)
+        assert self.numbers(page) == [1]
+        assert page.older is None
+
+    def test_walk_newer(self, session, pulls):
+        """Newer pages are returned newest first too."""
+        oldest = models.get_pull_request_page(session, limit=5).pulls[-1]
+
+        page = models.get_pull_request_page(
+            session, after=models.encode_cursor(oldest), limit=2
+        )
+        assert self.numbers(page) == [3, 2]
+        assert page.newer and page.older
 
-    def test_stability_status_no_count(self, session):
-        """A test without id should throw Integrity Error."""
-        test = models.Test()
+        page = models.get_pull_request_page(session, after=page.newer,
+                                            limit=2)
+        assert self.numbers(page) == [5, 4]
+        assert page.newer is None
 
-        session.add(test)
-        with pytest.raises(sqlalchemy.exc.IntegrityError):
-            session.commit()
+    def test_latest_builds(self, session, pulls):
+        """Each pull request gets its latest build, unstarted ones first."""
+        page = models.get_pull_request_page(session)
 
-    def test_repository_complete(self, session):
-        """A test with all required fields should be added to DB."""
-        test = models.Test(id='foo')
+        assert {pull_id: build.id
+                for pull_id, build in page.latest_builds.items()} == {4: 3,
+                                                                      2: 4}
 
-        session.add(test)
-        session.commit()
-
-        tests = session.query(models.Test).all()
-        assert test in tests
+    def test_invalid_cursor(self, session, pulls):
+        """Malformed cursors raise ValueError."""
+        with pytest.raises(ValueError):
+            models.get_pull_request_page(session, before='yesterday')
 
 
 class TestTestMirror(object):
@@ -553,17 +677,57 @@ class TestGetOrCreate(object):
 
     def test_get(self, session):
         """It should retrieve an existing object from the database."""
-        test = models.Test(id='foo')
+        test = models.Test(path='foo')
 
         session.add(test)
         session.commit()
 
-        instance, _ = models.get_or_create(session, models.Test, id='foo')
+        instance, _ = models.get_or_create(session, models.Test, path='foo')
 
         assert instance and not _
 
     def test_create(self, session):
         """It should create and return a new object."""
-        instance, _ = models.get_or_create(session, models.Test, id='bar')
+        instance, _ = models.get_or_create(session, models.Test, path='bar')
 
         assert instance and _
+
+
+class TestIdentityMap(object):
+
+    """Test the IdentityMap class."""
+
+    def test_preload(self, session):
+        """It should fetch every matching object in one query."""
+        session.add_all([models.Test(path='foo'), models.Test(path='bar')])
+        session.commit()
+
+        identity_map = models.IdentityMap(session)
+        tests = identity_map.preload(models.Test, path=['foo', 'bar', 'baz'])
+
+        assert set(tests) == {'foo', 'bar'}
+
+    def test_get_preloaded(self, session, mocker):
+        """It should not query for values that were already preloaded."""
+        session.add(models.Test(path='foo'))
+        session.commit()
+
+        identity_map = models.IdentityMap(session)
+        identity_map.preload(models.Test, path=['foo', 'bar'])
+        mocker.spy(session, 'query')
+
+        assert identity_map.get(models.Test, path='foo').path == 'foo'
+        assert identity_map.get(models.Test, path='bar') is None
+        assert session.query.call_count == 0
+
+    def test_get_or_create(self, session):
+        """It should create a missing object only once."""
+        identity_map = models.IdentityMap(session)
+
+        instance, created = identity_map.get_or_create(models.Test,
+                                                       path='foo')
+        again, created_again = identity_map.get_or_create(models.Test,
+                                                          path='foo')
+
+        assert created and not created_again
+        assert instance is again
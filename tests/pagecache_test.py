@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from datetime import datetime
+import os
+
+import pytest
+
+from wptdash.pagecache import (FileSystemBackend, LRUBackend, PageCache,
+                               UWSGIBackend, create_backend, templates_digest)
+import wptdash.models as models
+
+
+@pytest.fixture(params=['lru', 'filesystem'])
+def backend(request, tmpdir):
+    if request.param == 'lru':
+        return LRUBackend(maxsize=10)
+    return FileSystemBackend(str(tmpdir), threshold=10)
+
+
+@pytest.fixture
+def page_cache(app, mocker):
+    cache = PageCache(LRUBackend())
+    mocker.patch.dict(app.extensions, {'page_cache': cache})
+    return cache
+
+
+class TestBackends(object):
+
+    """Test the page cache storage backends."""
+
+    def test_set_get_delete(self, backend):
+        """Stored values are returned until deleted."""
+        assert backend.get('a') is None
+        backend.set('a', 'x')
+        backend.set('a', 'y')
+        assert backend.get('a') == 'y'
+
+        backend.delete('a')
+        backend.delete('a')
+        assert backend.get('a') is None
+
+    def test_add(self, backend):
+        """Adding keeps an existing value and returns it."""
+        assert backend.add('a', 'x') == 'x'
+        assert backend.add('a', 'y') == 'x'
+        assert backend.get('a') == 'x'
+
+    def test_bounded(self, backend):
+        """Entries are dropped beyond the size limit."""
+        for index in range(15):
+            backend.set('key %d' % index, 'value')
+
+        assert len([index for index in range(15)
+                    if backend.get('key %d' % index)]) == 10
+
+    def test_lru_order(self):
+        """The LRU drops the least recently used entry."""
+        backend = LRUBackend(maxsize=2)
+        backend.set('a', 'x')
+        backend.set('b', 'x')
+        backend.get('a')
+        backend.set('c', 'x')
+
+        assert backend.get('b') is None
+        assert backend.get('a') == 'x'
+
+    def test_filesystem_no_temporary_files(self, tmpdir):
+        """Only complete entries are left in the directory."""
+        backend = FileSystemBackend(str(tmpdir))
+        backend.set('a', 'x')
+        backend.add('a', 'y')
+        backend.add('b', 'y')
+
+        assert len(os.listdir(str(tmpdir))) == 2
+
+    def test_uwsgi_unavailable(self):
+        """The uwsgi backend needs to run under uWSGI."""
+        with pytest.raises(RuntimeError):
+            UWSGIBackend()
+
+    def test_create_backend(self, tmpdir):
+        """PAGE_CACHE selects the backend."""
+        assert create_backend({}) is None
+        assert isinstance(create_backend({'PAGE_CACHE': 'lru'}), LRUBackend)
+        assert isinstance(create_backend({'PAGE_CACHE': 'filesystem',
+                                          'PAGE_CACHE_DIR': str(tmpdir)}),
+                          FileSystemBackend)
+        with pytest.raises(ValueError):
+            create_backend({'PAGE_CACHE': 'memcached'})
+        with pytest.raises(ValueError):
+            create_backend({'PAGE_CACHE': 'filesystem'})
+
+    def test_filesystem_private(self, tmpdir):
+        """The directory is created private; a shared one is refused."""
+        directory = str(tmpdir.join('pages'))
+        FileSystemBackend(directory)
+        assert os.stat(directory).st_mode & 0o077 == 0
+
+        shared = str(tmpdir.join('shared'))
+        os.mkdir(shared)
+        os.chmod(shared, 0o777)
+        with pytest.raises(ValueError):
+            FileSystemBackend(shared)
+
+
+class TestPageCache(object):
+
+    """Test storing pages under version stamps."""
+
+    def test_stamp_stable(self, backend):
+        """A page keeps its stamp until it is bumped."""
+        cache = PageCache(backend)
+        stamp = cache.stamp('build', 1)
+
+        assert cache.stamp('build', 1) == stamp
+        assert cache.stamp('build', 2) != stamp
+
+    def test_bump(self, backend):
+        """Bumping a page's stamp drops its cached copy."""
+        cache = PageCache(backend)
+        stamp = cache.stamp('build', 1)
+        cache.put('build', 1, stamp, '<html>')
+        assert cache.get('build', 1, stamp) == '<html>'
+
+        cache.bump('build', 1)
+
+        assert cache.stamp('build', 1) != stamp
+        assert cache.get('build', 1, stamp) is None
+        assert cache.stats() == {'hits': 1, 'misses': 1, 'stored': 1,
+                                 'bumped': 1}
+
+
+    def test_version(self, backend):
+        """Pages and ETags depend on the template version."""
+        cache = PageCache(backend, version='v1')
+        stamp = cache.stamp('build', 1)
+        cache.put('build', 1, stamp, '<html>')
+
+        other = PageCache(backend, version='v2')
+        assert other.stamp('build', 1) == stamp
+        assert other.get('build', 1, stamp) is None
+        assert cache.etag(stamp) != other.etag(stamp)
+
+    def test_templates_digest(self, app):
+        """The template version is stable."""
+        assert templates_digest(app) == templates_digest(app)
+
+
+class TestInvalidation(object):
+
+    """Test that committed changes bump page stamps."""
+
+    def add_job(self, session):
+        build = models.Build(id=1, number=10, status=models.BuildStatus.PENDING)
+        job = models.Job(id=1, number='10.1', build=build,
+                         product=models.Product(name='firefox'),
+                         allow_failure=False)
+        session.add(job)
+        session.commit()
+        return job
+
+    def test_commit(self, session, page_cache):
+        """Changing a job bumps the job and build pages on commit."""
+        job = self.add_job(session)
+        build_stamp = page_cache.stamp('build', 10)
+        job_stamp = page_cache.stamp('job', '10.1')
+
+        job.state = models.JobStatus.PASSED
+        session.flush()
+        assert page_cache.stamp('job', '10.1') == job_stamp
+
+        session.commit()
+        assert page_cache.stamp('job', '10.1') != job_stamp
+        assert page_cache.stamp('build', 10) != build_stamp
+
+    def test_pull_request(self, session, page_cache):
+        """Changing a build bumps its pull request's page on commit."""
+        job = self.add_job(session)
+        job.build.pull_request = models.PullRequest(
+            id=1, number=5, state=models.PRStatus.OPEN, merged=False,
+            head_sha='abcdef12345', base_sha='12345abcdef', title='abc',
+            head_repo_id=1, base_repo_id=1, head_branch='foo',
+            base_branch='bar', created_at=datetime.now(),
+            updated_at=datetime.now()
+        )
+        session.commit()
+        pull_stamp = page_cache.stamp('pull', 5)
+
+        job.build.status = models.BuildStatus.PASSED
+        session.commit()
+
+        assert page_cache.stamp('pull', 5) != pull_stamp
+
+    def test_rollback(self, session, page_cache):
+        """Changes that are rolled back leave stamps alone."""
+        job = self.add_job(session)
+        job_stamp = page_cache.stamp('job', '10.1')
+
+        job.state = models.JobStatus.PASSED
+        session.flush()
+        session.rollback()
+        session.commit()
+
+        assert page_cache.stamp('job', '10.1') == job_stamp
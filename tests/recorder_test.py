@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import io
+import json
+import os
+import time
+
+from flask import Flask
+from werkzeug.test import EnvironBuilder
+
+import wptdash.models as models
+from wptdash.recorder import WebhookRecorder, read_capture
+from wptdash.replay import format_report, replay
+from tests.blueprints.fixtures.payloads import (github_webhook_payload,
+                                                stability_payload)
+
+
+def record(path, body, received_at, method='POST',
+           content_type='application/json'):
+    return {'received_at': received_at, 'method': method, 'path': path,
+            'query_string': '', 'body': json.dumps(body).encode('utf-8'),
+            'headers': {'Content-Type': content_type,
+                        'X-Hub-Signature': 'sha1=unchecked'}}
+
+
+class TestWebhookRecorder(object):
+
+    """Test recording webhook requests to a capture file."""
+
+    def test_record(self, app, client, session, tmpdir, mocker):
+        """Webhook requests are captured and still reach the app."""
+        recorder = WebhookRecorder(app.wsgi_app, str(tmpdir))
+        mocker.patch.object(app, 'wsgi_app', recorder)
+        body = json.dumps({'issue_number': 1, 'url': 'abc'})
+
+        rv = client.post('/api/test-mirror', data=body,
+                         content_type='application/json')
+        client.get('/')
+        recorder.close()
+
+        assert rv.status_code == 422
+        records = list(read_capture(recorder.path))
+        assert len(records) == 1
+        assert records[0]['method'] == 'POST'
+        assert records[0]['path'] == '/api/test-mirror'
+        assert records[0]['body'] == body.encode('utf-8')
+        assert records[0]['headers']['Content-Type'] == 'application/json'
+        assert records[0]['received_at'] <= time.time()
+        assert os.path.basename(recorder.path).endswith('.jsonl.gz')
+
+    def test_streamed_body(self, tmpdir):
+        """Bodies without a length are recorded in full as the app reads."""
+        lines = []
+
+        def app(environ, start_response):
+            lines.append(environ['wsgi.input'].readline())
+            start_response('202 Accepted', [])
+            return [b'']
+        recorder = WebhookRecorder(app, str(tmpdir))
+        body = b'{"header": 1}\n' + b'{"result": 2}\n' * 10000
+        environ = EnvironBuilder('/api/stability', method='POST',
+                                 input_stream=io.BytesIO(body)).get_environ()
+        environ.pop('CONTENT_LENGTH', None)
+        environ['wsgi.input_terminated'] = True
+
+        recorder(environ, lambda status, headers: None)
+        recorder.close()
+
+        assert lines == [b'{"header": 1}\n']
+        assert [entry['body'] for entry in read_capture(recorder.path)] == [
+            body
+        ]
+
+    def test_unclosed_capture(self, app, tmpdir):
+        """Lines flushed by a process that is still running can be read."""
+        recorder = WebhookRecorder(app.wsgi_app, str(tmpdir))
+        recorder.record({'REQUEST_METHOD': 'POST', 'PATH_INFO': '/api/pull'},
+                        b'{}')
+
+        assert [entry['body'] for entry in read_capture(recorder.path)] == [
+            b'{}'
+        ]
+        recorder.close()
+
+
+class TestReplay(object):
+
+    """Test replaying a capture against the app."""
+
+    def test_replay(self, app, session, mocker):
+        """Requests are ingested with signatures and GitHub stubbed."""
+        sleep = mocker.patch('wptdash.replay.time.sleep')
+        records = [
+            record('/api/pull', github_webhook_payload, 100.0),
+            record('/api/stability', stability_payload, 110.0),
+        ]
+
+        report = replay(app, records, speed=10)
+
+        assert report['requests'] == 2
+        assert report['statuses'] == {200: 2}
+        assert report['latency_max'] >= report['latency_p50'] > 0
+        assert session.query(models.JobResult).count() == 2
+        pull_request = session.query(models.PullRequest).one()
+        assert pull_request.comment_url.startswith('https://api.github.com/')
+        assert 0.5 < sleep.call_args[0][0] <= 1.0
+
+    def test_workers(self):
+        """Workers send requests at their scheduled times concurrently."""
+        app = Flask(__name__)
+
+        @app.route('/api/pull', methods=['POST'])
+        def slow():
+            time.sleep(0.2)
+            return 'OK'
+        records = [record('/api/pull', {}, 100.0) for _ in range(4)]
+
+        report = replay(app, records, speed=1, workers=4)
+
+        assert report['statuses'] == {200: 4}
+        assert report['elapsed'] < 0.6
+        assert report['lag_max'] < 100
+
+    def test_lag(self):
+        """Requests that wait for a busy worker are reported as lagging."""
+        app = Flask(__name__)
+
+        @app.route('/api/pull', methods=['POST'])
+        def slow():
+            time.sleep(0.1)
+            return 'OK'
+        records = [record('/api/pull', {}, 100.0) for _ in range(3)]
+
+        report = replay(app, records, speed=1)
+
+        assert report['lag_max'] >= 150
+        assert 'behind schedule' in format_report(report)
+
+    def test_unknown_pull_request(self, app, session, mocker):
+        """Pull requests never sent are stood in for by a known one."""
+        stability = json.loads(json.dumps(stability_payload))
+        stability['pull']['number'] = 2
+        records = [
+            record('/api/pull', github_webhook_payload, 100.0),
+            record('/api/stability', stability, 100.0),
+        ]
+
+        report = replay(app, records, speed=None)
+
+        assert report['statuses'] == {200: 2}
+        assert session.query(models.PullRequest).filter_by(
+            number=2
+        ).count() == 1
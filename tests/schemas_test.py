@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from copy import deepcopy
+import pytest
+
+from jsonschema.exceptions import ValidationError
+from wptdash import schemas
+from tests.blueprints.fixtures.payloads import stability_payload
+
+SUBTESTS = stability_payload['results'][0]['result']['subtests']
+
+
+class TestValidateSubtests(object):
+
+    """Test the hand-written subtest validator."""
+
+    def test_valid(self):
+        """A well-formed subtests array passes."""
+        schemas.validate_subtests(SUBTESTS)
+
+    def test_unknown_status(self):
+        """Status names outside the known set are not constrained."""
+        subtests = deepcopy(SUBTESTS)
+        subtests[0]['result']['status']['unknown'] = 'abc'
+        schemas.validate_subtests(subtests)
+
+    @pytest.mark.parametrize('mutate', [
+        lambda subtest: subtest.pop('test'),
+        lambda subtest: subtest.pop('result'),
+        lambda subtest: subtest['result'].pop('status'),
+        lambda subtest: subtest['result'].pop('messages'),
+        lambda subtest: subtest.update(test=1),
+        lambda subtest: subtest['result'].update(status=[]),
+        lambda subtest: subtest['result']['status'].update({'pass': '5'}),
+        lambda subtest: subtest['result']['status'].update(fail=True),
+        lambda subtest: subtest['result']['status'].update(fail=1.5),
+        lambda subtest: subtest['result'].update(messages='abc'),
+        lambda subtest: subtest['result']['messages'].append(1),
+    ])
+    def test_invalid(self, mutate):
+        """Each schema violation throws jsonschema ValidationError."""
+        subtests = deepcopy(SUBTESTS)
+        mutate(subtests[0])
+        with pytest.raises(ValidationError):
+            schemas.validate_subtests(subtests)
+
+    def test_not_object(self):
+        """Subtests that are not objects throw ValidationError."""
+        with pytest.raises(ValidationError):
+            schemas.validate_subtests(['abc'])
+
+
+class TestValidateStabilityResults(object):
+
+    """Test validation of the stability results array."""
+
+    def test_valid(self):
+        """A well-formed results array passes."""
+        schemas.validate_stability_results(stability_payload['results'])
+
+    def test_invalid_subtest(self):
+        """Subtests nested in a result are validated."""
+        results = deepcopy(stability_payload['results'])
+        results[0]['result']['subtests'][0].pop('test')
+        with pytest.raises(ValidationError):
+            schemas.validate_stability_results(results)
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from datetime import datetime
+import io
+import json
+import os
+import time
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import wptdash.models as models
+from wptdash.github import RateLimited
+from wptdash import spool as spool_module
+from wptdash.spool import DeferredPayloads, Spool, work
+from tests.blueprints.fixtures.payloads import stability_payload
+
+
+class TestSpool(object):
+
+    """Test the on-disk webhook spool."""
+
+    def test_put_and_claim(self, tmpdir):
+        """A stored payload can be claimed with its metadata and body."""
+        spool = Spool(str(tmpdir))
+        spool.put('pull', 'application/json', b'{"a": 1}')
+
+        entry = spool.claim()
+
+        assert entry.kind == 'pull'
+        assert entry.content_type == 'application/json'
+        with entry.open() as body:
+            assert body.read() == b'{"a": 1}'
+        assert spool.claim() is None
+
+    def test_put_stream(self, tmpdir):
+        """File-like bodies are copied into the spool."""
+        spool = Spool(str(tmpdir))
+        spool.put('stability', 'application/x-ndjson',
+                  io.BytesIO(b'line 1\nline 2\n'))
+
+        with spool.claim().open() as body:
+            assert body.readlines() == [b'line 1\n', b'line 2\n']
+
+    def test_claim_oldest_first(self, tmpdir):
+        """Entries are claimed in the order they arrived."""
+        spool = Spool(str(tmpdir))
+        spool.put('pull', 'application/json', b'1')
+        spool.put('pull', 'application/json', b'2')
+
+        with spool.claim().open() as body:
+            assert body.read() == b'1'
+
+    def test_complete_and_fail(self, tmpdir):
+        """Completed entries are removed and failed ones set aside."""
+        spool = Spool(str(tmpdir))
+        spool.put('pull', 'application/json', b'1')
+        spool.put('pull', 'application/json', b'2')
+
+        spool.complete(spool.claim())
+        spool.fail(spool.claim())
+
+        assert spool.stats()['depth'] == 0
+        assert spool.stats()['failed'] == 1
+        assert len(os.listdir(str(tmpdir.join('failed')))) == 1
+
+    def test_defer(self, tmpdir):
+        """Deferred entries are not claimed again until they are due."""
+        spool = Spool(str(tmpdir))
+        spool.put('pull', 'application/json', b'1')
+        spool.put('pull', 'application/json', b'2')
+
+        spool.defer(spool.claim(), 60)
+
+        with spool.claim().open() as body:
+            assert body.read() == b'2'
+        assert spool.claim() is None
+        assert spool.stats()['depth'] == 1
+
+    def test_expired_claim_requeued(self, tmpdir):
+        """Entries left claimed past the lease are claimed again."""
+        spool = Spool(str(tmpdir), lease=60)
+        spool.put('pull', 'application/json', b'1')
+        entry = spool.claim()
+        assert spool.claim() is None
+
+        claimed_at = time.time() - 61
+        os.utime(entry.path, (claimed_at, claimed_at))
+        requeued = spool.claim()
+
+        assert requeued.name == entry.name
+        with requeued.open() as body:
+            assert body.read() == b'1'
+        # The worker whose claim expired finishing does no harm.
+        spool.complete(entry)
+        spool.complete(requeued)
+        assert spool.stats()['in_progress'] == 0
+
+    def test_old_entry_claim_kept(self, tmpdir):
+        """Entries that waited long in the spool get a fresh lease."""
+        spool = Spool(str(tmpdir), lease=60)
+        spool.put('pull', 'application/json', b'1')
+        spool.put('pull', 'application/json', b'2')
+        written_at = time.time() - 3600
+        for name in os.listdir(str(tmpdir.join('new'))):
+            os.utime(str(tmpdir.join('new', name)), (written_at, written_at))
+
+        first = spool.claim()
+        second = spool.claim()
+
+        assert first.name != second.name
+        assert spool.stats()['in_progress'] == 2
+
+    def test_retry(self, tmpdir):
+        """A failed entry is retried after a delay."""
+        spool = Spool(str(tmpdir))
+        spool.put('pull', 'application/json', b'1')
+
+        assert spool.retry(spool.claim())
+
+        assert spool.claim() is None
+        name = os.listdir(str(tmpdir.join('new')))[0]
+        assert int(name.split('.')[0]) / 1e6 == pytest.approx(
+            time.time() + spool_module.RETRY_DELAY, abs=5
+        )
+
+    def test_retry_limit(self, tmpdir, mocker):
+        """Entries are failed once they used up their attempts."""
+        mocker.patch('wptdash.spool.RETRY_DELAY', 0)
+        spool = Spool(str(tmpdir))
+        spool.put('pull', 'application/json', b'1')
+
+        for attempts in range(spool_module.MAX_ATTEMPTS - 1):
+            entry = spool.claim()
+            assert entry.attempts == attempts
+            assert spool.retry(entry)
+
+        assert not spool.retry(spool.claim())
+        assert spool.stats()['failed'] == 1
+        assert spool.stats()['depth'] == 0
+
+    def test_stats(self, tmpdir):
+        """Stats report pending entries and the age of the oldest."""
+        spool = Spool(str(tmpdir))
+        assert spool.stats()['oldest_age_seconds'] is None
+
+        spool.put('pull', 'application/json', b'1')
+        stats = spool.stats()
+
+        assert stats['depth'] == 1
+        assert stats['in_progress'] == 0
+        assert stats['oldest_age_seconds'] >= 0
+
+
+class TestDeferredPayloads(object):
+
+    """Test the in-process queue of rate limited payloads."""
+
+    def test_processed_after_delay(self):
+        """Payloads are processed once their delay has passed."""
+        processed = []
+
+        def process(kind, content_type, body):
+            processed.append((kind, content_type, body.read()))
+            return 'OK', 200
+        queue = DeferredPayloads(process)
+        body = io.BytesIO(b'{}')
+
+        assert queue.defer('build', 'application/json', body, 0.01)
+        assert queue.wait_idle(5)
+
+        assert processed == [('build', 'application/json', b'{}')]
+        assert body.closed
+        assert queue.stats() == {'deferred': 1, 'pending': 0,
+                                 'processed': 1, 'failed': 0}
+
+    def test_deferred_again(self):
+        """Payloads deferred again are reread from the start later."""
+        bodies = []
+
+        def process(kind, content_type, body):
+            bodies.append(body.read())
+            if len(bodies) == 1:
+                raise RateLimited(0.01)
+            return 'OK', 200
+        queue = DeferredPayloads(process)
+
+        queue.defer('stability', 'application/x-ndjson',
+                    io.BytesIO(b'line\n'), 0)
+        assert queue.wait_idle(5)
+
+        assert bodies == [b'line\n', b'line\n']
+        assert queue.stats()['processed'] == 1
+
+    def test_failed(self):
+        """Payloads that raise or are rejected are counted as failed."""
+        def process(kind, content_type, body):
+            if kind == 'build':
+                raise ValueError(kind)
+            return 'Forbidden', 403
+        queue = DeferredPayloads(process)
+
+        queue.defer('build', 'application/json', io.BytesIO(b'{}'), 0)
+        queue.defer('stability', 'application/json', io.BytesIO(b'{}'), 0)
+        assert queue.wait_idle(5)
+
+        assert queue.stats()['failed'] == 2
+
+    def test_full(self):
+        """Payloads beyond the size limit are refused."""
+        queue = DeferredPayloads(lambda *args: ('OK', 200), maxsize=1)
+
+        assert queue.defer('build', 'application/json', io.BytesIO(), 60)
+        assert not queue.defer('build', 'application/json', io.BytesIO(), 60)
+        assert queue.stats()['pending'] == 1
+
+
+class TestSpooledRoutes(object):
+
+    """Test webhook routes when spooling is enabled."""
+
+    def test_stability_spooled(self, app, client, session, tmpdir, mocker):
+        """Payloads are acknowledged at once and ingested by the worker."""
+        mocker.patch.dict(app.config, {'WEBHOOK_SPOOL_DIR': str(tmpdir)})
+        mocker.patch('wptdash.blueprints.routes.update_github_comment',
+                     return_value=('OK', 200))
+        pull_request = models.PullRequest(state=models.PRStatus.OPEN, number=1,
+                                          merged=False, head_sha='abcdef12345',
+                                          base_sha='12345abcdef', title='abc',
+                                          head_repo_id=1, base_repo_id=1,
+                                          head_branch='foo', base_branch='bar',
+                                          created_at=datetime.now(),
+                                          updated_at=datetime.now(), id=1)
+        session.add(pull_request)
+        session.commit()
+
+        rv = client.post('/api/stability', data=json.dumps(stability_payload),
+                         content_type='application/json')
+
+        assert rv.status_code == 202
+        assert session.query(models.JobResult).count() == 0
+        stats = json.loads(client.get('/api/stats').data.decode('utf-8'))
+        assert stats['spool']['depth'] == 1
+
+        work(app, Spool(str(tmpdir)), once=True)
+
+        assert session.query(models.JobResult).count() == 2
+        assert Spool(str(tmpdir)).stats()['depth'] == 0
+
+    def test_failed_entry(self, app, session, tmpdir):
+        """Entries that raise are moved aside instead of blocking the spool."""
+        spool = Spool(str(tmpdir))
+        spool.put('stability', 'application/json', b'{}')
+
+        work(app, spool, once=True)
+
+        assert spool.stats()['failed'] == 1
+
+    def test_server_error_entry(self, app, session, tmpdir, mocker):
+        """Entries answered with a server error are kept for a retry."""
+        mocker.patch('wptdash.blueprints.routes.process_spooled_request',
+                     return_value=('Bad Gateway', 500))
+        spool = Spool(str(tmpdir))
+        spool.put('stability', 'application/json', b'{}')
+
+        work(app, spool, once=True)
+
+        stats = spool.stats()
+        assert stats['failed'] == 0
+        assert stats['depth'] == 1
+        assert os.listdir(str(tmpdir.join('new')))[0].endswith('.1')
+
+    def test_database_error_entry(self, app, session, tmpdir, mocker):
+        """Entries whose handler raises unexpectedly are kept for a retry."""
+        mocker.patch('wptdash.blueprints.routes.process_spooled_request',
+                     side_effect=OperationalError('SELECT 1', {},
+                                                  Exception('gone away')))
+        spool = Spool(str(tmpdir))
+        spool.put('stability', 'application/json', b'{}')
+
+        work(app, spool, once=True)
+
+        stats = spool.stats()
+        assert stats['failed'] == 0
+        assert stats['depth'] == 1
+        assert os.listdir(str(tmpdir.join('new')))[0].endswith('.1')
+
+    def test_rejected_entry(self, app, session, tmpdir, mocker):
+        """Entries answered with a client error are set aside."""
+        mocker.patch('wptdash.blueprints.routes.process_spooled_request',
+                     return_value=('Unprocessable', 422))
+        spool = Spool(str(tmpdir))
+        spool.put('stability', 'application/json', b'{}')
+
+        work(app, spool, once=True)
+
+        stats = spool.stats()
+        assert stats['failed'] == 1
+        assert stats['depth'] == 0
+
+    def test_rate_limited_entry(self, app, session, tmpdir, mocker):
+        """Entries deferred by the GitHub rate limit are kept for later."""
+        mocker.patch('wptdash.blueprints.routes.process_spooled_request',
+                     side_effect=RateLimited(60))
+        spool = Spool(str(tmpdir))
+        spool.put('stability', 'application/json', b'{}')
+
+        work(app, spool, once=True)
+
+        stats = spool.stats()
+        assert stats['failed'] == 0
+        assert stats['depth'] == 1
+        assert spool.claim() is None
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import base64
+import json
+import threading
+import time
+
+import pytest
+from OpenSSL import crypto
+
+from wptdash import travis
+from wptdash.travis import PublicKeyCache, Travis
+
+PAYLOAD = json.dumps({'id': 1})
+
+
+def make_key():
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    return key
+
+
+def public_pem(key):
+    return crypto.dump_publickey(crypto.FILETYPE_PEM, key).decode('utf-8')
+
+
+def signature(key, payload=PAYLOAD):
+    return base64.b64encode(crypto.sign(key, payload, 'sha1'))
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(scope='module')
+def keys():
+    return make_key(), make_key()
+
+
+@pytest.fixture
+def clock(mocker):
+    clock = FakeClock()
+    mocker.patch.object(travis, 'PUBLIC_KEYS', PublicKeyCache(clock=clock))
+    return clock
+
+
+class TestGetVerifiedPayload(object):
+
+    """Test verifying Travis CI webhook signatures with a cached key."""
+
+    def test_key_cached(self, keys, clock, mocker):
+        """The key is fetched and parsed once for many payloads."""
+        get_public_key = mocker.patch.object(Travis, 'get_public_key',
+                                             return_value=public_pem(keys[0]))
+
+        for _ in range(3):
+            assert Travis().get_verified_payload(
+                PAYLOAD, signature(keys[0])
+            ) == {'id': 1}
+
+        assert get_public_key.call_count == 1
+
+    def test_ttl(self, keys, clock, mocker):
+        """The key is fetched again once the TTL has passed."""
+        get_public_key = mocker.patch.object(Travis, 'get_public_key',
+                                             return_value=public_pem(keys[0]))
+        Travis().get_verified_payload(PAYLOAD, signature(keys[0]))
+        clock.now += travis.PUBLIC_KEY_TTL
+
+        Travis().get_verified_payload(PAYLOAD, signature(keys[0]))
+
+        assert get_public_key.call_count == 2
+
+    def test_rotated_key(self, keys, clock, mocker):
+        """A failed check refetches the key and verifies again."""
+        get_public_key = mocker.patch.object(
+            Travis, 'get_public_key',
+            side_effect=[public_pem(keys[0]), public_pem(keys[1])]
+        )
+        Travis().get_verified_payload(PAYLOAD, signature(keys[0]))
+        clock.now += travis.PUBLIC_KEY_MIN_REFRESH
+
+        assert Travis().get_verified_payload(
+            PAYLOAD, signature(keys[1])
+        ) == {'id': 1}
+        assert get_public_key.call_count == 2
+
+    def test_bad_signature(self, keys, clock, mocker):
+        """Bad signatures are rejected without refetching a fresh key."""
+        get_public_key = mocker.patch.object(Travis, 'get_public_key',
+                                             return_value=public_pem(keys[0]))
+
+        for _ in range(3):
+            result = Travis().get_verified_payload(PAYLOAD,
+                                                   signature(keys[1]))
+            assert result['error']['code'] == 401
+
+        assert get_public_key.call_count == 1
+
+    def test_fetch_failed(self, clock, mocker):
+        """Errors retrieving the key are reported, not raised."""
+        mocker.patch.object(Travis, 'get_public_key',
+                            side_effect=travis.requests.ConnectionError('down'))
+
+        result = Travis().get_verified_payload(PAYLOAD, signature(make_key()))
+
+        assert result['error']['code'] == 500
+
+
+class TestPublicKeyCache(object):
+
+    """Test the process-wide public key cache."""
+
+    def test_concurrent_refresh(self, keys):
+        """Callers racing to fetch the key share one fetch."""
+        cache = PublicKeyCache()
+        fetched = []
+
+        def fetch():
+            fetched.append(1)
+            time.sleep(0.05)
+            return public_pem(keys[0])
+
+        threads = [threading.Thread(target=cache.get, args=(fetch,))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(fetched) == 1
+        assert cache.get(fetch) is not None
+        assert len(fetched) == 1
@@ -10,17 +10,28 @@
 """
 import configparser
 from datetime import datetime
-from flask import Blueprint, g, render_template, request
-from jsonschema import validate
+from flask import (Blueprint, current_app, g, jsonify, render_template,
+                   request)
+from functools import partial
 import hashlib
 import hmac
+import io
+from itertools import islice
 import json
+import math
 import re
 import shlex
+import shutil
+import tempfile
 from urllib.parse import parse_qs
 
-from wptdash.commenter import update_github_comment
-from wptdash.github import GitHub
+from wptdash import ingest, schemas
+from wptdash.commenter import (COMMENT_STATS, CommentCoalescer,
+                               update_github_comment,
+                               update_github_comment_for)
+from wptdash.github import GitHub, RateLimited, STATS as GITHUB_STATS
+from wptdash.pagecache import get_page_cache
+from wptdash.spool import DeferredPayloads, Spool, process_payload
 from wptdash.travis import Travis
 
 CONFIG = configparser.ConfigParser()
@@ -34,43 +45,178 @@ DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 RE_ENV = re.compile(r'(\w+)=(.+)')
 RE_SAUCE = re.compile(r'^sauce:')
 
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson')
+STABILITY_BATCH_SIZE = 1000
+# Bytes of a deferred payload kept in memory before it goes to a file
+DEFERRED_MEMORY_SIZE = 1024 * 1024
+
+# Seconds clients may reuse a page of a finished build without revalidating
+FINISHED_PAGE_MAX_AGE = 3600
+
 bp = Blueprint('routes', __name__)
 
 
+class BackfillDeferred(RateLimited):
+
+    """
+    The lookup of a payload's pull request was deferred by the rate limit.
+
+    ``consumed`` holds the bytes a handler already read off a streamed
+    payload before it needed the pull request.
+    """
+
+    consumed = b''
+
+
+@bp.errorhandler(RateLimited)
+def rate_limited(err):
+    # Ask the sender to redeliver once the GitHub quota has been reset.
+    g.db.session.rollback()
+    return str(err), 503, {'Retry-After': str(int(math.ceil(err.retry_after)))}
+
+
 @bp.route('/')
 def main():
     db = g.db
     models = g.models
-    pulls = db.session.query(models.PullRequest).order_by(
-        models.PullRequest.created_at.desc()
-    ).limit(100).all()
-    return render_template('index.html', pulls=pulls)
+    try:
+        page = models.get_pull_request_page(
+            db.session,
+            before=request.args.get('before'),
+            after=request.args.get('after')
+        )
+    except ValueError:
+        return 'Invalid page cursor.', 400
+    return render_template('index.html', pulls=page.pulls,
+                           latest_builds=page.latest_builds,
+                           newer=page.newer, older=page.older)
 
 
 @bp.route('/pull/<int:pull_number>')
 def pull_detail(pull_number):
     db = g.db
     models = g.models
-    pull = models.get(db.session, models.PullRequest, number=pull_number)
-    return render_template('pull.html', pull=pull, pull_number=pull_number)
+    cache = get_page_cache()
+    etag = None
+    if cache:
+        # Read before the data, as for cached pages.
+        etag = cache.etag(cache.stamp('pull', pull_number))
+        if not_modified(etag):
+            return page_response(None, etag, final=False)
+
+    pull = models.get_pull_request_detail(db.session, pull_number)
+    page = render_template('pull.html', pull=pull, pull_number=pull_number)
+    return page_response(page, etag or page_digest(page), final=False,
+                         last_modified=pull.updated_at if pull else None)
 
 
 @bp.route('/build/<int:build_number>')
 def build_detail(build_number):
+    return cached_page('build', build_number, render_build)
+
+
+def render_build(build_number):
+    """Return the build page, and whether it is final."""
     db = g.db
     models = g.models
-    build = models.get(db.session, models.Build, number=build_number)
-    return render_template('build.html', build=build, build_number=build_number,
-                           org_name=ORG, repo_name=REPO)
+    build = models.get_build_detail(db.session, build_number)
+    page = render_template('build.html', build=build,
+                           build_number=build_number, org_name=ORG,
+                           repo_name=REPO)
+    return page, bool(build and build.finished_at)
 
 
 @bp.route('/job/<string:job_number>')
 def job_detail(job_number):
+    return cached_page('job', job_number, render_job)
+
+
+def render_job(job_number):
+    """Return the job page, and whether it is final."""
     db = g.db
     models = g.models
-    job = models.get(db.session, models.Job, number=job_number)
-    return render_template('job.html', job=job, job_number=job_number,
+    job = models.get_job_detail(db.session, job_number)
+    results = []
+    unstable_results = []
+    if job and job.result_count:
+        results = models.get_job_results(db.session, job.id)
+    if job and job.inconsistent_count:
+        unstable_results = models.get_job_results(db.session, job.id,
+                                                  consistent=False)
+    page = render_template('job.html', job=job, job_number=job_number,
+                           results=results, unstable_results=unstable_results,
                            org_name=ORG, repo_name=REPO)
+    return page, bool(job and job.build.finished_at)
+
+
+def cached_page(kind, number, render):
+    """
+    Serve a build or job page from the page cache, rendering it on a miss.
+
+    Only pages of finished builds are stored; ingest invalidates them if
+    stability results arrive later. The page's version stamp is its ETag,
+    so a client holding the current page gets a 304 without the page being
+    rendered or the database being queried. Pages of running builds are
+    only noted as such, so that their 304s do not need the database
+    either. A 304 for a page that is in neither state, e.g. one that was
+    evicted, is rendered to send the right caching headers.
+    """
+    cache = get_page_cache()
+    if not cache:
+        page, final = render(number)
+        return page_response(page, page_digest(page), final)
+
+    stamp = cache.stamp(kind, number)
+    etag = cache.etag(stamp)
+    page = cache.get(kind, number, stamp)
+    if page is not None:
+        return page_response(page, etag, True)
+    if not_modified(etag) and cache.unfinished(kind, number, stamp):
+        return page_response(None, etag, False)
+
+    page, final = render(number)
+    if final:
+        cache.put(kind, number, stamp, page)
+    else:
+        cache.mark_unfinished(kind, number, stamp)
+    return page_response(page, etag, final)
+
+
+def not_modified(etag):
+    """Return whether the client already holds the page with ``etag``."""
+    return (request.method in ('GET', 'HEAD') and
+            request.if_none_match.contains_weak(etag))
+
+
+def page_digest(page):
+    return hashlib.sha1(page.encode('utf-8')).hexdigest()
+
+
+def page_response(page, etag, final, last_modified=None):
+    """
+    Return a rendered page with its validators and caching headers.
+
+    The response is a bodiless 304 if ``If-None-Match`` matches ``etag``,
+    and ``page`` may be None when it does. Clients may reuse pages of
+    finished builds for ``FINISHED_PAGE_MAX_AGE`` seconds and revalidate
+    other pages every time. ``If-Modified-Since`` is not honoured, since
+    pages change without ``last_modified`` changing.
+    """
+    if page is None or not_modified(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.response_class(page, mimetype='text/html')
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    if final:
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config.get(
+            'FINISHED_PAGE_MAX_AGE', FINISHED_PAGE_MAX_AGE
+        )
+    else:
+        response.cache_control.no_cache = True
+    return response
 
 
 @bp.route('/api/pull', methods=['POST'])
@@ -80,106 +226,29 @@ def add_pull_request():
     if not is_authorized:
         return 'Invalid Authorization Signature.', 401
 
-    db = g.db
-    models = g.models
-    schema = {
-        '$schema': 'http://json-schema.org/schema#',
-        'title': 'Pull Request Event',
-        'type': 'object',
-        'properties': {
-            'pull_request': {
-                'type': 'object',
-            },
-        },
-        'required': ['pull_request'],
-    }
-    data = request.get_json(force=True)
-    validate(data, schema)
+    spool = get_spool()
+    if spool:
+        return spool_payload(spool, 'pull', request.mimetype, request.data)
+
+    return process_pull_request(request.get_json(force=True), g.db, g.models)
+
+
+def process_pull_request(data, db, models):
+    schemas.PULL_REQUEST_EVENT.validate(data)
 
     pr = add_pr_to_session(data['pull_request'], db, models)
 
-    route_response = update_github_comment(pr)
-    db.session.commit()
-    return route_response
+    return update_comment(pr, db)
 
 
 @bp.route('/api/build', methods=['POST'])
 def add_build():
-    db = g.db
-    models = g.models
-    schema = {
-        '$schema': 'http://json-schema.org/schema#',
-        'title': 'Travis Build Event',
-        'type': 'object',
-        'definitions': {
-            'date_time': {
-                'type': 'string',
-                'format': 'date-time',
-            },
-        },
-        'properties': {
-            'id': {'type': 'integer'},
-            'number': {'type': 'string'},
-            'head_commit': {'type': 'string'},
-            'base_commit': {'type': 'string'},
-            'pull_request': {'type': 'boolean'},
-            'pull_request_number': {'oneOf': [
-                {'type': 'integer'},
-                {'type': 'null'},
-            ]},
-            'status_message': {
-                'enum': ['Pending', 'Passed', 'Fixed', 'Broken', 'Failed',
-                         'Still Failing', 'Canceled', 'Errored'],
-            },
-            'started_at': {'$ref': '#/definitions/date_time'},
-            'finished_at': {'$ref': '#/definitions/date_time'},
-            'repository': {
-                'type': 'object',
-                'properties': {
-                    'name': {'type': 'string'},
-                    'owner_name': {'type': 'string'},
-                },
-                'required': ['name', 'owner_name'],
-            },
-            'matrix': {
-                'type': 'array',
-                'items': {
-                    'type': 'object',
-                    'properties': {
-                        'id': {'type': 'integer'},
-                        'number': {'type': 'string'},
-                        'state': {
-                            'type': 'string',
-                            'enum': ['created', 'queued', 'started', 'passed',
-                                     'failed', 'errored', 'finished']
-                        },
-                        'started_at': {'oneOf': [
-                            {'$ref': '#/definitions/date_time'},
-                            {'type': 'null'},
-                        ]},
-                        'finished_at': {'oneOf': [
-                            {'$ref': '#/definitions/date_time'},
-                            {'type': 'null'},
-                        ]},
-                        'allow_failure': {'type': 'boolean'},
-                        'config': {'type': 'object'},
-                    },
-                    'required': ['id', 'number', 'state', 'started_at',
-                                 'config', 'allow_failure']
-                }
-            }
-        },
-        'required': ['id', 'number', 'head_commit', 'base_commit',
-                     'pull_request', 'pull_request_number', 'status',
-                     'repository'],
-    }
-
     travis = Travis()
 
     # The payload comes in the request, but we need to make sure it is
     # really signed by Travis CI. If not, respond to this request with
     # an error.
-    resp = validate(json.loads(request.form['payload']), schema)
+    schemas.TRAVIS_BUILD_EVENT.validate(json.loads(request.form['payload']))
 
     verified_payload = travis.get_verified_payload(
         request.form['payload'], request.headers['SIGNATURE']
@@ -195,30 +264,47 @@ def add_build():
     if owner_name != ORG or repo_name != REPO:
         return "Forbidden: Repository Mismatch. Build for %s/%s attempting to comment on %s/%s" % (owner_name, repo_name, ORG, REPO), 403
 
+    payload = request.form['payload'].encode('utf-8')
+    spool = get_spool()
+    if spool:
+        return spool_payload(spool, 'build', 'application/json', payload)
+
+    try:
+        return process_build(verified_payload, g.db, g.models)
+    except BackfillDeferred as err:
+        return defer_payload('build', 'application/json',
+                             io.BytesIO(payload), err)
+
+
+def process_build(verified_payload, db, models):
     pr_number = verified_payload['pull_request_number']
 
-    pr = models.get(
-        db.session, models.PullRequest,
-        number=pr_number,
-    )
+    identity_map = models.IdentityMap(db.session)
+    identity_map.preload(models.Commit, sha=[
+        verified_payload['head_commit'], verified_payload['base_commit'],
+    ])
+    identity_map.preload(models.Job, id=[
+        job_data['id'] for job_data in verified_payload['matrix']
+    ])
+    identity_map.preload(models.Product, name=[
+        job_product_name(job_data) for job_data in verified_payload['matrix']
+    ])
+
+    pr = identity_map.get(models.PullRequest, number=pr_number)
 
     if not pr:
-        github = GitHub()
-        pr_data = github.get_pr(pr_number)
-        pr = add_pr_to_session(pr_data, db, models)
+        pr = fetch_pr(pr_number, db, models, identity_map)
 
-    head_commit, _ = models.get_or_create(
-        db.session, models.Commit,
-        sha=verified_payload['head_commit']
+    head_commit, _ = identity_map.get_or_create(
+        models.Commit, sha=verified_payload['head_commit']
     )
 
-    base_commit, _ = models.get_or_create(
-        db.session, models.Commit,
-        sha=verified_payload['base_commit']
+    base_commit, _ = identity_map.get_or_create(
+        models.Commit, sha=verified_payload['base_commit']
     )
 
-    build, _ = models.get_or_create(
-        db.session, models.Build, id=verified_payload['id']
+    build, _ = identity_map.get_or_create(
+        models.Build, id=verified_payload['id']
     )
     build.number = int(verified_payload['number'])
     build.pull_request = pr
@@ -238,43 +324,21 @@ def add_build():
         )
 
     for job_data in verified_payload['matrix']:
-        add_job_to_session(job_data, build, db, models)
+        add_job_to_session(job_data, build, db, models, identity_map)
 
-    route_response = update_github_comment(pr)
-    db.session.commit()
-    return route_response
+    return update_comment(pr, db)
 
 
 @bp.route('/api/test-mirror', methods=['POST', 'DELETE'])
 def update_test_mirror():
     db = g.db
     models = g.models
-    schema = None
 
+    data = request.get_json(force=True)
     if request.method == 'DELETE':
-        schema = {
-            '$schema': 'http://json-schema.org/schema#',
-            'title': 'PR Mirrored Event',
-            'type': 'object',
-            'properties': {
-                'issue_number': {'type': 'integer'},
-            },
-            'required': ['issue_number', 'url'],
-        }
+        schemas.TEST_MIRROR_DELETE_EVENT.validate(data)
     else:
-        schema = {
-            '$schema': 'http://json-schema.org/schema#',
-            'title': 'PR Mirrored Event',
-            'type': 'object',
-            'properties': {
-                'issue_number': {'type': 'integer'},
-                'url': {'type': 'string'}
-            },
-            'required': ['issue_number', 'url'],
-        }
-
-    data = request.get_json(force=True)
-    validate(data, schema)
+        schemas.TEST_MIRROR_EVENT.validate(data)
 
     pr = models.get(
         db.session, models.PullRequest, number=data['issue_number']
@@ -286,142 +350,119 @@ def update_test_mirror():
     pr.mirror = pr.mirror or models.TestMirror()
     pr.mirror.url = data['url'] if request.method == 'POST' else None
 
-    route_response = update_github_comment(pr)
-    db.session.commit()
-    return route_response
+    return update_comment(pr, db)
 
 
 @bp.route('/api/stability', methods=['POST'])
 def add_stability_check():
-    db = g.db
-    models = g.models
-    schema = {
-        'type': 'object',
-        'properties': {
-            'pull': {
-                'type': 'object',
-                'properties': {
-                    'number': {'type': 'integer'},
-                    'sha': {'type': 'string'},
-                },
-                'required': ['number', 'sha'],
-            },
-            'job': {
-                'type': 'object',
-                'properties': {
-                    'id': {'type': 'integer'},
-                    'number': {'type': 'string'},
-                    'allow_failure': {'type': 'boolean'},
-                    'status': {
-                        'type': 'string',
-                        'enum': ['created', 'queued', 'started', 'passed',
-                                 'failed', 'errored', 'finished']
-                    },
-                },
-                'required': [
-                    'id', 'number', 'allow_failure', 'status',
-                ],
-            },
-            'build': {
-                'type': 'object',
-                'properties': {
-                    'id': {'type': 'integer'},
-                    'number': {'type': 'string'},
-                },
-                'required': [
-                    'id', 'number',
-                ],
-            },
-            'product': {
-                'type': 'string',
-                'maxLength': 255,
-            },
-            'iterations': {
-                'type': 'integer'
-            },
-            'message': {
-                'type': 'string'
-            },
-            'results': {
-                'type': 'array',
-                'items': {
-                    'type': 'object',
-                    'properties': {
-                        'result': {
-                            'type': 'object',
-                            'properties': {
-                                'status': {
-                                    'type': 'object',
-                                    'patternProperties': {
-                                        '^(?:pass|fail|ok|timeout|error|notrun|crash)$': {
-                                            'type': 'integer'
-                                        },
-                                    },
-                                },
-                                'subtests': {
-                                    'type': 'array',
-                                    'items': {
-                                        'type': 'object',
-                                        'properties': {
-                                            'result': {
-                                                'type': 'object',
-                                                'properties': {
-                                                    'status': {
-                                                        'type': 'object',
-                                                        'patternProperties': {
-                                                            '^(?:pass|fail|ok|timeout|error|notrun|crash)$': {
-                                                                'type': 'integer'
-                                                            },
-                                                        },
-                                                    },
-                                                    'messages': {
-                                                        'type': 'array',
-                                                        'items': {
-                                                            'type': 'string'
-                                                        },
-                                                    },
-                                                },
-                                                'required': ['status', 'messages'],
-                                            },
-                                            'test': {
-                                                'type': 'string',
-                                            },
-                                        },
-                                        'required': ['result', 'test'],
-                                    },
-                                },
-                            },
-                            'required': ['status'],
-                        },
-                        'test': {
-                            'type': 'string',
-                        },
-                    },
-                    'required': ['test', 'result'],
-                },
-            },
-        },
-        'required': ['pull', 'job', 'build', 'product', 'iterations',
-                     'results']
-    }
-
-    data = request.get_json(force=True)
-    validate(data, schema)
-
+    spool = get_spool()
+    if spool:
+        return spool_payload(spool, 'stability', request.mimetype,
+                             request.stream)
+
+    try:
+        if request.mimetype in NDJSON_MIMETYPES:
+            return process_stability_ndjson(request.stream, g.db, g.models)
+        return process_stability(request.get_json(force=True), g.db,
+                                 g.models, payload_digest(request.get_data()))
+    except BackfillDeferred as err:
+        # A JSON body is cached by get_json(); a stream is read on from
+        # where the handler stopped.
+        body = (request.stream if request.mimetype in NDJSON_MIMETYPES
+                else io.BytesIO(request.get_data()))
+        return defer_payload('stability', request.mimetype, body, err)
+
+
+def process_stability(data, db, models, digest=None):
+    schemas.STABILITY_CHECK.validate(data)
+
+    # Runners retry on timeouts; a byte-identical resubmission for a job
+    # has nothing new to write or comment on, unless posting the comment
+    # failed, which leaves the pull request's comment digest cleared.
+    stored = db.session.query(
+        models.Job.payload_digest, models.PullRequest.comment_digest
+    ).join(models.Job.build).join(models.Build.pull_request).filter(
+        models.Job.id == data['job']['id']
+    ).first()
+    if digest and stored and digest == stored.payload_digest and \
+            stored.comment_digest:
+        return 'OK', 200
+
+    schemas.validate_stability_results(data['results'])
+
+    pr, job = add_stability_job_to_session(data, db, models)
+    job.payload_digest = digest
+
+    # Results are written with bulk upserts, which need the job row.
+    db.session.flush()
+    counts = ingest.add_stability_results(db.session, job.id,
+                                          data['iterations'],
+                                          data.get('results', []))
+    ingest.update_counters(db.session, job.id, counts)
+
+    return update_comment(pr, db)
+
+
+def process_stability_ndjson(stream, db, models):
+    # One header line followed by one result per line. Lines are read
+    # straight off the stream and written in fixed-size batches, so memory
+    # use does not grow with the number of results.
+    digest = hashlib.sha256()
+
+    def hashed(stream):
+        for line in stream:
+            digest.update(line)
+            yield line
+
+    lines = (line for line in hashed(stream) if line.strip())
+    header_line = next(lines, b'null')
+    header = json.loads(header_line.decode('utf-8'))
+    schemas.STABILITY_HEADER.validate(header)
+
+    try:
+        pr, job = add_stability_job_to_session(header, db, models)
+    except BackfillDeferred as err:
+        # Nothing past the header has been read yet.
+        err.consumed = header_line
+        raise
+    previous_digest = job.payload_digest
+    db.session.flush()
+
+    # The counters are updated once at the end, so the build row is only
+    # locked for the rest of the transaction, not the whole stream.
+    counts = []
+    while True:
+        results = [json.loads(line.decode('utf-8'))
+                   for line in islice(lines, STABILITY_BATCH_SIZE)]
+        if not results:
+            break
+        schemas.validate_stability_results(results)
+        counts.append(ingest.add_stability_results(
+            db.session, job.id, header['iterations'], results
+        ))
+    ingest.update_counters(db.session, job.id, ingest.sum_counts(counts))
+
+    # The digest is only known once the stream is consumed, so a streamed
+    # resubmission is still written, but does not update the comment
+    # unless the last attempt to post it failed.
+    job.payload_digest = digest.hexdigest()
+    if job.payload_digest == previous_digest and pr.comment_digest:
+        db.session.commit()
+        return 'OK', 200
+    return update_comment(pr, db)
+
+
+def add_stability_job_to_session(data, db, models):
     pr_number = data['pull']['number']
 
-    pr = models.get(
-        db.session, models.PullRequest,
-        number=pr_number,
-    )
+    identity_map = models.IdentityMap(db.session)
+    pr = identity_map.get(models.PullRequest, number=pr_number)
 
     if not pr:
-        github = GitHub()
-        pr_data = github.get_pr(pr_number)
-        pr = add_pr_to_session(pr_data, db, models)
+        pr = fetch_pr(pr_number, db, models, identity_map)
 
-    build, _ = models.get_or_create(
-        db.session, models.Build, id=data['build']['id']
+    build, _ = identity_map.get_or_create(
+        models.Build, id=data['build']['id']
     )
     build.number = int(data['build']['number'])
     build.pull_request = pr
@@ -429,13 +470,11 @@ def add_stability_check():
     build.status = build.status or models.BuildStatus.from_string('pending')
 
     product_name = normalize_product_name(data['product'])
-    product, _ = models.get_or_create(
-        db.session, models.Product, name=product_name
+    product, _ = identity_map.get_or_create(
+        models.Product, name=product_name
     )
 
-    job, _ = models.get_or_create(
-        db.session, models.Job, id=data['job']['id']
-    )
+    job, _ = identity_map.get_or_create(models.Job, id=data['job']['id'])
     job.number = data['job']['number']
     job.allow_failure = data['job']['allow_failure']
     job.build = build
@@ -443,70 +482,125 @@ def add_stability_check():
     job.message = data.get('message', None)
     job.state = models.JobStatus.from_string(data['job']['status'])
 
-    for test_data in data.get('results', []):
-        test, _ = models.get_or_create(
-            db.session,
-            models.Test,
-            id=test_data['test']
-        )
+    return pr, job
 
-        test_result, _ = models.get_or_create(
-            db.session,
-            models.JobResult,
-            test_id=test.id,
-            job_id=job.id,
-        )
-        test_result.iterations = data['iterations']
-        test_result.consistent = True
-
-        for status_name, count in test_data['result']['status'].items():
-            status, _ = models.get_or_create(
-                db.session,
-                models.StabilityStatus,
-                job_id=job.id,
-                test_id=test.id,
-                status=models.TestStatus.from_string(status_name)
-            )
-            status.count = count
-            if (count < data['iterations']):
-                test_result.consistent = False
-
-        for subtest_data in test_data['result'].get('subtests', []):
-            subtest, _ = models.get_or_create(
-                db.session,
-                models.Test,
-                id=subtest_data['test']
-            )
-            subtest.parent = test
-
-            subtest_result, _ = models.get_or_create(
-                db.session,
-                models.JobResult,
-                test_id=subtest.id,
-                job_id=job.id,
-            )
-            subtest_result.iterations = data['iterations']
-            subtest_result.messages = json.dumps(subtest_data['result']['messages'])
-            subtest_result.consistent = True
-
-            for subtest_status_name, count in subtest_data['result']['status'].items():
-                subtest_status, _ = models.get_or_create(
-                    db.session,
-                    models.StabilityStatus,
-                    job_id=job.id,
-                    test_id=subtest.id,
-                    status=models.TestStatus.from_string(subtest_status_name)
-                )
-                subtest_status.count = count
-                if (count < data['iterations']):
-                    subtest_result.consistent = False
-                    test_result.consistent = False
-
-    route_response = update_github_comment(pr)
+
+@bp.route('/api/stats')
+def stats():
+    spool = get_spool()
+    comments = COMMENT_STATS.stats()
+    coalescer = get_comment_coalescer()
+    if coalescer:
+        comments.update(coalescer.stats())
+    page_cache = get_page_cache()
+    deferred = current_app.extensions.get('deferred_payloads')
+    return jsonify(spool=spool.stats() if spool else None, comments=comments,
+                   github=GITHUB_STATS.stats(),
+                   pages=page_cache.stats() if page_cache else None,
+                   deferred=deferred.stats() if deferred else None)
+
+
+def update_comment(pr, db):
+    """
+    Commit the request's changes, then update the PR's GitHub comment.
+
+    With ``COMMENT_COALESCE_WINDOW`` or ``COMMENT_WORKERS`` set, the update
+    is queued for a background thread instead, and merged with other
+    updates to the same pull request.
+    """
     db.session.commit()
+
+    coalescer = get_comment_coalescer()
+    if coalescer:
+        coalescer.schedule(pr.number)
+        return 'Comment update queued', 202
+
+    try:
+        route_response = update_github_comment(pr)
+    finally:
+        # Also keeps the comment digest cleared when posting failed.
+        db.session.commit()
     return route_response
 
 
+def get_comment_coalescer():
+    window = current_app.config.get('COMMENT_COALESCE_WINDOW', 0)
+    workers = current_app.config.get('COMMENT_WORKERS', 0)
+    if not window and not workers:
+        return None
+    coalescer = current_app.extensions.get('comment_coalescer')
+    if coalescer is None:
+        app = current_app._get_current_object()
+        coalescer = current_app.extensions.setdefault(
+            'comment_coalescer',
+            CommentCoalescer(window, partial(update_github_comment_for, app),
+                             workers=workers or 1)
+        )
+    return coalescer
+
+
+def get_spool():
+    spool_dir = current_app.config.get('WEBHOOK_SPOOL_DIR')
+    return Spool(spool_dir) if spool_dir else None
+
+
+def spool_payload(spool, kind, content_type, body):
+    name = spool.put(kind, content_type, body)
+    return jsonify(spooled=name), 202
+
+
+def get_deferred_payloads():
+    queue = current_app.extensions.get('deferred_payloads')
+    if queue is None:
+        app = current_app._get_current_object()
+        queue = current_app.extensions.setdefault(
+            'deferred_payloads',
+            DeferredPayloads(partial(process_payload, app))
+        )
+    return queue
+
+
+def defer_payload(kind, content_type, body, err):
+    """
+    Keep a payload whose pull request lookup was deferred until the reset.
+
+    Only used without a spool. The payload, ``err.consumed`` followed by
+    the rest of ``body``, is copied aside and processed again by a
+    background thread once the quota resets. Answers with 503 and
+    ``Retry-After`` if too many payloads are already waiting.
+    """
+    g.db.session.rollback()
+    payload = tempfile.SpooledTemporaryFile(max_size=DEFERRED_MEMORY_SIZE)
+    payload.write(err.consumed)
+    shutil.copyfileobj(body, payload)
+    if not get_deferred_payloads().defer(kind, content_type, payload,
+                                         err.retry_after):
+        payload.close()
+        return rate_limited(err)
+    return jsonify(deferred=True,
+                   retry_after=int(math.ceil(err.retry_after))), 202
+
+
+def process_spooled_request(kind, content_type, body, db, models):
+    """Run the handler for a payload that was spooled by a route."""
+    if kind == 'stability' and content_type in NDJSON_MIMETYPES:
+        return process_stability_ndjson(body, db, models)
+
+    raw_data = body.read()
+    data = json.loads(raw_data.decode('utf-8'))
+    if kind == 'pull':
+        return process_pull_request(data, db, models)
+    if kind == 'build':
+        return process_build(data, db, models)
+    if kind == 'stability':
+        return process_stability(data, db, models, payload_digest(raw_data))
+    raise ValueError('Unknown spooled payload kind: %s' % kind)
+
+
+def payload_digest(payload):
+    return hashlib.sha256(payload).hexdigest()
+
+
 def normalize_product_name(product_name):
     return RE_SAUCE.sub('', product_name) if product_name else None
 
@@ -522,7 +616,7 @@ def dictify_env_list(env_list):
     return env_dict
 
 
-def add_job_to_session(job_data, build, db, models):
+def job_product_name(job_data):
     env_dict = dictify_env_list(job_data['config'].get('env', []))
 
     product_name = normalize_product_name(env_dict.get('PRODUCT'))
@@ -534,12 +628,16 @@ def add_job_to_session(job_data, build, db, models):
         if python_version:
             product_name += ' in %s' % python_version
 
-    product, _ = models.get_or_create(
-        db.session, models.Product, name=product_name
-    )
-    job, _ = models.get_or_create(
-        db.session, models.Job, id=job_data['id']
+    return product_name
+
+
+def add_job_to_session(job_data, build, db, models, identity_map=None):
+    identity_map = identity_map or models.IdentityMap(db.session)
+
+    product, _ = identity_map.get_or_create(
+        models.Product, name=job_product_name(job_data)
     )
+    job, _ = identity_map.get_or_create(models.Job, id=job_data['id'])
     job.number = job_data['number']
     job.build = build
     job.product = product
@@ -560,148 +658,95 @@ def add_job_to_session(job_data, build, db, models):
         )
 
 
-def add_pr_to_session(pr_data, db, models):
+def fetch_pr(pr_number, db, models, identity_map=None):
+    """Look up a pull request the dashboard has not seen on GitHub."""
+    try:
+        pr_data = GitHub().get_pr(pr_number)
+    except RateLimited as err:
+        raise BackfillDeferred(err.retry_after)
+    return add_pr_to_session(pr_data, db, models, identity_map)
+
+
+def add_pr_to_session(pr_data, db, models, identity_map=None):
     db = g.db
     models = g.models
-    schema = {
-        '$schema': 'http://json-schema.org/schema#',
-        'title': 'Pull Request',
-        'definitions': {
-            'commit_object': {
-                'type': 'object',
-                'properties': {
-                    'ref': {'type': 'string'},
-                    'sha': {'type': 'string'},
-                    'user': {'$ref': '#/definitions/github_user'},
-                    'repo': {
-                        'type': 'object',
-                        'properties': {
-                            'id': {'type': 'integer'},
-                            'name': {'type': 'string'},
-                            'owner': {'$ref': '#/definitions/github_user'},
-                        },
-                        'required': ['id', 'owner'],
-                    },
-                },
-                'required': ['sha', 'ref', 'user', 'repo']
-            },
-            'date_time': {
-                'type': 'string',
-                'format': 'date-time',
-            },
-            'github_user': {
-                'type': 'object',
-                'properties': {
-                    'login': {'type': 'string'},
-                    'id': {'type': 'integer'},
-                },
-                'required': ['login', 'id'],
-            },
-        },
-        'type': 'object',
-        'properties': {
-            'id': {'type': 'integer'},
-            'number': {'type': 'integer'},
-            'title': {'type': 'string'},
-            'user': {'$ref': '#/definitions/github_user'},
-            'merged': {'type': 'boolean'},
-            'state': {
-                'enum': ['open', 'closed'],
-            },
-            'head': {'$ref': '#/definitions/commit_object'},
-            'base': {'$ref': '#/definitions/commit_object'},
-            'merged_by': {'oneOf': [
-                {'$ref': '#definitions/github_user'},
-                {'type': 'null'},
-            ]},
-            'created_at': {'$ref': '#/definitions/date_time'},
-            'updated_at': {'$ref': '#/definitions/date_time'},
-            'closed_at': {'oneOf': [
-                {'$ref': '#/definitions/date_time'},
-                {'type': 'null'},
-            ]},
-            'merged_at': {'oneOf': [
-                {'$ref': '#/definitions/date_time'},
-                {'type': 'null'},
-            ]},
-        },
-        'required': [
-            'id', 'number', 'title', 'user', 'merged', 'state', 'head',
-            'base', 'created_at', 'updated_at'
-        ],
-    }
-
-    validate(pr_data, schema)
+
+    schemas.PULL_REQUEST.validate(pr_data)
 
     pr_head = pr_data['head']
     pr_base = pr_data['base']
     merger = None
 
-    creator, _ = models.get_or_create(
-        db.session, models.GitHubUser, id=pr_data['user']['id']
+    identity_map = identity_map or models.IdentityMap(db.session)
+    identity_map.preload(models.GitHubUser, id=[
+        pr_data['user']['id'],
+        (pr_data['merged_by'] or {}).get('id'),
+        pr_head['user']['id'],
+        pr_base['user']['id'],
+        pr_head['repo']['owner']['id'],
+        pr_base['repo']['owner']['id'],
+    ])
+    identity_map.preload(models.Commit, sha=[pr_head['sha'], pr_base['sha']])
+    identity_map.preload(models.Repository, id=[
+        pr_head['repo']['id'], pr_base['repo']['id'],
+    ])
+
+    creator, _ = identity_map.get_or_create(
+        models.GitHubUser, id=pr_data['user']['id']
     )
     creator.login = pr_data['user']['login']
 
     if pr_data['merged_by']:
-        merger, _ = models.get_or_create(
-            db.session, models.GitHubUser,
-            id=pr_data['merged_by']['id']
+        merger, _ = identity_map.get_or_create(
+            models.GitHubUser, id=pr_data['merged_by']['id']
         )
         merger.login = pr_data['merged_by']['login']
 
-    head_commit_user, _ = models.get_or_create(
-        db.session, models.GitHubUser,
-        id=pr_head['user']['id']
+    head_commit_user, _ = identity_map.get_or_create(
+        models.GitHubUser, id=pr_head['user']['id']
     )
     head_commit_user.login = pr_head['user']['login']
 
-    head_commit, _ = models.get_or_create(
-        db.session, models.Commit,
-        sha=pr_head['sha']
+    head_commit, _ = identity_map.get_or_create(
+        models.Commit, sha=pr_head['sha']
     )
     head_commit.user = head_commit_user
 
-    base_commit_user, _ = models.get_or_create(
-        db.session, models.GitHubUser,
-        id=pr_base['user']['id']
+    base_commit_user, _ = identity_map.get_or_create(
+        models.GitHubUser, id=pr_base['user']['id']
     )
     base_commit_user.login = pr_base['user']['login']
 
-    base_commit, _ = models.get_or_create(
-        db.session, models.Commit,
-        sha=pr_base['sha']
+    base_commit, _ = identity_map.get_or_create(
+        models.Commit, sha=pr_base['sha']
     )
     base_commit.user = base_commit_user
 
     # Query by ID and update in case name or owner have changed
-    head_repo_owner, _ = models.get_or_create(
-        db.session, models.GitHubUser,
-        id=pr_head['repo']['owner']['id']
+    head_repo_owner, _ = identity_map.get_or_create(
+        models.GitHubUser, id=pr_head['repo']['owner']['id']
     )
     head_repo_owner.login = pr_head['repo']['owner']['login']
 
-    head_repo, _ = models.get_or_create(
-        db.session, models.Repository,
-        id=pr_head['repo']['id']
+    head_repo, _ = identity_map.get_or_create(
+        models.Repository, id=pr_head['repo']['id']
     )
     head_repo.name = pr_head['repo']['name']
     head_repo.owner = head_repo_owner
 
-    base_repo_owner, _ = models.get_or_create(
-        db.session, models.GitHubUser,
-        id=pr_base['repo']['owner']['id']
+    base_repo_owner, _ = identity_map.get_or_create(
+        models.GitHubUser, id=pr_base['repo']['owner']['id']
     )
     base_repo_owner.login = pr_base['repo']['owner']['login']
 
-    base_repo, _ = models.get_or_create(
-        db.session, models.Repository,
-        id=pr_base['repo']['id']
+    base_repo, _ = identity_map.get_or_create(
+        models.Repository, id=pr_base['repo']['id']
     )
     base_repo.name = pr_base['repo']['name']
     base_repo.owner = base_repo_owner
 
-    pr, _ = models.get_or_create(
-        db.session, models.PullRequest, id=pr_data['id']
+    pr, _ = identity_map.get_or_create(
+        models.PullRequest, id=pr_data['id']
     )
 
     pr.number = pr_data['number']
@@ -1,13 +1,23 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import configparser
+import hashlib
+import heapq
+import itertools
+import json
 import logging
 import requests
-from operator import attrgetter
-from flask import render_template
+import threading
+import time
+from flask import current_app
+from sqlalchemy.orm import object_session
 
-from wptdash.github import GitHub
+from wptdash.github import GitHub, RateLimited
+from wptdash.stats import Counters
+import wptdash.models as models
 
 CONFIG = configparser.ConfigParser()
 CONFIG.readfp(open(r'config.txt'))
@@ -15,40 +25,396 @@ APP_DOMAIN = CONFIG.get('app', 'APP_DOMAIN')
 ORG_NAME = CONFIG.get('GitHub', 'ORG')
 REPO_NAME = CONFIG.get('GitHub', 'REPO')
 
+# Unstable result rows read from the database at a time for a comment
+COMMENT_RESULTS_BATCH = 500
+
+# Retries of a failed background comment update, and the delay before the
+# first; it doubles for each further retry.
+COMMENT_RETRIES = 3
+COMMENT_RETRY_BACKOFF = 2.0
+
+
+class CommentError(Exception):
+
+    """Posting a pull request's comment to GitHub failed."""
+
+
+# Comment updates posted to GitHub, skipped as unchanged, and cut short
+COMMENT_STATS = Counters('sent', 'skipped', 'truncated')
+
+# Plain data the comment templates render from
+CommentData = namedtuple('CommentData',
+                         ['build', 'failing_jobs', 'unstable_jobs'])
+CommentBuild = namedtuple('CommentBuild', ['id', 'number', 'status',
+                                           'started_at', 'finished_at',
+                                           'inconsistent_count'])
+CommentJob = namedtuple('CommentJob', ['id', 'number', 'product',
+                                       'allow_failure', 'results'])
+CommentResult = namedtuple('CommentResult', ['path', 'statuses', 'messages'])
+
+
+def get_comment_data(session, pr):
+    """
+    Fetch what the comment for a pull request's latest build shows.
+
+    Uses one query for the build, one for its jobs and one for the
+    inconsistent results of all its jobs, so the cost does not depend on
+    how many consistent results the build has. The inconsistent results
+    are read lazily, ``COMMENT_RESULTS_BATCH`` rows at a time, as the
+    comment is rendered, so rows past GitHub's length limit are not read.
+
+    Arguments:
+    session -- The database session
+    pr -- The ``PullRequest`` to comment on
+
+    Returns ``CommentData``, or None if the pull request has no builds.
+    Its ``unstable_jobs`` is an iterator, and the ``results`` of each job
+    have to be consumed before the next job is taken.
+    """
+    # Builds first seen through stability results have no start time until
+    # Travis CI reports them, and are newer than every started build.
+    build = session.query(
+        models.Build.id, models.Build.number, models.Build.status,
+        models.Build.started_at, models.Build.finished_at,
+        models.Build.inconsistent_count
+    ).filter(models.Build.pull_request_id == pr.id).order_by(
+        models.Build.started_at.desc().nullsfirst(), models.Build.id.desc()
+    ).first()
+    if build is None:
+        return None
+    build = CommentBuild(*build)
+
+    jobs = session.query(
+        models.Job.id, models.Job.number, models.Job.state,
+        models.Job.allow_failure, models.Job.inconsistent_count,
+        models.Product.name
+    ).join(models.Job.product).filter(
+        models.Job.build_id == build.id
+    ).order_by(models.Job.id).all()
+    failing_jobs = [job.name for job in jobs
+                    if job.state == models.JobStatus.FAILED]
+
+    return CommentData(build, failing_jobs, _unstable_jobs(session, jobs))
+
+
+def _unstable_jobs(session, jobs):
+    """Yield a ``CommentJob`` for each of ``jobs`` with unstable results."""
+    jobs = {job.id: job for job in jobs if job.inconsistent_count}
+    if not jobs:
+        return
+    results = session.query(
+        models.JobResult.job_id, models.JobResult.test_id,
+        models.JobResult.status_counts, models.JobResult.messages,
+        models.Test.path, models.Test.parent_id
+    ).join(models.JobResult.test).filter(
+        models.JobResult.job_id.in_(list(jobs)),
+        ~models.JobResult.consistent
+    ).order_by(
+        models.JobResult.job_id, models.Test.tree_path
+    ).yield_per(COMMENT_RESULTS_BATCH)
+
+    for job_id, groups in itertools.groupby(_result_groups(results),
+                                            key=lambda item: item[0]):
+        job = jobs[job_id]
+        yield CommentJob(job.id, job.number, job.name, job.allow_failure,
+                         (group for _, group in groups))
+
+
+def _result_groups(rows):
+    """
+    Yield ``(job_id, ResultGroup)`` pairs from ordered result ``rows``.
+
+    As in ``models.get_job_results``, subtest results follow their
+    parent's, and those whose parent is consistent are dropped. A group is
+    yielded once the row after its last subtest has been read.
+    """
+    current = None
+    for row in rows:
+        result = CommentResult(
+            row.path, models.histogram_statuses(row.status_counts),
+            json.loads(row.messages) if row.messages else []
+        )
+        if row.parent_id is None:
+            if current is not None:
+                yield current[0], current[2]
+            current = (row.job_id, row.test_id,
+                       models.ResultGroup(result, []))
+        elif current is not None and current[:2] == (row.job_id,
+                                                     row.parent_id):
+            current[2].subresults.append(result)
+    if current is not None:
+        yield current[0], current[2]
+
+
+def _unstable_chunks(macros, jobs):
+    """
+    Yield ``(chunk, closing)`` pairs for the unstable results section.
+
+    ``closing`` is the markup that has to follow if the comment is cut off
+    after ``chunk``.
+    """
+    footer = str(macros.job_footer())
+    for job in jobs:
+        yield str(macros.job_header(job)), footer
+        for result, subresults in job.results:
+            yield str(macros.result_row(result)), footer
+            for subresult in subresults:
+                yield str(macros.result_row(subresult, True)), footer
+        yield footer, ''
+
+
+def render_comment(data, max_length):
+    """
+    Render the comment for ``data`` in fewer than ``max_length`` characters.
+
+    The pieces of ``comment.md`` are rendered one at a time against a
+    running budget. Once the next unstable result row would not fit, the
+    open table is closed and a truncation notice with links to the full
+    results is appended instead, so an oversized comment is rendered once
+    and never held in full.
+
+    Arguments:
+    data -- The ``CommentData`` to render
+    max_length -- The maximum comment length GitHub accepts
+
+    Returns a tuple of the comment and whether it was truncated
+    """
+    template = current_app.jinja_env.get_template('comment.md')
+    macros = template.make_module(dict(build=data.build,
+                                       app_domain=APP_DOMAIN,
+                                       org_name=ORG_NAME, repo_name=REPO_NAME,
+                                       characters=max_length))
+    parts = [str(macros.header(data.failing_jobs))]
+    if not data.build.inconsistent_count:
+        parts.append(str(macros.build_links()))
+        return ''.join(parts), False
+
+    parts.append(str(macros.unstable_heading()))
+    notice = str(macros.truncated())
+    budget = max_length - 1 - len(notice)
+    used = sum(len(part) for part in parts)
+    closing = ''
+    chunks = _unstable_chunks(macros, data.unstable_jobs)
+    try:
+        for chunk, next_closing in chunks:
+            if used + len(chunk) + len(next_closing) > budget:
+                parts.extend([closing, notice])
+                return ''.join(parts), True
+            parts.append(chunk)
+            used += len(chunk)
+            closing = next_closing
+    finally:
+        # Stop reading results once the budget is used up.
+        chunks.close()
+        if hasattr(data.unstable_jobs, 'close'):
+            data.unstable_jobs.close()
+    return ''.join(parts), False
+
 
 # TODO: make this return some useful JSON
 def update_github_comment(pr):
     resp = None
-    if pr.builds:
+    data = get_comment_data(object_session(pr), pr)
+    if data:
         github = GitHub()
-        build = sorted(pr.builds, key=attrgetter('started_at'), reverse=True)[0]
-        has_unstable = False
-        failing_jobs = []
-        for job in build.jobs:
-            if job.state.name == 'FAILED':
-                failing_jobs.append(job.product.name)
-            if not has_unstable:
-                for test in job.tests:
-                    if not test.consistent:
-                        has_unstable = True
-                        break
-
-        comment = render_template('comment.md', build=build,
-                                  app_domain=APP_DOMAIN, org_name=ORG_NAME,
-                                  repo_name=REPO_NAME,
-                                  has_unstable=has_unstable,
-                                  failing_jobs=failing_jobs)
-        if not github.validate_comment_length(comment):
-            comment = render_template('comment-short.md', build=build,
-                                      app_domain=APP_DOMAIN, org_name=ORG_NAME,
-                                      characters=github.max_comment_length,
-                                      repo_name=REPO_NAME,
-                                      has_unstable=has_unstable,
-                                      failing_jobs=failing_jobs)
+        comment, truncated = render_comment(data, github.max_comment_length)
+        if truncated:
+            COMMENT_STATS.count('truncated')
+        digest = hashlib.sha256(comment.encode('utf-8')).hexdigest()
+        if pr.comment_url and pr.comment_digest == digest:
+            COMMENT_STATS.count('skipped')
+            return 'OK', 200
+
+        # Cleared until the new comment is known to be posted, so that
+        # resubmitted stability results are not skipped after a failure.
+        pr.comment_digest = None
         try:
             resp = github.post_comment(pr.number, comment, pr.comment_url)
             pr.comment_url = resp.json().get('url')
+            pr.comment_digest = digest
+        except RateLimited:
+            # Deferred rather than failed; callers retry after the reset.
+            raise
         except requests.RequestException as err:
-            logging.error(err.response.text)
-            return err.response.text, 500
+            # Timeouts and connection errors have no response.
+            message = (err.response.text if err.response is not None
+                       else str(err))
+            logging.error(message)
+            return message, 500
+        COMMENT_STATS.count('sent')
     return 'OK', 200
+
+
+def update_github_comment_for(app, pr_number):
+    """Update the comment of pull request ``pr_number`` in a fresh session."""
+    from wptdash.database import db
+
+    with app.app_context():
+        try:
+            pr = models.get(db.session, models.PullRequest, number=pr_number)
+            if pr:
+                try:
+                    message, status = update_github_comment(pr)
+                finally:
+                    # Also keeps the comment digest cleared when posting
+                    # failed.
+                    db.session.commit()
+                if status != 200:
+                    raise CommentError(message)
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+
+class CommentCoalescer(object):
+
+    """
+    Post comment updates from a pool of background threads.
+
+    A build posts one ``/api/build`` event and one ``/api/stability`` event
+    per matrix job within seconds of each other. ``schedule`` queues an
+    update of a pull request's comment ``window`` seconds after the first
+    request; requests for the same pull request until then are absorbed. A
+    dispatcher thread hands due updates, in order, to at most ``workers``
+    threads.
+
+    Callers commit before scheduling, so an update that starts after a
+    request sees its changes. Updates of one pull request never run
+    concurrently: a request arriving while its update is running queues one
+    more, so the last state is always posted last. Failed updates are
+    retried with exponential backoff, and updates deferred by the GitHub
+    rate limit are queued again for after the reset.
+    """
+
+    def __init__(self, window, update, workers=1, retries=COMMENT_RETRIES,
+                 backoff=COMMENT_RETRY_BACKOFF):
+        """
+        Create a coalescer.
+
+        Arguments:
+        window -- Seconds to wait for further updates to a pull request
+        update -- Callable taking a pull request number to update
+        workers -- Number of updates to run at once
+        retries -- Times to retry an update that raises
+        backoff -- Seconds before the first retry, doubling for each next
+        """
+        self.window = window
+        self.update = update
+        self.retries = retries
+        self.backoff = backoff
+        self.scheduled = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.failed = 0
+        self._heap = []
+        self._pending = set()
+        self._running = set()
+        self._rerun = set()
+        self._attempts = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='comment')
+        self._thread = None
+
+    def schedule(self, pr_number):
+        """Queue an update of ``pr_number``'s comment."""
+        with self._condition:
+            self.scheduled += 1
+            if pr_number in self._pending:
+                self.coalesced += 1
+            elif pr_number in self._running:
+                if pr_number in self._rerun:
+                    self.coalesced += 1
+                self._rerun.add(pr_number)
+            else:
+                self._push(pr_number)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch,
+                                                name='comment-coalescer',
+                                                daemon=True)
+                self._thread.start()
+
+    def wait_idle(self, timeout=None):
+        """Block until no updates are queued or running."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._pending or self._running:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                self._condition.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._condition:
+            return {
+                'scheduled': self.scheduled,
+                'coalesced': self.coalesced,
+                'pending': len(self._pending) + len(self._rerun),
+                'running': len(self._running),
+                'retried': self.retried,
+                'failed': self.failed,
+            }
+
+    def _push(self, pr_number, delay=None):
+        due = time.monotonic() + (self.window if delay is None else delay)
+        heapq.heappush(self._heap, (due, next(self._sequence), pr_number))
+        self._pending.add(pr_number)
+        self._condition.notify_all()
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                while True:
+                    delay = None
+                    if self._heap:
+                        delay = self._heap[0][0] - time.monotonic()
+                        if delay <= 0:
+                            break
+                    self._condition.wait(delay)
+                _, _, pr_number = heapq.heappop(self._heap)
+                self._pending.discard(pr_number)
+                self._running.add(pr_number)
+            self._executor.submit(self._run, pr_number)
+
+    def _run(self, pr_number):
+        deferred = None
+        failed = False
+        try:
+            self.update(pr_number)
+        except RateLimited as err:
+            logging.warning('Deferring comment for PR %s: %s',
+                            pr_number, err)
+            deferred = max(err.retry_after, self.window)
+        except Exception:
+            logging.exception('Failed to update comment for PR %s',
+                              pr_number)
+            failed = True
+        finally:
+            with self._condition:
+                self._running.discard(pr_number)
+                if failed:
+                    attempt = self._attempts.get(pr_number, 0) + 1
+                    if attempt <= self.retries:
+                        self._attempts[pr_number] = attempt
+                        self.retried += 1
+                        deferred = self.backoff * 2 ** (attempt - 1)
+                    else:
+                        self._attempts.pop(pr_number, None)
+                        self.failed += 1
+                elif deferred is None:
+                    self._attempts.pop(pr_number, None)
+
+                if deferred is not None:
+                    # A later schedule() coalesces into the retry.
+                    self._rerun.discard(pr_number)
+                    self._push(pr_number, deferred)
+                elif pr_number in self._rerun:
+                    self._rerun.discard(pr_number)
+                    self._push(pr_number)
+                self._condition.notify_all()
@@ -9,20 +9,49 @@
     more detailed forms of that information.
 """
 
+import logging
+import os
+import threading
+import time
+
 import requests_cache
 from flask import Flask, g
+from jinja2 import FileSystemBytecodeCache
 from wptdash.database import db
+from wptdash.recorder import WebhookRecorder
 from werkzeug.utils import find_modules, import_string
 
 
+class BytecodeCache(FileSystemBytecodeCache):
+
+    """File system bytecode cache that counts its hits and misses."""
+
+    def __init__(self, directory=None):
+        super(BytecodeCache, self).__init__(directory)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def load_bytecode(self, bucket):
+        super(BytecodeCache, self).load_bytecode(bucket)
+        with self._lock:
+            if bucket.code is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+
 def create_app(config=None):
     import wptdash.models as models
+    from wptdash.pagecache import configure_page_cache
 
     app = Flask('wptdash')
 
     app.config.update(config or {})
     app.config.from_envvar('WPTDASH_SETTINGS', silent=True)
 
+    configure_templates(app)
+
     requests_cache.install_cache(backend='memory', expire_after=180)
 
     db.init_app(app)
@@ -35,10 +64,61 @@ def create_app(config=None):
         g.models = models
 
     register_blueprints(app)
+    configure_page_cache(app)
+
+    if app.config.get('JINJA_WARM_UP', True):
+        warm_up_templates(app)
+
+    record_dir = app.config.get('WEBHOOK_RECORD_DIR')
+    if record_dir:
+        app.wsgi_app = WebhookRecorder(app.wsgi_app, record_dir)
 
     return app
 
 
+def configure_templates(app):
+    """
+    Keep compiled templates on disk across worker restarts.
+
+    Jinja loads cached templates as code, so the default directory is
+    Jinja's own per-user one, which it creates private and refuses to use
+    if another user owns it. ``JINJA_BYTECODE_CACHE_DIR`` overrides it,
+    and is created private too; setting it to an empty value disables the
+    cache. Must run before the Jinja environment is first used.
+    """
+    directory = app.config.get('JINJA_BYTECODE_CACHE_DIR')
+    if directory == '':
+        return
+    if directory:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    app.jinja_options = dict(app.jinja_options,
+                             bytecode_cache=BytecodeCache(directory))
+
+
+def warm_up_templates(app):
+    """
+    Load every template so the first request does not compile any.
+
+    Filters are checked when a template is compiled, so this runs after the
+    blueprints registering them. Logs how long loading took and how many
+    templates came from the bytecode cache.
+    """
+    started = time.monotonic()
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    elapsed = (time.monotonic() - started) * 1000
+
+    cache = app.jinja_env.bytecode_cache
+    if cache is None:
+        logging.info('Compiled %d templates in %.1f ms', len(names), elapsed)
+    else:
+        logging.info('Loaded %d templates in %.1f ms '
+                     '(%d from bytecode cache, %d compiled)', len(names),
+                     elapsed, cache.hits, cache.misses)
+    return elapsed
+
+
 def register_blueprints(app):
     """ Registers all blueprint modules. """
     for name in find_modules('wptdash.blueprints'):
@@ -4,11 +4,15 @@
 """This module contains all GitHub interaction logic."""
 
 import configparser
+from collections import deque
 import json
 import logging
+import threading
+import time
 from urllib.parse import urljoin
 
 import requests
+from requests.adapters import HTTPAdapter
 
 CONFIG = configparser.ConfigParser()
 CONFIG.readfp(open(r'config.txt'))
@@ -17,6 +21,207 @@ GH_TOKEN = CONFIG.get('GitHub', 'GH_TOKEN')
 ORG = CONFIG.get('GitHub', 'ORG')
 REPO = CONFIG.get('GitHub', 'REPO')
 
+# Seconds to wait for a connection and for each read from the socket
+TIMEOUT = (3.05, 15)
+# Connections kept open to api.github.com per process
+POOL_SIZE = 10
+# Attempts after the first for calls that are safe to repeat
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+# Longest Retry-After or rate limit reset worth sleeping through
+MAX_RETRY_WAIT = 60
+RETRY_STATUSES = frozenset([502, 503, 504])
+# PATCH only ever sets a comment's whole body, so it is safe to repeat.
+IDEMPOTENT_METHODS = frozenset(['GET', 'PATCH'])
+# Number of recent call latencies kept for percentiles
+LATENCY_SAMPLES = 1000
+
+# Call priorities: comment updates on open pull requests come before
+# lookups of pull requests the dashboard has not seen yet.
+PRIORITY_COMMENT = 0
+PRIORITY_BACKFILL = 1
+# Remaining calls kept back for comment updates once quota runs low, and
+# the largest share of the limit the reserve may take
+RATE_LIMIT_RESERVE = 500
+RATE_LIMIT_RESERVE_SHARE = 0.1
+
+
+class RateLimited(requests.RequestException):
+
+    """A call was deferred because the GitHub rate limit is too low."""
+
+    def __init__(self, retry_after, *args, **kwargs):
+        super(RateLimited, self).__init__(
+            'GitHub rate limit reached; retry in %ds' % retry_after,
+            *args, **kwargs
+        )
+        self.retry_after = retry_after
+
+
+class RateLimiter(object):
+
+    """
+    Token bucket holding this token's remaining GitHub API calls.
+
+    The bucket is filled from the ``X-RateLimit-*`` headers of every
+    response, refilled to the limit at the reported reset time, and drained
+    by one token per call. Backfill calls are refused once only ``reserve``
+    tokens are left, so the rest of the window's quota goes to comment
+    updates; the reserve never exceeds ``RATE_LIMIT_RESERVE_SHARE`` of the
+    limit, so that small limits leave room for backfill. Refused calls
+    raise ``RateLimited`` with the seconds until the reset, for the caller
+    to defer.
+    """
+
+    def __init__(self, reserve=RATE_LIMIT_RESERVE, clock=time.time):
+        self.reserve = reserve
+        self.clock = clock
+        self.limit = None
+        self.tokens = None
+        self.reset = None
+        self._lock = threading.Lock()
+
+    def update(self, headers):
+        """Refill the bucket from a response's rate limit headers."""
+        if 'X-RateLimit-Remaining' not in headers:
+            return
+        with self._lock:
+            self.limit = int(headers.get('X-RateLimit-Limit', 0))
+            self.tokens = int(headers['X-RateLimit-Remaining'])
+            self.reset = int(headers.get('X-RateLimit-Reset', 0))
+
+    def acquire(self, priority=PRIORITY_COMMENT):
+        """
+        Take a token for one call, or raise ``RateLimited``.
+
+        Comment updates wait out a reset that is at most ``MAX_RETRY_WAIT``
+        seconds away; anything else is deferred to the caller.
+        """
+        while True:
+            with self._lock:
+                now = self.clock()
+                if self.reset is not None and now >= self.reset:
+                    self.tokens = self.limit
+                    self.reset = None
+                needed = 1
+                if priority != PRIORITY_COMMENT:
+                    needed += min(self.reserve, int(
+                        (self.limit or 0) * RATE_LIMIT_RESERVE_SHARE
+                    ))
+                # Without a known reset there is no refill to wait for; the
+                # next response refills the bucket from GitHub's count.
+                if (self.tokens is None or self.tokens >= needed or
+                        self.reset is None):
+                    if self.tokens:
+                        self.tokens -= 1
+                    return
+                wait = max(0, self.reset - now)
+            if priority != PRIORITY_COMMENT or wait > MAX_RETRY_WAIT:
+                raise RateLimited(wait)
+            time.sleep(wait)
+
+
+LIMITER = RateLimiter()
+
+
+class GitHubStats(object):
+
+    """Thread-safe record of GitHub API latency and rate limit quota."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.rate_limit = None
+        self.rate_remaining = None
+        self.rate_reset = None
+
+    def record(self, seconds, response=None):
+        """Record one HTTP call and the rate limit headers it returned."""
+        with self._lock:
+            self.calls += 1
+            self._latencies.append(seconds)
+            if response is None or response.status_code >= 500:
+                self.errors += 1
+            if response is None or getattr(response, 'from_cache', False):
+                return
+            headers = response.headers
+            if 'X-RateLimit-Remaining' in headers:
+                self.rate_limit = int(headers.get('X-RateLimit-Limit', 0))
+                self.rate_remaining = int(headers['X-RateLimit-Remaining'])
+                self.rate_reset = int(headers.get('X-RateLimit-Reset', 0))
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+
+            def percentile(fraction):
+                if not latencies:
+                    return None
+                return latencies[min(len(latencies) - 1,
+                                     int(len(latencies) * fraction))]
+
+            return {
+                'calls': self.calls,
+                'errors': self.errors,
+                'retries': self.retries,
+                'latency_p50': percentile(0.5),
+                'latency_p95': percentile(0.95),
+                'latency_max': latencies[-1] if latencies else None,
+                'rate_limit': self.rate_limit,
+                'rate_remaining': self.rate_remaining,
+                'rate_reset': self.rate_reset,
+            }
+
+
+STATS = GitHubStats()
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Return the connection-pooled session shared by this process."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def retry_delay(response, attempt):
+    """
+    Return seconds to wait before retrying after ``response``.
+
+    Returns None if the response should not be retried, or if GitHub asks
+    for a longer wait than ``MAX_RETRY_WAIT``.
+    """
+    delay = BACKOFF_FACTOR * (2 ** attempt)
+    if response is None or response.status_code in RETRY_STATUSES:
+        return delay
+    if response.status_code not in (403, 429):
+        return None
+
+    # Secondary rate limits send Retry-After; exhausting the primary quota
+    # sends X-RateLimit-Remaining: 0 with the reset time.
+    if 'Retry-After' in response.headers:
+        delay = float(response.headers['Retry-After'])
+    elif response.headers.get('X-RateLimit-Remaining') == '0':
+        reset = int(response.headers.get('X-RateLimit-Reset', 0))
+        delay = max(0, reset - time.time())
+    else:
+        return None
+    return delay if delay <= MAX_RETRY_WAIT else None
+
 
 class GitHub(object):
 
@@ -24,13 +229,14 @@ class GitHub(object):
 
     max_comment_length = 65536
 
-    def __init__(self):
+    def __init__(self, session=None):
         """Create GitHub instance."""
         self.headers = {"Accept": "application/vnd.github.v3+json"}
         self.auth = (GH_TOKEN, "x-oauth-basic")
         self.org = ORG
         self.repo = REPO
         self.base_url = "https://api.github.com/repos/%s/%s/" % (ORG, REPO)
+        self.session = session or get_session()
 
     # default object is safe because it is not being modified
     def _headers(self, headers=None):
@@ -41,44 +247,67 @@ class GitHub(object):
         return_value.update(headers)
         return return_value
 
-    def post(self, url, data, headers=None):
-        """Serialize and POST data to given URL."""
-        logging.debug("POST %s", url)
+    def request(self, method, url, data=None, headers=None,
+                priority=PRIORITY_COMMENT):
+        """
+        Send a request through the pooled session and return the response.
+
+        Every attempt first takes a token from ``LIMITER`` at ``priority``,
+        which raises ``RateLimited`` if the call has to be deferred.
+        Idempotent calls are retried with exponential backoff on connection
+        errors, timeouts and 5xx gateway errors, and after waiting out
+        ``Retry-After`` or an exhausted rate limit.
+        """
         if data is not None:
             data = json.dumps(data)
-        resp = requests.post(
-            url,
-            data=data,
-            headers=self._headers(headers),
-            auth=self.auth
-        )
+        retries = MAX_RETRIES if method in IDEMPOTENT_METHODS else 0
+
+        for attempt in range(retries + 1):
+            LIMITER.acquire(priority)
+            logging.debug("%s %s", method, url)
+            started = time.monotonic()
+            try:
+                resp = self.session.request(
+                    method,
+                    url,
+                    data=data,
+                    headers=self._headers(headers),
+                    auth=self.auth,
+                    timeout=TIMEOUT
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                STATS.record(time.monotonic() - started)
+                if attempt == retries:
+                    raise
+                resp = None
+            else:
+                STATS.record(time.monotonic() - started, resp)
+                if not getattr(resp, 'from_cache', False):
+                    LIMITER.update(resp.headers)
+                if resp.ok or attempt == retries:
+                    break
+
+            delay = retry_delay(resp, attempt)
+            if delay is None:
+                break
+            STATS.record_retry()
+            logging.warning("Retrying %s %s in %.1fs", method, url, delay)
+            time.sleep(delay)
+
         resp.raise_for_status()
         return resp
 
+    def post(self, url, data, headers=None):
+        """Serialize and POST data to given URL."""
+        return self.request('POST', url, data, headers)
+
     def patch(self, url, data, headers=None):
         """Serialize and PATCH data to given URL."""
-        logging.debug("PATCH %s", url)
-        if data is not None:
-            data = json.dumps(data)
-        resp = requests.patch(
-            url,
-            data=data,
-            headers=self._headers(headers),
-            auth=self.auth
-        )
-        resp.raise_for_status()
-        return resp
+        return self.request('PATCH', url, data, headers)
 
-    def get(self, url, headers=None):
+    def get(self, url, headers=None, priority=PRIORITY_COMMENT):
         """Execute GET request for given URL."""
-        logging.debug("GET %s", url)
-        resp = requests.get(
-            url,
-            headers=self._headers(headers),
-            auth=self.auth
-        )
-        resp.raise_for_status()
-        return resp
+        return self.request('GET', url, headers=headers, priority=priority)
 
     def validate_comment_length(self, comment):
         return len(comment) < self.max_comment_length
@@ -86,7 +315,7 @@ class GitHub(object):
     def get_pr(self, issue_number):
         """Get pull request data."""
         pr_url = urljoin(self.base_url, "pulls/%s" % issue_number)
-        return self.get(pr_url).json()
+        return self.get(pr_url, priority=PRIORITY_BACKFILL).json()
 
     def post_comment(self, issue_number, body, comment_url=None):
         data = {"body": body}
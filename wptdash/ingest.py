@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Set-based ingestion of stability results.
+
+Rows are collected from a payload up front and written with a handful of
+multi-row ``INSERT ... ON CONFLICT`` statements instead of one SELECT and
+one INSERT per row.
+
+Test paths are interned into integer ids. Ids seen in committed
+transactions are kept in a process-wide LRU cache, so steady-state ingest
+of a known test suite does not look tests up at all.
+"""
+
+from collections import namedtuple, OrderedDict
+import json
+from operator import add, sub
+import threading
+
+from sqlalchemy import bindparam, event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+import wptdash.models as models
+
+# Upper bound on bound parameters in a single statement. SQLite builds
+# before 3.32 refuse more than 999.
+MAX_PARAMETERS = {'sqlite': 999}
+DEFAULT_MAX_PARAMETERS = 32767
+
+# Number of test paths whose ids are remembered between requests.
+TEST_ID_CACHE_SIZE = 100000
+
+# ``Session.info`` key for test ids learned in the current transaction.
+PENDING_TEST_IDS = 'wptdash.pending_test_ids'
+
+# Counter values stored on ``Job`` and ``Build``, or a change to them
+ResultCounts = namedtuple('ResultCounts',
+                          ['results', 'inconsistent', 'status_totals'])
+
+
+def upsert(session, table, rows, index_elements, update_columns=()):
+    """Write ``rows`` to ``table`` with multi-row upserts.
+
+    Rows conflicting on ``index_elements`` have ``update_columns``
+    overwritten; with no ``update_columns`` they are left untouched.
+
+    PostgreSQL gets ``INSERT ... ON CONFLICT``. Other dialects (SQLite in
+    the test fixtures) get ``INSERT OR REPLACE`` / ``INSERT OR IGNORE``,
+    which rewrite the whole row, so callers always pass complete rows.
+    """
+    if not rows:
+        return
+
+    dialect = session.get_bind().dialect.name
+    max_parameters = MAX_PARAMETERS.get(dialect, DEFAULT_MAX_PARAMETERS)
+    batch_size = max(1, max_parameters // len(rows[0]))
+
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        if dialect == 'postgresql':
+            statement = postgresql.insert(table).values(batch)
+            if update_columns:
+                statement = statement.on_conflict_do_update(
+                    index_elements=index_elements,
+                    set_={column: statement.excluded[column]
+                          for column in update_columns}
+                )
+            else:
+                statement = statement.on_conflict_do_nothing(
+                    index_elements=index_elements
+                )
+        else:
+            statement = table.insert().values(batch).prefix_with(
+                'OR REPLACE' if update_columns else 'OR IGNORE'
+            )
+        session.execute(statement)
+
+
+class TestIdCache(object):
+
+    """
+    Thread-safe LRU cache mapping test paths to ``(id, parent_id)``.
+
+    Ids never change once assigned. The parent is only used to decide
+    whether a subtest needs re-parenting, so a stale entry at worst costs
+    one redundant or skipped ``UPDATE`` of ``test.parent_id``.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._entries.move_to_end(path)
+            return entry
+
+    def update(self, entries):
+        with self._lock:
+            for path, entry in entries.items():
+                self._entries[path] = entry
+                self._entries.move_to_end(path)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+TEST_IDS = TestIdCache(TEST_ID_CACHE_SIZE)
+
+
+@event.listens_for(Session, 'after_commit')
+def _promote_test_ids(session):
+    """Cache the test ids of a transaction once it has committed."""
+    TEST_IDS.update(session.info.pop(PENDING_TEST_IDS, {}))
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_test_ids(session, transaction):
+    """Forget test ids from a transaction that was rolled back."""
+    if transaction.parent is None:
+        session.info.pop(PENDING_TEST_IDS, None)
+
+
+def collect_stability_rows(job_id, iterations, results):
+    """Flatten stability ``results`` into rows for each table.
+
+    Returns a tuple of (parent tests, subtests, job results), each a list
+    of column dicts with duplicates collapsed. Tests are identified by
+    path: subtests carry a ``parent_path`` and job results a ``test_path``,
+    which ``add_stability_results`` resolves to ids. Status counts are
+    packed into each job result's ``status_counts`` histogram.
+    """
+    parents = {}
+    subtests = {}
+    job_results = {}
+
+    def add_result(path, result, messages):
+        counts = {}
+        consistent = True
+        for status_name, count in result['status'].items():
+            counts[models.TestStatus.from_string(status_name)] = count
+            if count < iterations:
+                consistent = False
+        job_result = {
+            'job_id': job_id,
+            'test_path': path,
+            'iterations': iterations,
+            'messages': messages,
+            'consistent': consistent,
+            'status_counts': models.StatusHistogram.from_counts(counts),
+        }
+        job_results[path] = job_result
+        return job_result
+
+    for test_data in results:
+        path = test_data['test']
+        parents[path] = {'path': path, 'tree_path': path}
+        test_result = add_result(path, test_data['result'], None)
+
+        for subtest_data in test_data['result'].get('subtests', []):
+            subtest_path = subtest_data['test']
+            subtests[subtest_path] = {
+                'path': subtest_path,
+                'parent_path': path,
+                'tree_path': path + models.TREE_PATH_SEPARATOR + subtest_path,
+            }
+            subtest_result = add_result(
+                subtest_path, subtest_data['result'],
+                json.dumps(subtest_data['result']['messages'])
+            )
+            if not subtest_result['consistent']:
+                test_result['consistent'] = False
+
+    return (list(parents.values()), list(subtests.values()),
+            list(job_results.values()))
+
+
+def preload_tests(session, paths):
+    """Return dict of test path to ``(id, parent_id)`` for existing tests.
+
+    Paths are answered from ``TEST_IDS`` where possible and from the
+    database otherwise. Ids read from the database are staged on the
+    session and only enter the cache once the transaction commits.
+    """
+    tests = {}
+    missing = []
+    for path in paths:
+        entry = TEST_IDS.get(path)
+        if entry is None:
+            missing.append(path)
+        else:
+            tests[path] = entry
+
+    pending = session.info.setdefault(PENDING_TEST_IDS, {})
+    columns = (models.Test.path, models.Test.id, models.Test.parent_id)
+    for batch in _in_batches(session, missing):
+        query = session.query(*columns).filter(models.Test.path.in_(batch))
+        for path, test_id, parent_id in query:
+            tests[path] = pending[path] = (test_id, parent_id)
+    return tests
+
+
+def intern_tests(session, parents, subtests):
+    """Create missing tests and return dict of test path to id.
+
+    Existing tests keep their parent; subtests are re-parented.
+    """
+    test_table = models.Test.__table__
+    paths = ([row['path'] for row in parents] +
+             [row['path'] for row in subtests])
+    tests = preload_tests(session, paths)
+
+    new_parents = [row for row in parents if row['path'] not in tests]
+    upsert(session, test_table, new_parents, ['path'])
+    tests.update(preload_tests(session,
+                               [row['path'] for row in new_parents]))
+
+    new_subtests = []
+    moved_subtests = {}
+    tree_paths = {}
+    for row in subtests:
+        parent_id = tests[row['parent_path']][0]
+        if row['path'] not in tests:
+            new_subtests.append({'path': row['path'],
+                                 'parent_id': parent_id,
+                                 'tree_path': row['tree_path']})
+        elif tests[row['path']][1] != parent_id:
+            moved_subtests[row['path']] = (tests[row['path']][0], parent_id)
+            tree_paths[row['path']] = row['tree_path']
+
+    upsert(session, test_table, new_subtests, ['path'])
+    tests.update(preload_tests(session,
+                               [row['path'] for row in new_subtests]))
+
+    if moved_subtests:
+        session.execute(
+            test_table.update().where(
+                test_table.c.id == bindparam('test_id')
+            ).values(parent_id=bindparam('new_parent_id'),
+                     tree_path=bindparam('new_tree_path')),
+            [{'test_id': test_id, 'new_parent_id': parent_id,
+              'new_tree_path': tree_paths[path]}
+             for path, (test_id, parent_id) in moved_subtests.items()]
+        )
+        session.info.setdefault(PENDING_TEST_IDS, {}).update(moved_subtests)
+        tests.update(moved_subtests)
+
+    return {path: entry[0] for path, entry in tests.items()}
+
+
+def preload_job_results(session, job_id, test_ids):
+    """Return dict of test id to the existing JobResult row for ``job_id``."""
+    columns = (models.JobResult.test_id, models.JobResult.iterations,
+               models.JobResult.messages, models.JobResult.consistent,
+               models.JobResult.status_counts)
+    job_results = {}
+    for batch in _in_batches(session, test_ids):
+        query = session.query(*columns).filter(
+            models.JobResult.job_id == job_id,
+            models.JobResult.test_id.in_(batch)
+        )
+        for test_id, iterations, messages, consistent, status_counts in query:
+            job_results[test_id] = {
+                'job_id': job_id,
+                'test_id': test_id,
+                'iterations': iterations,
+                'messages': messages,
+                'consistent': consistent,
+                'status_counts': status_counts,
+            }
+    return job_results
+
+
+def count_results(rows):
+    """Return the ``ResultCounts`` contributed by job result ``rows``."""
+    status_totals = [0] * models.StatusHistogram.size
+    inconsistent = 0
+    for row in rows:
+        status_totals = list(map(add, status_totals, row['status_counts']))
+        if not row['consistent']:
+            inconsistent += 1
+    return ResultCounts(len(rows), inconsistent, tuple(status_totals))
+
+
+def sum_counts(counts):
+    """Return the total of an iterable of ``ResultCounts``."""
+    total = ResultCounts(0, 0, (0,) * models.StatusHistogram.size)
+    for item in counts:
+        total = ResultCounts(
+            total.results + item.results,
+            total.inconsistent + item.inconsistent,
+            tuple(map(add, total.status_totals, item.status_totals))
+        )
+    return total
+
+
+def update_counters(session, job_id, counts):
+    """Add ``counts`` to the counters of a job and of its build.
+
+    Both rows are re-read with ``SELECT ... FOR UPDATE`` so that stability
+    results for several jobs of one build arriving at once do not lose
+    each other's updates.
+    """
+    if not (counts.results or counts.inconsistent or
+            any(counts.status_totals)):
+        return
+
+    job = _locked(session, models.Job, job_id)
+    build = _locked(session, models.Build, job.build_id)
+    for instance in (job, build):
+        instance.result_count += counts.results
+        instance.inconsistent_count += counts.inconsistent
+        instance.status_totals = tuple(map(add, instance.status_totals,
+                                           counts.status_totals))
+
+
+def add_stability_results(session, job_id, iterations, results):
+    """Upsert every Test and JobResult row in ``results``.
+
+    Test ids come from the process-wide cache or one batched query, and
+    existing job results are preloaded the same way so that rows which
+    would not change are not written at all. The job itself must already
+    be flushed to the database.
+
+    The job row is locked before its results are preloaded, so concurrent
+    submissions for one job take turns, and each sees the results the
+    other wrote.
+
+    Returns the ``ResultCounts`` by which the job's counters change, for
+    ``update_counters``.
+    """
+    parents, subtests, job_results = collect_stability_rows(
+        job_id, iterations, results
+    )
+
+    tests = intern_tests(session, parents, subtests)
+    for row in job_results:
+        row['test_id'] = tests[row.pop('test_path')]
+
+    _lock(session, models.Job, job_id)
+    existing_results = preload_job_results(
+        session, job_id, [row['test_id'] for row in job_results]
+    )
+    job_results = [row for row in job_results
+                   if existing_results.get(row['test_id']) != row]
+
+    upsert(session, models.JobResult.__table__, job_results,
+           ['job_id', 'test_id'],
+           ['iterations', 'messages', 'consistent', 'status_counts'])
+
+    added = count_results(job_results)
+    replaced = count_results([existing_results[row['test_id']]
+                              for row in job_results
+                              if row['test_id'] in existing_results])
+    return ResultCounts(
+        added.results - replaced.results,
+        added.inconsistent - replaced.inconsistent,
+        tuple(map(sub, added.status_totals, replaced.status_totals))
+    )
+
+
+def _locked(session, model, id):
+    """Load ``model`` row ``id`` afresh, locked for the transaction."""
+    # populate_existing() skips autoflush, and would otherwise overwrite
+    # pending changes with the stored values.
+    session.flush()
+    return session.query(model).filter(
+        model.id == id
+    ).with_for_update().populate_existing().one()
+
+
+def _lock(session, model, id):
+    """Lock ``model`` row ``id`` for the transaction without loading it."""
+    session.query(model.id).filter(model.id == id).with_for_update().all()
+
+
+def _in_batches(session, values):
+    """Split ``values`` into lists small enough for one ``IN (...)``."""
+    values = list(set(values))
+    dialect = session.get_bind().dialect.name
+    # Leave room for the other parameters in the query.
+    batch_size = MAX_PARAMETERS.get(dialect, DEFAULT_MAX_PARAMETERS) - 1
+    for start in range(0, len(values), batch_size):
+        yield values[start:start + batch_size]
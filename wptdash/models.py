@@ -1,6 +1,10 @@
 """ SQLAlchemy Model definitions. """
+from collections import namedtuple
+from datetime import datetime
 import enum
 
+from sqlalchemy.dialects import postgresql
+
 from wptdash.database import db
 
 
@@ -116,6 +120,74 @@ class TestStatus(enum.Enum):
         return getattr(cls, status.upper())
 
 
+# One ``(status, count)`` pair of a ``JobResult`` status histogram
+StatusCount = namedtuple('StatusCount', ['status', 'count'])
+
+# A parent test's ``JobResult`` and the results of its subtests
+ResultGroup = namedtuple('ResultGroup', ['result', 'subresults'])
+
+# A page of the pull request list, the latest build of each pull request by
+# id, and the cursors of the neighbouring pages (None if there is none)
+PullRequestPage = namedtuple('PullRequestPage',
+                             ['pulls', 'latest_builds', 'newer', 'older'])
+
+PULL_REQUEST_PAGE_SIZE = 100
+CURSOR_DATETIME_FORMAT = '%Y%m%dT%H%M%S.%f'
+
+# Separates a parent test path from a subtest name in ``Test.tree_path``.
+# It sorts before every printable character, so ordering by tree path puts
+# each test directly before its subtests.
+TREE_PATH_SEPARATOR = '\x1f'
+
+
+class StatusHistogram(db.TypeDecorator):
+
+    """
+    Fixed-width count of iterations per ``TestStatus``.
+
+    Slot ``n`` holds the count for the status whose value is ``n + 1``.
+    Stored as an integer array on PostgreSQL and as comma-separated text on
+    other dialects; loaded as a tuple so it is never mutated in place.
+
+    Subclasses ``sqlalchemy.types.TypeDecorator``
+    """
+
+    impl = db.Text
+    size = len(TestStatus)
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(postgresql.ARRAY(db.Integer))
+        return dialect.type_descriptor(db.Text())
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if dialect.name == 'postgresql':
+            return list(value)
+        return ','.join(str(count) for count in value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if dialect.name != 'postgresql':
+            value = value.split(',')
+        return tuple(int(count) for count in value)
+
+    @classmethod
+    def from_counts(cls, counts):
+        """
+        Build a histogram from a ``{TestStatus: count}`` mapping.
+
+        Arguments:
+        counts -- Mapping of ``TestStatus`` to number of iterations
+        """
+        histogram = [0] * cls.size
+        for status, count in counts.items():
+            histogram[status.value - 1] = count
+        return tuple(histogram)
+
+
 # Many to Many Table joining ``GitHubUser`` and ``PullRequest``
 # SQLAlchemy auto-deletes from this table. See:
 # http://docs.sqlalchemy.org/en/latest/orm/basic_relationships.html#deleting-rows-from-the-many-to-many-table
@@ -139,14 +211,19 @@ class Build(db.Model):
     __tablename__ = 'build'
 
     id = db.Column(db.Integer, primary_key=True)
-    number = db.Column(db.Integer, nullable=False)
+    number = db.Column(db.Integer, nullable=False, index=True)
     pull_request_id = db.Column(db.Integer,
-                                db.ForeignKey('pull_request.id'))
+                                db.ForeignKey('pull_request.id'), index=True)
     head_sha = db.Column(db.String, db.ForeignKey('commit.sha'))
     base_sha = db.Column(db.String, db.ForeignKey('commit.sha'))
     status = db.Column(db.Enum(BuildStatus), nullable=False)
     started_at = db.Column(db.TIMESTAMP())
     finished_at = db.Column(db.TIMESTAMP())
+    # Totals over the results of every job, maintained at ingest
+    result_count = db.Column(db.Integer, nullable=False, default=0)
+    inconsistent_count = db.Column(db.Integer, nullable=False, default=0)
+    status_totals = db.Column(StatusHistogram, nullable=False,
+                              default=(0,) * StatusHistogram.size)
 
     jobs = db.relationship('Job', back_populates='build')
     pull_request = db.relationship('PullRequest',
@@ -203,8 +280,9 @@ class Job(db.Model):
     __tablename__ = 'job'
 
     id = db.Column(db.Integer, primary_key=True)
-    number = db.Column(db.String)
-    build_id = db.Column(db.Integer, db.ForeignKey('build.id'), nullable=False)
+    number = db.Column(db.String, index=True)
+    build_id = db.Column(db.Integer, db.ForeignKey('build.id'), nullable=False,
+                         index=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'),
                            nullable=False)
     state = db.Column(db.Enum(JobStatus))
@@ -212,6 +290,13 @@ class Job(db.Model):
     allow_failure = db.Column(db.Boolean, nullable=False)
     started_at = db.Column(db.TIMESTAMP())
     finished_at = db.Column(db.TIMESTAMP())
+    # SHA-256 of the last stability payload ingested for this job
+    payload_digest = db.Column(db.String(64))
+    # Totals over the job's results, maintained at ingest
+    result_count = db.Column(db.Integer, nullable=False, default=0)
+    inconsistent_count = db.Column(db.Integer, nullable=False, default=0)
+    status_totals = db.Column(StatusHistogram, nullable=False,
+                              default=(0,) * StatusHistogram.size)
 
     build = db.relationship('Build', back_populates='jobs')
     product = db.relationship('Product', back_populates='jobs')
@@ -231,16 +316,33 @@ class JobResult(db.Model):
     __tablename__ = 'job_result'
 
     job_id = db.Column(db.Integer, db.ForeignKey('job.id'), primary_key=True)
-    test_id = db.Column(db.Text, db.ForeignKey('test.id'), primary_key=True)
+    test_id = db.Column(db.Integer, db.ForeignKey('test.id'), primary_key=True,
+                        autoincrement=False, index=True)
     iterations = db.Column(db.Integer, nullable=False)
     messages = db.Column(db.Text)
     consistent = db.Column(db.Boolean, nullable=False)
+    status_counts = db.Column(StatusHistogram, nullable=False,
+                              default=(0,) * StatusHistogram.size)
 
     job = db.relationship('Job', back_populates='tests')
     test = db.relationship('Test', back_populates='jobs')
-    statuses = db.relationship('StabilityStatus',
-                               primaryjoin="and_(foreign(JobResult.job_id)==remote(StabilityStatus.job_id), foreign(JobResult.test_id)==remote(StabilityStatus.test_id))",
-                               uselist=True)
+
+    # Every unstable results view filters on ``NOT consistent``; the
+    # partial index only holds those rows, a small share of the table.
+    __table_args__ = (
+        db.Index('ix_job_result_inconsistent', job_id, test_id,
+                 postgresql_where=~consistent, sqlite_where=~consistent),
+    )
+
+    @property
+    def statuses(self):
+        """
+        Non-zero entries of ``status_counts`` as ``StatusCount`` tuples.
+
+        Keeps the ``status.status`` / ``status.count`` interface the
+        templates used with the old ``stability_status`` table.
+        """
+        return histogram_statuses(self.status_counts)
 
 
 class Product(db.Model):
@@ -270,7 +372,7 @@ class PullRequest(db.Model):
     __tablename__ = 'pull_request'
 
     id = db.Column(db.Integer, primary_key=True)
-    number = db.Column(db.Integer, nullable=False)
+    number = db.Column(db.Integer, nullable=False, index=True)
     title = db.Column(db.String, nullable=False)
     state = db.Column(db.Enum(PRStatus), nullable=False)
     head_sha = db.Column(db.String, db.ForeignKey('commit.sha'),
@@ -291,6 +393,8 @@ class PullRequest(db.Model):
     updated_at = db.Column(db.TIMESTAMP(), nullable=False)
     closed_at = db.Column(db.TIMESTAMP())
     comment_url = db.Column(db.String)
+    # SHA-256 of the comment body last posted to ``comment_url``
+    comment_digest = db.Column(db.String(64))
 
     builds = db.relationship('Build', back_populates='pull_request')
     creator = db.relationship('GitHubUser', foreign_keys=[created_by],
@@ -310,6 +414,11 @@ class PullRequest(db.Model):
     watchers = db.relationship('GitHubUser', secondary=USER_PR,
                                back_populates='prs_watching')
 
+    # The index page walks pull requests newest first by this key.
+    __table_args__ = (
+        db.Index('ix_pull_request_created_at_id', created_at, id),
+    )
+
 
 class Repository(db.Model):
 
@@ -329,26 +438,6 @@ class Repository(db.Model):
     owner = db.relationship('GitHubUser', back_populates='repositories')
 
 
-class StabilityStatus(db.Model):
-
-    """
-    Table containing stability statuses for tests in jobs
-
-    Subclasses ``wptdash.app.db.Model``
-    """
-
-    __tablename__ = 'stability_status'
-
-    id = db.Column(db.Integer, primary_key=True)
-    job_id = db.Column(db.Integer, nullable=False)
-    test_id = db.Column(db.Text, nullable=False)
-    status = db.Column(db.Enum(TestStatus), nullable=False)
-    count = db.Column(db.Integer, nullable=False)
-
-    db.ForeignKeyConstraint(['job_id', 'test_id'],
-                            ['job_result.job_id', 'job_result.test_id'])
-
-
 class Test(db.Model):
 
     """
@@ -356,13 +445,27 @@ class Test(db.Model):
 
     Makes use of the `Adjacency List Pattern <http://docs.sqlalchemy.org/en/latest/orm/self_referential.html>`_.
 
+    Tests are keyed by a compact integer id; the (possibly long) test path or
+    subtest name is stored once, in the unique ``path`` column.
+
+    ``tree_path`` materializes the hierarchy: a test's own path, or its
+    parent's path and ``TREE_PATH_SEPARATOR`` followed by the subtest name.
+    It is indexed with byte-order collation, so ordering by it groups
+    subtests under their parent and a directory prefix is an index range.
+
     Subclasses ``wptdash.app.db.Model``
     """
 
     __tablename__ = 'test'
 
-    id = db.Column(db.Text, primary_key=True)
-    parent_id = db.Column(db.Text, db.ForeignKey('test.id'))
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.Text, nullable=False, unique=True)
+    parent_id = db.Column(db.Integer, db.ForeignKey('test.id'), index=True)
+    tree_path = db.Column(
+        db.Text().with_variant(postgresql.TEXT(collation='C'), 'postgresql'),
+        nullable=False, index=True,
+        default=lambda context: context.current_parameters['path']
+    )
 
     subtests = db.relationship('Test',
                                backref=db.backref('parent',
@@ -410,3 +513,253 @@ def get_or_create(session, model, defaults=None, **kwargs):
         return instance, True
 
 
+def histogram_statuses(status_counts):
+    """Return the non-zero entries of a status histogram as ``StatusCount``."""
+    return [StatusCount(status, count)
+            for status, count in zip(TestStatus, status_counts or ())
+            if count]
+
+
+def get_job_results(session, job_id, prefix=None, consistent=None):
+    """
+    Return a job's results grouped under their parent tests.
+
+    Uses a single query ordered by ``Test.tree_path``, so each parent's
+    subtest results follow it directly. Subtest results whose parent has no
+    result in the job are dropped.
+
+    Arguments:
+    session -- The database session
+    job_id -- The job to fetch results for
+    prefix -- Only include tests whose path starts with this (e.g. '/css/')
+    consistent -- If not None, only include results with this consistency
+
+    Returns list of ``ResultGroup``
+    """
+    query = session.query(JobResult).join(JobResult.test).options(
+        db.contains_eager(JobResult.test)
+    ).filter(JobResult.job_id == job_id).order_by(Test.tree_path)
+    if prefix:
+        query = query.filter(Test.tree_path.startswith(prefix,
+                                                       autoescape=True))
+    if consistent is not None:
+        # Spelled as the ix_job_result_inconsistent predicate is.
+        query = query.filter(JobResult.consistent if consistent
+                             else ~JobResult.consistent)
+
+    groups = []
+    for result in query:
+        if result.test.parent_id is None:
+            groups.append(ResultGroup(result, []))
+        elif groups and groups[-1].result.test_id == result.test.parent_id:
+            groups[-1].subresults.append(result)
+    return groups
+
+
+def get_pull_request_detail(session, number):
+    """
+    Return pull request ``number`` with everything ``pull.html`` shows.
+
+    Users and repositories are joined in; builds are loaded with one more
+    query.
+    """
+    return session.query(PullRequest).options(
+        db.joinedload(PullRequest.creator),
+        db.joinedload(PullRequest.merger),
+        db.joinedload(PullRequest.head_repository).joinedload(
+            Repository.owner
+        ),
+        db.joinedload(PullRequest.base_repository).joinedload(
+            Repository.owner
+        ),
+        db.selectinload(PullRequest.builds),
+    ).filter(PullRequest.number == number).first()
+
+
+def get_build_detail(session, number):
+    """
+    Return build ``number`` with everything ``build.html`` shows.
+
+    The pull request is joined in; jobs and their products are loaded with
+    one more query.
+    """
+    return session.query(Build).options(
+        db.joinedload(Build.pull_request),
+        db.selectinload(Build.jobs).joinedload(Job.product),
+    ).filter(Build.number == number).first()
+
+
+def get_job_detail(session, number):
+    """
+    Return job ``number`` with everything ``job.html`` shows but results.
+
+    Results are loaded with ``get_job_results``.
+    """
+    return session.query(Job).options(
+        db.joinedload(Job.build).joinedload(Build.pull_request),
+        db.joinedload(Job.product),
+    ).filter(Job.number == number).first()
+
+
+def encode_cursor(pull):
+    """Return the page cursor of a pull request."""
+    return '%s_%d' % (pull.created_at.strftime(CURSOR_DATETIME_FORMAT),
+                      pull.id)
+
+
+def decode_cursor(cursor):
+    """
+    Return the ``(created_at, id)`` key encoded in a page cursor.
+
+    Raises ValueError if the cursor is malformed.
+    """
+    created_at, _, pull_id = cursor.partition('_')
+    return datetime.strptime(created_at, CURSOR_DATETIME_FORMAT), int(pull_id)
+
+
+def get_latest_builds(session, pull_request_ids):
+    """
+    Return the latest build of each pull request, by pull request id.
+
+    Builds are ranked within their pull request by a window function, so
+    one query returns them all. As for the pull request comment, builds not
+    yet reported by Travis CI have no start time and rank as the newest.
+    """
+    if not pull_request_ids:
+        return {}
+    ranked = session.query(
+        Build.id.label('build_id'),
+        db.func.row_number().over(
+            partition_by=Build.pull_request_id,
+            order_by=(Build.started_at.desc().nullsfirst(), Build.id.desc())
+        ).label('rank')
+    ).filter(Build.pull_request_id.in_(pull_request_ids)).subquery()
+    builds = session.query(Build).join(
+        ranked, Build.id == ranked.c.build_id
+    ).filter(ranked.c.rank == 1)
+    return {build.pull_request_id: build for build in builds}
+
+
+def get_pull_request_page(session, before=None, after=None,
+                          limit=PULL_REQUEST_PAGE_SIZE):
+    """
+    Return a page of pull requests, newest first.
+
+    Pages are keyed on ``(created_at, id)`` rather than offset, so every
+    page costs the same two queries however far back it is: one for the
+    pull requests and one for their latest builds.
+
+    Arguments:
+    session -- The database session
+    before -- Cursor of the pull request the page starts after
+    after -- Cursor of the pull request the page ends before
+    limit -- The most pull requests to return
+
+    Raises ValueError if a cursor is malformed.
+
+    Returns ``PullRequestPage``
+    """
+    key = db.tuple_(PullRequest.created_at, PullRequest.id)
+    query = session.query(PullRequest)
+    if after:
+        # Walk forwards from the cursor and flip the page round.
+        query = query.filter(key > db.tuple_(*decode_cursor(after))).order_by(
+            PullRequest.created_at, PullRequest.id
+        )
+    else:
+        if before:
+            query = query.filter(key < db.tuple_(*decode_cursor(before)))
+        query = query.order_by(PullRequest.created_at.desc(),
+                               PullRequest.id.desc())
+
+    # One extra row tells whether there is another page beyond this one.
+    pulls = query.limit(limit + 1).all()
+    more = len(pulls) > limit
+    pulls = pulls[:limit]
+    if after:
+        pulls.reverse()
+        has_newer, has_older = more, True
+    else:
+        has_newer, has_older = bool(before), more
+
+    return PullRequestPage(
+        pulls,
+        get_latest_builds(session, [pull.id for pull in pulls]),
+        encode_cursor(pulls[0]) if pulls and has_newer else None,
+        encode_cursor(pulls[-1]) if pulls and has_older else None,
+    )
+
+
+def get_tests_under(session, prefix):
+    """
+    Return a query for every test and subtest whose path starts with prefix.
+
+    Arguments:
+    session -- The database session
+    prefix -- A path prefix such as '/css/'
+    """
+    return session.query(Test).filter(
+        Test.tree_path.startswith(prefix, autoescape=True)
+    ).order_by(Test.tree_path)
+
+
+class IdentityMap(object):
+
+    """
+    Request-scoped cache of the rows a payload refers to.
+
+    ``preload`` fetches every row for a set of attribute values with a
+    single ``IN (...)`` query, and ``get``/``get_or_create`` then answer
+    from the cache instead of issuing a SELECT (and an autoflush) per
+    lookup.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self._instances = {}
+        self._loaded = {}
+
+    def preload(self, model, **kwargs):
+        """
+        Fetch all instances of ``model`` matching any of the given values.
+
+        Arguments:
+        model -- The model class to query
+        kwargs -- A single attribute name mapped to an iterable of values
+
+        Returns dict of attribute value to instance for the values found
+        """
+        (attribute, values), = kwargs.items()
+        key = (model, attribute)
+        instances = self._instances.setdefault(key, {})
+        loaded = self._loaded.setdefault(key, set())
+
+        missing = set(value for value in values if value is not None) - loaded
+        if missing:
+            column = getattr(model, attribute)
+            with self.session.no_autoflush:
+                query = self.session.query(model).filter(
+                    column.in_(missing)
+                )
+                for instance in query:
+                    instances.setdefault(getattr(instance, attribute),
+                                         instance)
+            loaded.update(missing)
+        return instances
+
+    def get(self, model, **kwargs):
+        (attribute, value), = kwargs.items()
+        return self.preload(model, **{attribute: [value]}).get(value)
+
+    def get_or_create(self, model, defaults=None, **kwargs):
+        instance = self.get(model, **kwargs)
+
+        if instance:
+            return instance, False
+        else:
+            (attribute, value), = kwargs.items()
+            kwargs.update(defaults or {})
+            instance = model(**kwargs)
+            self.session.add(instance)
+            self._instances[(model, attribute)][value] = instance
+            return instance, True
@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Cache of rendered build and job pages.
+
+Pages are stored under the build or job number and a version stamp, a
+random token kept in the cache itself. Ingest replaces the stamp of every
+pull request, build and job it changes once its transaction commits, so a
+cached page is never served after the data behind it changed, and a hit
+needs neither a database session nor any invalidation query. The stamps
+also serve as the pages' ETags.
+
+``PAGE_CACHE`` selects the storage:
+
+- ``'lru'``: an in-process LRU of ``PAGE_CACHE_SIZE`` entries. Ingest in
+  another process cannot invalidate it, so it only suits a single process
+  that also ingests.
+- ``'filesystem'``: files under ``PAGE_CACHE_DIR``, which must be set,
+  shared by every process on the host that runs as the same user,
+  including the spool worker.
+- ``'uwsgi'``: the uWSGI cache named by ``PAGE_CACHE_UWSGI_NAME``, shared by
+  the workers of one uWSGI instance.
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import secrets
+import tempfile
+import threading
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+import wptdash.models as models
+from wptdash.stats import Counters
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+DEFAULT_LRU_SIZE = 500
+DEFAULT_FILESYSTEM_THRESHOLD = 2000
+DEFAULT_UWSGI_CACHE = 'wptdash-pages'
+
+# ``Session.info`` key for the pages changed in the current transaction.
+CHANGED_PAGES = 'wptdash.changed_pages'
+
+
+class LRUBackend(object):
+
+    """Thread-safe in-process store keeping the most recently used entries."""
+
+    def __init__(self, maxsize=DEFAULT_LRU_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def add(self, key, value):
+        """Store ``value`` unless ``key`` is present; return the stored one."""
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = value
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+            return self._entries.get(key, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class FileSystemBackend(object):
+
+    """
+    Store with one file per entry, shared by every process on the host.
+
+    Entries are written to a temporary file and renamed into place, so
+    readers never see a partial page. Once there are more than
+    ``threshold`` entries, the least recently written are removed.
+
+    Pages are served as they are stored, so the directory is created
+    private, and one that other users could write to is refused.
+    """
+
+    def __init__(self, directory, threshold=DEFAULT_FILESYSTEM_THRESHOLD):
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        status = os.stat(directory)
+        if status.st_uid != os.getuid() or status.st_mode & 0o022:
+            raise ValueError('Page cache directory %s is writable by other '
+                             'users' % directory)
+        self.directory = directory
+        self.threshold = threshold
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _write_temporary(self, value):
+        handle, path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        with os.fdopen(handle, 'wb') as entry_file:
+            entry_file.write(value.encode('utf-8'))
+        return path
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as entry_file:
+                return entry_file.read().decode('utf-8')
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value):
+        os.replace(self._write_temporary(value), self._path(key))
+        self._prune()
+
+    def add(self, key, value):
+        """Store ``value`` unless ``key`` is present; return the stored one."""
+        path = self._write_temporary(value)
+        try:
+            # Unlike a rename, a link fails if the entry already exists.
+            os.link(path, self._path(key))
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(path)
+        stored = self.get(key)
+        return value if stored is None else stored
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _prune(self):
+        names = [name for name in os.listdir(self.directory)
+                 if not name.startswith('.tmp')]
+        if len(names) <= self.threshold:
+            return
+        entries = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except FileNotFoundError:
+                continue
+        entries.sort()
+        for _, path in entries[:len(entries) - self.threshold]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class UWSGIBackend(object):
+
+    """Store in a uWSGI cache, shared by the workers of one instance."""
+
+    def __init__(self, name=DEFAULT_UWSGI_CACHE):
+        if uwsgi is None:
+            raise RuntimeError('The uwsgi page cache backend only works '
+                               'when running under uWSGI')
+        self.name = name
+
+    def get(self, key):
+        value = uwsgi.cache_get(key, self.name)
+        return None if value is None else value.decode('utf-8')
+
+    def set(self, key, value):
+        uwsgi.cache_update(key, value.encode('utf-8'), 0, self.name)
+
+    def add(self, key, value):
+        """Store ``value`` unless ``key`` is present; return the stored one."""
+        # cache_set leaves existing entries alone.
+        uwsgi.cache_set(key, value.encode('utf-8'), 0, self.name)
+        stored = self.get(key)
+        return value if stored is None else stored
+
+    def delete(self, key):
+        uwsgi.cache_del(key, self.name)
+
+
+class PageCache(object):
+
+    """
+    Rendered pages keyed by page kind, number and version stamp.
+
+    ``version`` identifies the templates pages are rendered with, so pages
+    and ETags from before a deploy that changed them are not reused.
+    """
+
+    def __init__(self, backend, version=''):
+        self.backend = backend
+        self.version = version
+        self.counters = Counters('hits', 'misses', 'stored', 'bumped')
+
+    @staticmethod
+    def _stamp_key(kind, number):
+        return 'stamp:%s:%s' % (kind, number)
+
+    def _page_key(self, kind, number, stamp):
+        return 'page:%s:%s:%s:%s' % (self.version, kind, number, stamp)
+
+    @staticmethod
+    def _unfinished_key(kind, number, stamp):
+        return 'unfinished:%s:%s:%s' % (kind, number, stamp)
+
+    def stamp(self, kind, number):
+        """Return the current version stamp of a page, creating it if new."""
+        stamp = self.backend.get(self._stamp_key(kind, number))
+        if stamp is None:
+            stamp = self.backend.add(self._stamp_key(kind, number),
+                                     secrets.token_hex(8))
+        return stamp
+
+    def etag(self, stamp):
+        """Return the ETag of a page rendered at ``stamp``."""
+        return '%s-%s' % (self.version, stamp) if self.version else stamp
+
+    def get(self, kind, number, stamp):
+        """Return the page rendered at ``stamp``, or None."""
+        page = self.backend.get(self._page_key(kind, number, stamp))
+        self.counters.count('misses' if page is None else 'hits')
+        return page
+
+    def put(self, kind, number, stamp, page):
+        """
+        Store a page rendered at ``stamp``.
+
+        The stamp must have been read before the data the page shows, so a
+        page rendered from data that has since changed is stored under a
+        stamp that is no longer current, and never served.
+        """
+        self.backend.set(self._page_key(kind, number, stamp), page)
+        self.counters.count('stored')
+
+    def mark_unfinished(self, kind, number, stamp):
+        """
+        Note that the page rendered at ``stamp`` belongs to a running build.
+
+        Such pages are not stored, but the note lets a conditional request
+        for one be answered without rendering it to find out.
+        """
+        self.backend.set(self._unfinished_key(kind, number, stamp), '1')
+
+    def unfinished(self, kind, number, stamp):
+        """Return whether the page at ``stamp`` is known to be unfinished."""
+        return self.backend.get(
+            self._unfinished_key(kind, number, stamp)
+        ) is not None
+
+    def bump(self, kind, number):
+        """Give a page a new version stamp, dropping its cached copy."""
+        stamp_key = self._stamp_key(kind, number)
+        previous = self.backend.get(stamp_key)
+        self.backend.set(stamp_key, secrets.token_hex(8))
+        if previous is not None:
+            self.backend.delete(self._page_key(kind, number, previous))
+            self.backend.delete(self._unfinished_key(kind, number, previous))
+        self.counters.count('bumped')
+
+    def stats(self):
+        return self.counters.stats()
+
+
+def create_backend(config):
+    """Return the storage ``config`` selects, or None if caching is off."""
+    kind = config.get('PAGE_CACHE')
+    if not kind:
+        return None
+    if kind == 'lru':
+        return LRUBackend(config.get('PAGE_CACHE_SIZE', DEFAULT_LRU_SIZE))
+    if kind == 'filesystem':
+        if not config.get('PAGE_CACHE_DIR'):
+            raise ValueError('The filesystem page cache needs PAGE_CACHE_DIR')
+        return FileSystemBackend(
+            config['PAGE_CACHE_DIR'],
+            config.get('PAGE_CACHE_THRESHOLD', DEFAULT_FILESYSTEM_THRESHOLD)
+        )
+    if kind == 'uwsgi':
+        return UWSGIBackend(config.get('PAGE_CACHE_UWSGI_NAME',
+                                       DEFAULT_UWSGI_CACHE))
+    raise ValueError('Unknown PAGE_CACHE backend: %s' % kind)
+
+
+def templates_digest(app):
+    """Return a short digest of the source of every template."""
+    digest = hashlib.sha1()
+    for name in sorted(app.jinja_env.list_templates()):
+        source, _, _ = app.jinja_env.loader.get_source(app.jinja_env, name)
+        digest.update(name.encode('utf-8') + b'\0')
+        digest.update(source.encode('utf-8') + b'\0')
+    return digest.hexdigest()[:12]
+
+
+def configure_page_cache(app):
+    """
+    Set up the page cache ``PAGE_CACHE`` selects, if any.
+
+    Runs after the blueprints are registered, so that their templates are
+    part of the cache version.
+    """
+    backend = create_backend(app.config)
+    app.extensions['page_cache'] = (
+        PageCache(backend, templates_digest(app)) if backend else None
+    )
+
+
+def get_page_cache():
+    """Return the current app's page cache, or None."""
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('page_cache')
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_pages(session, flush_context):
+    """Note the pull request, build and job pages a flush changed."""
+    changed = session.info.setdefault(CHANGED_PAGES, set())
+    for instance in session.new | session.dirty | session.deleted:
+        if isinstance(instance, models.PullRequest):
+            changed.add(('pull', instance.number))
+        elif isinstance(instance, models.Build):
+            changed.add(('build', instance.number))
+            # Pull request pages list their builds.
+            if instance.pull_request is not None:
+                changed.add(('pull', instance.pull_request.number))
+        elif isinstance(instance, models.Job):
+            changed.add(('job', instance.number))
+            # Build pages list their jobs.
+            if instance.build is not None:
+                changed.add(('build', instance.build.number))
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_changed_pages(session):
+    """Invalidate the pages a transaction changed once it has committed."""
+    changed = session.info.pop(CHANGED_PAGES, ())
+    cache = get_page_cache()
+    if cache is None:
+        return
+    for kind, number in changed:
+        cache.bump(kind, number)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_changed_pages(session, transaction):
+    """Forget pages changed by a transaction that was rolled back."""
+    if transaction.parent is None:
+        session.info.pop(CHANGED_PAGES, None)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Record incoming webhook requests for later replay.
+
+When ``WEBHOOK_RECORD_DIR`` is configured, every request to a webhook route
+is appended to a gzip-compressed JSON Lines file in that directory, one per
+process, once the app has returned its response. Each line holds the
+receive timestamp, method, path, query string, headers and the raw body in
+base64. ``wptdash.replay`` plays such a capture back against the app.
+
+The body is copied to a temporary file as the app reads it, so streamed
+bodies are neither held in memory nor read ahead of the app, and whatever
+the app left unread is read after it returns. Requests handled at the same
+time may be written slightly out of order of their receive times.
+"""
+
+import base64
+from functools import partial
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+
+from werkzeug.datastructures import EnvironHeaders
+
+RECORDED_PATHS = ('/api/pull', '/api/build', '/api/test-mirror',
+                  '/api/stability')
+CHUNK_SIZE = 64 * 1024
+# Bytes of a body kept in memory before its copy goes to a file
+MEMORY_SIZE = 1024 * 1024
+# Body bytes encoded at a time; a multiple of 3 encodes without padding.
+BASE64_CHUNK_SIZE = 48 * 1024
+
+
+class RecordingInput(object):
+
+    """``wsgi.input`` wrapper copying everything read to a temporary file."""
+
+    def __init__(self, stream, length=None):
+        """
+        Wrap a request body.
+
+        Arguments:
+        stream -- The server's ``wsgi.input``
+        length -- Bytes the body has, or None to read it to the end
+        """
+        self.stream = stream
+        self.remaining = length
+        self.copy = tempfile.SpooledTemporaryFile(max_size=MEMORY_SIZE)
+
+    def _limit(self, size):
+        if self.remaining is None:
+            return size
+        if size is None or size < 0:
+            return self.remaining
+        return min(size, self.remaining)
+
+    def _copied(self, data):
+        self.copy.write(data)
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        return data
+
+    def read(self, size=-1):
+        size = self._limit(size)
+        if size == 0:
+            return b''
+        if size is None or size < 0:
+            return self._copied(self.stream.read())
+        return self._copied(self.stream.read(size))
+
+    def readline(self, size=-1):
+        size = self._limit(size)
+        if size == 0:
+            return b''
+        if size is None or size < 0:
+            return self._copied(self.stream.readline())
+        return self._copied(self.stream.readline(size))
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def drain(self):
+        """Read, and so copy, the rest of the body."""
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+class WebhookRecorder(object):
+
+    """WSGI middleware appending webhook requests to a capture file."""
+
+    def __init__(self, app, directory):
+        """
+        Wrap a WSGI app.
+
+        Arguments:
+        app -- The WSGI app to pass requests on to
+        directory -- Directory to write the capture file to
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.app = app
+        self.path = os.path.join(directory, 'webhooks-%s-%d.jsonl.gz' % (
+            time.strftime('%Y%m%dT%H%M%S'), os.getpid()
+        ))
+        self._file = None
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') not in RECORDED_PATHS:
+            return self.app(environ, start_response)
+
+        # Bodies without a length, e.g. chunked ones, can be read to the
+        # end when the server says so; otherwise the app reads nothing.
+        if environ.get('wsgi.input_terminated'):
+            length = None
+        else:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = RecordingInput(environ['wsgi.input'], length)
+        environ['wsgi.input'] = body
+        received_at = time.time()
+        try:
+            # The webhook routes are done with the body once they return.
+            return self.app(environ, start_response)
+        finally:
+            try:
+                body.drain()
+                body.copy.seek(0)
+                self.record(environ, body.copy, received_at)
+            finally:
+                body.copy.close()
+
+    def record(self, environ, body, received_at=None):
+        """
+        Append one request to the capture file.
+
+        ``body`` is bytes or a binary file object positioned at its start.
+        """
+        if isinstance(body, bytes):
+            body = io.BytesIO(body)
+        # The body is encoded straight into the file, after the other
+        # fields, so that large bodies are not held in memory.
+        head = json.dumps({
+            'received_at': received_at or time.time(),
+            'method': environ.get('REQUEST_METHOD'),
+            'path': environ.get('PATH_INFO'),
+            'query_string': environ.get('QUERY_STRING', ''),
+            'headers': dict(EnvironHeaders(environ)),
+        })
+        with self._lock:
+            if self._file is None:
+                self._file = gzip.open(self.path, 'at', encoding='utf-8')
+            self._file.write(head[:-1] + ', "body": "')
+            for chunk in iter(partial(body.read, BASE64_CHUNK_SIZE), b''):
+                self._file.write(base64.b64encode(chunk).decode('ascii'))
+            self._file.write('"}\n')
+            # Each flush ends a deflate block, so a capture can be read
+            # while the process is still running.
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_capture(path):
+    """Yield the requests recorded in a capture file, in order."""
+    with gzip.open(path, 'rt', encoding='utf-8') as capture:
+        try:
+            for line in capture:
+                if line.strip():
+                    record = json.loads(line)
+                    record['body'] = base64.b64decode(record['body'])
+                    yield record
+        except EOFError:
+            # The recording process did not close the file; every flushed
+            # line has been read.
+            return
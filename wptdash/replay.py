@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Replay recorded webhook requests against the app.
+
+Plays back captures written by ``wptdash.recorder`` through the app's test
+client, at the recorded pace, N times faster, or as fast as possible, and
+reports throughput, latency and how far sending fell behind the schedule.
+Requests are sent by a pool of workers, so that slow requests overlap as
+they did when recorded. Webhook signatures are not checked and
+GitHub is not called: pull request lookups are answered from the pull
+request events seen earlier in the capture, and comments are accepted
+without being posted.
+"""
+
+import argparse
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import copy
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+from unittest import mock
+
+import requests
+
+from wptdash.blueprints import routes
+from wptdash.github import GitHub
+from wptdash.recorder import WebhookRecorder, read_capture
+from wptdash.travis import Travis
+
+# Request headers the test client sets itself
+SKIPPED_HEADERS = ('Content-Length', 'Host')
+DEFAULT_WORKERS = 8
+
+
+class FakeGitHub(object):
+
+    """Answers GitHub API calls made by the app during a replay."""
+
+    def __init__(self):
+        self.pulls = {}
+        self.comments = itertools.count(1)
+
+    def learn(self, record):
+        """Remember the pull request sent in a ``/api/pull`` event."""
+        if record['path'] != '/api/pull':
+            return
+        try:
+            pull_request = json.loads(record['body'].decode('utf-8'))
+            pr_data = pull_request['pull_request']
+        except (ValueError, KeyError, TypeError):
+            return
+        self.pulls[pr_data['number']] = pr_data
+
+    def get_pr(self, number):
+        """
+        Return a known pull request, or a copy of the last one seen.
+
+        Captures that start mid-build refer to pull requests whose events
+        were not recorded; those get the details of another pull request.
+        """
+        if number in self.pulls:
+            return self.pulls[number]
+        if not self.pulls:
+            raise LookupError('No pull request events to stand in for #%s'
+                              % number)
+        pr_data = copy.deepcopy(list(self.pulls.values())[-1])
+        pr_data['id'] = pr_data['number'] = number
+        return pr_data
+
+    def request(self, github, method, url, data=None, headers=None,
+                priority=None):
+        """Stand-in for ``GitHub.request``."""
+        if method == 'GET' and '/pulls/' in url:
+            body = self.get_pr(int(url.rstrip('/').rsplit('/', 1)[1]))
+        elif method == 'PATCH':
+            body = {'url': url}
+        else:
+            body = {'url': 'https://api.github.com/replay/comments/%d'
+                    % next(self.comments)}
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = json.dumps(body).encode('utf-8')
+        return response
+
+
+@contextmanager
+def stubbed_services(fake_github):
+    """Skip signature checks and answer GitHub calls with ``fake_github``."""
+    def request(github, *args, **kwargs):
+        return fake_github.request(github, *args, **kwargs)
+
+    with mock.patch.object(routes, 'validate_hmac_signature',
+                           return_value=True), \
+            mock.patch.object(Travis, 'get_verified_payload',
+                              lambda travis, payload, signature:
+                              json.loads(payload)), \
+            mock.patch.object(GitHub, 'request', request):
+        yield
+
+
+def percentile(values, fraction):
+    """Return the value at ``fraction`` of the sorted ``values``."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def replay(app, records, speed=1.0, workers=1):
+    """
+    Send recorded requests to ``app`` and return a report.
+
+    Each request is handed to a free worker at its scheduled time; its lag
+    is how long after that time it was sent, because every worker was busy
+    or the capture could not be read fast enough. With one worker, requests
+    are sent from the calling thread.
+
+    Arguments:
+    app -- The Flask app to replay against
+    records -- Recorded requests, ordered by ``received_at``
+    speed -- Pace relative to the recording; None replays without pauses
+    workers -- Number of requests in flight at once
+
+    Returns a dict with the request count, elapsed seconds, throughput,
+    latency and lag percentiles in milliseconds, and response counts by
+    status; there is no lag without a schedule
+    """
+    fake_github = FakeGitHub()
+    clients = threading.local()
+    latencies = []
+    lags = []
+    statuses = Counter()
+    first_received = None
+    # At most this many requests are read ahead of the workers.
+    slots = threading.BoundedSemaphore(workers * 2)
+    in_flight = deque()
+    started = time.monotonic()
+
+    def send(record, due):
+        client = getattr(clients, 'client', None)
+        if client is None:
+            client = clients.client = app.test_client()
+        headers = [(name, value)
+                   for name, value in record['headers'].items()
+                   if name not in SKIPPED_HEADERS]
+        sent = time.monotonic()
+        response = client.open(record['path'], method=record['method'],
+                               query_string=record['query_string'],
+                               headers=headers, data=record['body'])
+        lag = None if due is None else max(0.0, sent - due)
+        return time.monotonic() - sent, lag, response.status_code
+
+    def send_in_slot(record, due):
+        try:
+            return send(record, due)
+        finally:
+            slots.release()
+
+    def collect(latency, lag, status):
+        latencies.append(latency)
+        if lag is not None:
+            lags.append(lag)
+        statuses[status] += 1
+
+    executor = None
+    if workers > 1:
+        executor = ThreadPoolExecutor(max_workers=workers,
+                                      thread_name_prefix='replay')
+    with stubbed_services(fake_github):
+        try:
+            for record in records:
+                if first_received is None:
+                    first_received = record['received_at']
+                due = None
+                if speed:
+                    due = started + (record['received_at'] -
+                                     first_received) / speed
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                fake_github.learn(record)
+                if executor is None:
+                    collect(*send(record, due))
+                    continue
+                slots.acquire()
+                in_flight.append(executor.submit(send_in_slot, record, due))
+                while in_flight and in_flight[0].done():
+                    collect(*in_flight.popleft().result())
+            while in_flight:
+                collect(*in_flight.popleft().result())
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    elapsed = time.monotonic() - started
+    latencies.sort()
+    lags.sort()
+
+    def milliseconds(value):
+        return None if value is None else value * 1000
+
+    return {
+        'requests': len(latencies),
+        'elapsed': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else None,
+        'latency_p50': milliseconds(percentile(latencies, 0.5)),
+        'latency_p90': milliseconds(percentile(latencies, 0.9)),
+        'latency_p99': milliseconds(percentile(latencies, 0.99)),
+        'latency_max': milliseconds(latencies[-1] if latencies else None),
+        'lag_p50': milliseconds(percentile(lags, 0.5)),
+        'lag_p99': milliseconds(percentile(lags, 0.99)),
+        'lag_max': milliseconds(lags[-1] if lags else None),
+        'statuses': dict(statuses),
+    }
+
+
+def format_report(report):
+    lines = [
+        'Requests:   %d in %.2f s' % (report['requests'], report['elapsed']),
+    ]
+    if report['requests']:
+        lines += [
+            'Throughput: %.1f requests/s' % report['throughput'],
+            'Latency:    p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms'
+            % (report['latency_p50'], report['latency_p90'],
+               report['latency_p99'], report['latency_max']),
+            'Statuses:   %s' % ', '.join(
+                '%s: %d' % item for item in sorted(report['statuses'].items())
+            ),
+        ]
+    if report.get('lag_max') is not None:
+        lines.append('Lag:        p50 %.1f ms, p99 %.1f ms, max %.1f ms '
+                     'behind schedule' % (report['lag_p50'],
+                                          report['lag_p99'],
+                                          report['lag_max']))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay webhook requests recorded by wptdash.'
+    )
+    parser.add_argument('captures', nargs='+',
+                        help='Capture files (webhooks-*.jsonl.gz)')
+    pace = parser.add_mutually_exclusive_group()
+    pace.add_argument('--speed', type=float, default=1.0,
+                      help='Replay N times faster than recorded (default 1)')
+    pace.add_argument('--max-speed', action='store_true',
+                      help='Replay without pauses between requests')
+    parser.add_argument('--database', default='sqlite://',
+                        help='SQLAlchemy database URI to ingest into '
+                             '(default: an in-memory SQLite database)')
+    parser.add_argument('--workers', type=int,
+                        help='Requests in flight at once (default %d, or 1 '
+                             'for SQLite)' % DEFAULT_WORKERS)
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error('--speed must be positive')
+    workers = args.workers
+    if workers is None:
+        # Every thread shares the one connection to an in-memory database.
+        sqlite = args.database.startswith('sqlite:')
+        workers = 1 if sqlite else DEFAULT_WORKERS
+    if workers < 1:
+        parser.error('--workers must be positive')
+
+    logging.basicConfig(level=logging.WARNING)
+    from wptdash.factory import create_app
+    app = create_app(dict(
+        DEBUG=False,
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        SQLALCHEMY_DATABASE_URI=args.database
+    ))
+    if isinstance(app.wsgi_app, WebhookRecorder):
+        # Do not record the replay itself.
+        app.wsgi_app = app.wsgi_app.app
+
+    # Each capture is in arrival order, so merging keeps memory bounded.
+    records = heapq.merge(*[read_capture(path) for path in args.captures],
+                          key=lambda record: record['received_at'])
+    report = replay(app, records, None if args.max_speed else args.speed,
+                    workers)
+    print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
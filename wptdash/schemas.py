@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""JSON schemas for webhook payloads and their precompiled validators.
+
+Each schema is checked and turned into a validator once, at import time,
+rather than on every request.
+"""
+
+from jsonschema import ValidationError
+from jsonschema.validators import validator_for
+
+
+def compile_schema(schema):
+    """Check ``schema`` and return a reusable validator for it."""
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+
+PULL_REQUEST_EVENT_SCHEMA = {
+    '$schema': 'http://json-schema.org/schema#',
+    'title': 'Pull Request Event',
+    'type': 'object',
+    'properties': {
+        'pull_request': {
+            'type': 'object',
+        },
+    },
+    'required': ['pull_request'],
+}
+
+TRAVIS_BUILD_EVENT_SCHEMA = {
+    '$schema': 'http://json-schema.org/schema#',
+    'title': 'Travis Build Event',
+    'type': 'object',
+    'definitions': {
+        'date_time': {
+            'type': 'string',
+            'format': 'date-time',
+        },
+    },
+    'properties': {
+        'id': {'type': 'integer'},
+        'number': {'type': 'string'},
+        'head_commit': {'type': 'string'},
+        'base_commit': {'type': 'string'},
+        'pull_request': {'type': 'boolean'},
+        'pull_request_number': {'oneOf': [
+            {'type': 'integer'},
+            {'type': 'null'},
+        ]},
+        'status_message': {
+            'enum': ['Pending', 'Passed', 'Fixed', 'Broken', 'Failed',
+                     'Still Failing', 'Canceled', 'Errored'],
+        },
+        'started_at': {'$ref': '#/definitions/date_time'},
+        'finished_at': {'$ref': '#/definitions/date_time'},
+        'repository': {
+            'type': 'object',
+            'properties': {
+                'name': {'type': 'string'},
+                'owner_name': {'type': 'string'},
+            },
+            'required': ['name', 'owner_name'],
+        },
+        'matrix': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'id': {'type': 'integer'},
+                    'number': {'type': 'string'},
+                    'state': {
+                        'type': 'string',
+                        'enum': ['created', 'queued', 'started', 'passed',
+                                 'failed', 'errored', 'finished']
+                    },
+                    'started_at': {'oneOf': [
+                        {'$ref': '#/definitions/date_time'},
+                        {'type': 'null'},
+                    ]},
+                    'finished_at': {'oneOf': [
+                        {'$ref': '#/definitions/date_time'},
+                        {'type': 'null'},
+                    ]},
+                    'allow_failure': {'type': 'boolean'},
+                    'config': {'type': 'object'},
+                },
+                'required': ['id', 'number', 'state', 'started_at',
+                             'config', 'allow_failure']
+            }
+        }
+    },
+    'required': ['id', 'number', 'head_commit', 'base_commit',
+                 'pull_request', 'pull_request_number', 'status',
+                 'repository'],
+}
+
+TEST_MIRROR_EVENT_SCHEMA = {
+    '$schema': 'http://json-schema.org/schema#',
+    'title': 'PR Mirrored Event',
+    'type': 'object',
+    'properties': {
+        'issue_number': {'type': 'integer'},
+        'url': {'type': 'string'}
+    },
+    'required': ['issue_number', 'url'],
+}
+
+TEST_MIRROR_DELETE_EVENT_SCHEMA = {
+    '$schema': 'http://json-schema.org/schema#',
+    'title': 'PR Mirrored Event',
+    'type': 'object',
+    'properties': {
+        'issue_number': {'type': 'integer'},
+    },
+    'required': ['issue_number', 'url'],
+}
+
+PULL_REQUEST_SCHEMA = {
+    '$schema': 'http://json-schema.org/schema#',
+    'title': 'Pull Request',
+    'definitions': {
+        'commit_object': {
+            'type': 'object',
+            'properties': {
+                'ref': {'type': 'string'},
+                'sha': {'type': 'string'},
+                'user': {'$ref': '#/definitions/github_user'},
+                'repo': {
+                    'type': 'object',
+                    'properties': {
+                        'id': {'type': 'integer'},
+                        'name': {'type': 'string'},
+                        'owner': {'$ref': '#/definitions/github_user'},
+                    },
+                    'required': ['id', 'owner'],
+                },
+            },
+            'required': ['sha', 'ref', 'user', 'repo']
+        },
+        'date_time': {
+            'type': 'string',
+            'format': 'date-time',
+        },
+        'github_user': {
+            'type': 'object',
+            'properties': {
+                'login': {'type': 'string'},
+                'id': {'type': 'integer'},
+            },
+            'required': ['login', 'id'],
+        },
+    },
+    'type': 'object',
+    'properties': {
+        'id': {'type': 'integer'},
+        'number': {'type': 'integer'},
+        'title': {'type': 'string'},
+        'user': {'$ref': '#/definitions/github_user'},
+        'merged': {'type': 'boolean'},
+        'state': {
+            'enum': ['open', 'closed'],
+        },
+        'head': {'$ref': '#/definitions/commit_object'},
+        'base': {'$ref': '#/definitions/commit_object'},
+        'merged_by': {'oneOf': [
+            {'$ref': '#definitions/github_user'},
+            {'type': 'null'},
+        ]},
+        'created_at': {'$ref': '#/definitions/date_time'},
+        'updated_at': {'$ref': '#/definitions/date_time'},
+        'closed_at': {'oneOf': [
+            {'$ref': '#/definitions/date_time'},
+            {'type': 'null'},
+        ]},
+        'merged_at': {'oneOf': [
+            {'$ref': '#/definitions/date_time'},
+            {'type': 'null'},
+        ]},
+    },
+    'required': [
+        'id', 'number', 'title', 'user', 'merged', 'state', 'head',
+        'base', 'created_at', 'updated_at'
+    ],
+}
+
+STABILITY_HEADER_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'pull': {
+            'type': 'object',
+            'properties': {
+                'number': {'type': 'integer'},
+                'sha': {'type': 'string'},
+            },
+            'required': ['number', 'sha'],
+        },
+        'job': {
+            'type': 'object',
+            'properties': {
+                'id': {'type': 'integer'},
+                'number': {'type': 'string'},
+                'allow_failure': {'type': 'boolean'},
+                'status': {
+                    'type': 'string',
+                    'enum': ['created', 'queued', 'started', 'passed',
+                             'failed', 'errored', 'finished']
+                },
+            },
+            'required': [
+                'id', 'number', 'allow_failure', 'status',
+            ],
+        },
+        'build': {
+            'type': 'object',
+            'properties': {
+                'id': {'type': 'integer'},
+                'number': {'type': 'string'},
+            },
+            'required': [
+                'id', 'number',
+            ],
+        },
+        'product': {
+            'type': 'string',
+            'maxLength': 255,
+        },
+        'iterations': {
+            'type': 'integer'
+        },
+        'message': {
+            'type': 'string'
+        },
+    },
+    'required': ['pull', 'job', 'build', 'product', 'iterations']
+}
+
+STABILITY_RESULT_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'result': {
+            'type': 'object',
+            'properties': {
+                'status': {
+                    'type': 'object',
+                    'patternProperties': {
+                        '^(?:pass|fail|ok|timeout|error|notrun|crash)$': {
+                            'type': 'integer'
+                        },
+                    },
+                },
+                # Items are checked by ``validate_subtests``; with tens of
+                # thousands of them the generic validator dominates ingest.
+                'subtests': {'type': 'array'},
+            },
+            'required': ['status'],
+        },
+        'test': {
+            'type': 'string',
+        },
+    },
+    'required': ['test', 'result'],
+}
+
+STABILITY_CHECK_SCHEMA = dict(STABILITY_HEADER_SCHEMA)
+STABILITY_CHECK_SCHEMA['properties'] = dict(
+    STABILITY_HEADER_SCHEMA['properties'],
+    # Items are checked one at a time by ``validate_stability_results``.
+    results={'type': 'array'},
+)
+STABILITY_CHECK_SCHEMA['required'] = (STABILITY_HEADER_SCHEMA['required'] +
+                                      ['results'])
+
+PULL_REQUEST_EVENT = compile_schema(PULL_REQUEST_EVENT_SCHEMA)
+TRAVIS_BUILD_EVENT = compile_schema(TRAVIS_BUILD_EVENT_SCHEMA)
+TEST_MIRROR_EVENT = compile_schema(TEST_MIRROR_EVENT_SCHEMA)
+TEST_MIRROR_DELETE_EVENT = compile_schema(TEST_MIRROR_DELETE_EVENT_SCHEMA)
+PULL_REQUEST = compile_schema(PULL_REQUEST_SCHEMA)
+STABILITY_HEADER = compile_schema(STABILITY_HEADER_SCHEMA)
+STABILITY_RESULT = compile_schema(STABILITY_RESULT_SCHEMA)
+STABILITY_CHECK = compile_schema(STABILITY_CHECK_SCHEMA)
+
+STATUS_NAMES = frozenset(['pass', 'fail', 'ok', 'timeout', 'error', 'notrun',
+                          'crash'])
+
+
+def _is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def validate_subtests(subtests):
+    """
+    Validate a ``results[].result.subtests`` array.
+
+    Hand-written equivalent of the JSON schema for subtest items: each
+    needs a string ``test`` and a ``result`` holding a ``status`` object
+    (known status names map to integers) and a list of string
+    ``messages``. Raises ``jsonschema.ValidationError`` on the first
+    problem found.
+    """
+    if not isinstance(subtests, list):
+        raise ValidationError('subtests: %r is not of type array' % subtests)
+
+    for index, subtest in enumerate(subtests):
+        path = 'subtests[%d]' % index
+        if not isinstance(subtest, dict):
+            raise ValidationError('%s: %r is not of type object'
+                                  % (path, subtest))
+        for field in ('result', 'test'):
+            if field not in subtest:
+                raise ValidationError('%s: %r is a required property'
+                                      % (path, field))
+        if not isinstance(subtest['test'], str):
+            raise ValidationError('%s.test: %r is not of type string'
+                                  % (path, subtest['test']))
+
+        result = subtest['result']
+        if not isinstance(result, dict):
+            raise ValidationError('%s.result: %r is not of type object'
+                                  % (path, result))
+        for field in ('status', 'messages'):
+            if field not in result:
+                raise ValidationError('%s.result: %r is a required property'
+                                      % (path, field))
+
+        status = result['status']
+        if not isinstance(status, dict):
+            raise ValidationError('%s.result.status: %r is not of type '
+                                  'object' % (path, status))
+        for name, count in status.items():
+            if name in STATUS_NAMES and not _is_integer(count):
+                raise ValidationError('%s.result.status.%s: %r is not of '
+                                      'type integer' % (path, name, count))
+
+        messages = result['messages']
+        if not isinstance(messages, list):
+            raise ValidationError('%s.result.messages: %r is not of type '
+                                  'array' % (path, messages))
+        for message in messages:
+            if not isinstance(message, str):
+                raise ValidationError('%s.result.messages: %r is not of '
+                                      'type string' % (path, message))
+
+
+def validate_stability_results(results):
+    """Validate each item of a stability ``results`` array."""
+    for result in results:
+        STABILITY_RESULT.validate(result)
+        validate_subtests(result['result'].get('subtests', []))
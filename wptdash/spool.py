@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Durable on-disk spool for webhook payloads.
+
+When ``WEBHOOK_SPOOL_DIR`` is configured the webhook routes only verify a
+request, write its body here and answer ``202 Accepted``; a separate worker
+process drains the spool and runs the ingest and commenting logic.
+
+The layout follows Maildir: entries are written to ``tmp/``, fsynced and
+renamed into ``new/``. A worker claims an entry by renaming it into ``cur/``,
+so several workers can drain one spool, and deletes it once processed.
+Entries that fail are moved to ``failed/`` for inspection; entries deferred
+by the GitHub rate limit go back into ``new/`` under a future timestamp and
+are not claimed before it. Entries whose handler answers with a server
+error are retried the same way, with a growing delay, a few times before
+they are failed.
+
+A claim is a lease: claiming touches the entry, and entries left in
+``cur/`` for longer than the lease, by a worker that crashed or was
+killed, are put back into ``new/`` by the next ``claim``.
+
+Without a spool, payloads whose pull request lookup the GitHub rate limit
+deferred are kept in a ``DeferredPayloads`` queue in the app process until
+the reset instead.
+"""
+
+import argparse
+from datetime import datetime
+import heapq
+import itertools
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+SUBDIRECTORIES = ('tmp', 'new', 'cur', 'failed')
+CHUNK_SIZE = 64 * 1024
+
+# Seconds a claimed entry may be processed before other workers requeue it
+CLAIM_LEASE = 600
+
+# Attempts at an entry whose handler answers with a server error, and the
+# delay before the first retry; it doubles for each further retry.
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 60
+
+# Payloads a process keeps for after a rate limit reset without a spool
+DEFERRED_PAYLOAD_LIMIT = 1000
+
+
+class SpoolEntry(object):
+
+    """A claimed spool entry."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.attempts = _entry_attempts(self.name)
+        with open(path, 'rb') as entry_file:
+            header = json.loads(entry_file.readline().decode('utf-8'))
+        self.kind = header['kind']
+        self.content_type = header['content_type']
+        self.received_at = header['received_at']
+
+    def open(self):
+        """Return the entry body as a binary file object."""
+        entry_file = open(self.path, 'rb')
+        entry_file.readline()
+        return entry_file
+
+
+class Spool(object):
+
+    """Directory-backed queue of raw webhook payloads."""
+
+    def __init__(self, path, lease=CLAIM_LEASE):
+        self.path = path
+        self.lease = lease
+        for subdirectory in SUBDIRECTORIES:
+            os.makedirs(os.path.join(path, subdirectory), exist_ok=True)
+
+    def _directory(self, subdirectory):
+        return os.path.join(self.path, subdirectory)
+
+    def put(self, kind, content_type, body):
+        """
+        Durably store a payload and return the entry name.
+
+        Arguments:
+        kind -- The webhook the payload belongs to (e.g. ``'build'``)
+        content_type -- The request content type
+        body -- The payload as bytes or as a binary file object
+        """
+        # Names sort by arrival time so workers drain oldest first.
+        name = _entry_name(time.time(), uuid.uuid4().hex)
+        tmp_path = os.path.join(self._directory('tmp'), name)
+        header = {
+            'kind': kind,
+            'content_type': content_type,
+            'received_at': datetime.utcnow().isoformat(),
+        }
+
+        with open(tmp_path, 'wb') as entry_file:
+            entry_file.write(json.dumps(header).encode('utf-8') + b'\n')
+            if isinstance(body, bytes):
+                entry_file.write(body)
+            else:
+                shutil.copyfileobj(body, entry_file, CHUNK_SIZE)
+            entry_file.flush()
+            os.fsync(entry_file.fileno())
+
+        os.rename(tmp_path, os.path.join(self._directory('new'), name))
+        self._sync_directory('new')
+        return name
+
+    def claim(self):
+        """Claim the oldest due entry, or return None if there is none."""
+        self.requeue_expired()
+        now = time.time()
+        for name in sorted(os.listdir(self._directory('new'))):
+            if _entry_time(name) > now:
+                # Deferred entries sort after everything that is due.
+                break
+            new_path = os.path.join(self._directory('new'), name)
+            path = os.path.join(self._directory('cur'), name)
+            try:
+                # The lease starts now. Touching the entry before moving it
+                # keeps other workers from taking it for an expired claim.
+                os.utime(new_path)
+                os.rename(new_path, path)
+            except FileNotFoundError:
+                # Another worker claimed it first.
+                continue
+            return SpoolEntry(path)
+        return None
+
+    def requeue_expired(self):
+        """Put entries claimed longer than the lease ago back into new/."""
+        now = time.time()
+        for name in os.listdir(self._directory('cur')):
+            path = os.path.join(self._directory('cur'), name)
+            try:
+                if now - os.stat(path).st_mtime <= self.lease:
+                    continue
+                os.rename(path, os.path.join(self._directory('new'), name))
+            except FileNotFoundError:
+                # Completed, or requeued by another worker.
+                continue
+            logging.warning('Requeued spooled payload %s after its claim '
+                            'expired', name)
+
+    def complete(self, entry):
+        """Remove a successfully processed entry."""
+        self._release(os.unlink, entry.path)
+
+    def defer(self, entry, delay, attempts=None):
+        """
+        Put a claimed entry back, to be claimed after ``delay`` seconds.
+
+        ``attempts`` replaces the entry's count of failed attempts.
+        """
+        if attempts is None:
+            attempts = entry.attempts
+        unique = entry.name.split('.')[1]
+        if attempts:
+            unique = '%s.%d' % (unique, attempts)
+        name = _entry_name(time.time() + delay, unique)
+        self._release(os.rename, entry.path,
+                      os.path.join(self._directory('new'), name))
+
+    def retry(self, entry):
+        """
+        Put back an entry whose processing failed, or fail it for good.
+
+        Returns whether the entry will be tried again.
+        """
+        attempts = entry.attempts + 1
+        if attempts >= MAX_ATTEMPTS:
+            self.fail(entry)
+            return False
+        self.defer(entry, RETRY_DELAY * 2 ** (attempts - 1), attempts)
+        return True
+
+    def fail(self, entry):
+        """Set aside an entry that could not be processed."""
+        self._release(os.rename, entry.path,
+                      os.path.join(self._directory('failed'), entry.name))
+
+    @staticmethod
+    def _release(operation, *paths):
+        try:
+            operation(*paths)
+        except FileNotFoundError:
+            # The claim expired and the entry was requeued; whoever claims
+            # it next processes it again.
+            logging.warning('Spooled payload %s was requeued while in '
+                            'progress', os.path.basename(paths[0]))
+
+    def stats(self):
+        """Return spool depth, in-progress and failed counts, and age."""
+        pending = os.listdir(self._directory('new'))
+        in_progress = os.listdir(self._directory('cur'))
+        oldest = min(pending + in_progress, default=None)
+        oldest_age = None
+        if oldest:
+            oldest_age = max(0.0, time.time() - _entry_time(oldest))
+        return {
+            'depth': len(pending),
+            'in_progress': len(in_progress),
+            'failed': len(os.listdir(self._directory('failed'))),
+            'oldest_age_seconds': oldest_age,
+        }
+
+    def _sync_directory(self, subdirectory):
+        fd = os.open(self._directory(subdirectory), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _entry_name(timestamp, unique):
+    return '%020d.%s' % (timestamp * 1e6, unique)
+
+
+def _entry_time(name):
+    return int(name.split('.')[0]) / 1e6
+
+
+def _entry_attempts(name):
+    # Names of entries that failed before end in their count of attempts.
+    parts = name.split('.')
+    return int(parts[2]) if len(parts) > 2 else 0
+
+
+class DeferredPayloads(object):
+
+    """
+    In-process queue of payloads to process once the GitHub quota resets.
+
+    Used by apps without a spool, whose senders do not redeliver payloads
+    answered with an error. A background thread hands each payload to
+    ``process`` once its delay has passed, and queues it again if the rate
+    limit defers it once more. Payloads are lost if the process exits.
+    """
+
+    def __init__(self, process, maxsize=DEFERRED_PAYLOAD_LIMIT):
+        """
+        Create a queue.
+
+        Arguments:
+        process -- Callable taking a payload's kind, content type and body,
+                   and returning the route handler's response
+        maxsize -- Number of payloads held at once
+        """
+        self.process = process
+        self.maxsize = maxsize
+        self.deferred = 0
+        self.processed = 0
+        self.failed = 0
+        self._heap = []
+        self._running = 0
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def defer(self, kind, content_type, body, delay):
+        """
+        Queue a payload to be processed in ``delay`` seconds.
+
+        ``body`` is a binary file object, which the queue closes once it is
+        done with it. Returns False, leaving ``body`` open, if the queue is
+        full.
+        """
+        with self._condition:
+            if len(self._heap) + self._running >= self.maxsize:
+                return False
+            self.deferred += 1
+            self._push((kind, content_type, body), delay)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch,
+                                                name='deferred-payloads',
+                                                daemon=True)
+                self._thread.start()
+        return True
+
+    def wait_idle(self, timeout=None):
+        """Block until no payloads are queued or running."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._heap or self._running:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                self._condition.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._condition:
+            return {
+                'deferred': self.deferred,
+                'pending': len(self._heap) + self._running,
+                'processed': self.processed,
+                'failed': self.failed,
+            }
+
+    def _push(self, payload, delay):
+        due = time.monotonic() + delay
+        heapq.heappush(self._heap, (due, next(self._sequence), payload))
+        self._condition.notify_all()
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                while True:
+                    delay = None
+                    if self._heap:
+                        delay = self._heap[0][0] - time.monotonic()
+                        if delay <= 0:
+                            break
+                    self._condition.wait(delay)
+                _, _, payload = heapq.heappop(self._heap)
+                self._running += 1
+            self._run(payload)
+
+    def _run(self, payload):
+        from wptdash.github import RateLimited
+
+        kind, content_type, body = payload
+        deferred = None
+        failed = False
+        try:
+            body.seek(0)
+            response = self.process(kind, content_type, body)
+        except RateLimited as err:
+            logging.warning('Deferring %s payload again: %s', kind, err)
+            deferred = err.retry_after
+        except Exception:
+            logging.exception('Failed to process deferred %s payload', kind)
+            failed = True
+        else:
+            if _response_status(response) >= 300:
+                logging.error('Deferred %s payload was rejected: %s', kind,
+                              response)
+                failed = True
+        with self._condition:
+            self._running -= 1
+            if deferred is not None:
+                self._push(payload, deferred)
+            else:
+                body.close()
+                if failed:
+                    self.failed += 1
+                else:
+                    self.processed += 1
+            self._condition.notify_all()
+
+
+def _response_status(response):
+    """Return the status code of a route handler's return value."""
+    if isinstance(response, tuple):
+        return response[1]
+    return response.status_code
+
+
+def process_payload(app, kind, content_type, body):
+    """Run the ingest logic for one payload inside ``app``."""
+    from flask import g
+    from wptdash.blueprints.routes import process_spooled_request
+    from wptdash.database import db
+    import wptdash.models as models
+
+    with app.app_context():
+        g.db = db
+        g.models = models
+        try:
+            return process_spooled_request(kind, content_type, body, db,
+                                           models)
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+
+def process_entry(app, spool, entry):
+    """
+    Run the ingest logic for one claimed entry inside ``app``.
+
+    Payloads the handler rejects as invalid are set aside at once; other
+    errors, such as a lost database connection or a failed GitHub call,
+    may pass, so the entry is retried like one answered with a server
+    error.
+    """
+    from jsonschema import ValidationError
+    from wptdash.github import RateLimited
+
+    try:
+        with entry.open() as body:
+            response = process_payload(app, entry.kind, entry.content_type,
+                                       body)
+    except RateLimited as err:
+        logging.warning('Deferring spooled %s payload %s: %s',
+                        entry.kind, entry.name, err)
+        spool.defer(entry, err.retry_after)
+        return False
+    except (ValidationError, ValueError, KeyError):
+        logging.exception('Rejected spooled %s payload %s', entry.kind,
+                          entry.name)
+        spool.fail(entry)
+        return False
+    except Exception:
+        retried = spool.retry(entry)
+        logging.exception('Failed to process spooled %s payload %s%s',
+                          entry.kind, entry.name,
+                          '; will retry' if retried else '')
+        return False
+
+    status = _response_status(response)
+    if status >= 500:
+        retried = spool.retry(entry)
+        logging.warning('Spooled %s payload %s failed with %s%s: %s',
+                        entry.kind, entry.name, status,
+                        '; will retry' if retried else '', response)
+        return False
+    if status >= 300:
+        logging.error('Spooled %s payload %s was rejected: %s', entry.kind,
+                      entry.name, response)
+        spool.fail(entry)
+        return False
+
+    logging.info('Processed spooled %s payload %s: %s', entry.kind,
+                 entry.name, response)
+    spool.complete(entry)
+    return True
+
+
+def work(app, spool, poll_interval=1.0, once=False):
+    """Drain ``spool`` forever, or until it is empty if ``once`` is set."""
+    while True:
+        entry = spool.claim()
+        if entry is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+        process_entry(app, spool, entry)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Process webhook payloads spooled by wptdash.'
+    )
+    parser.add_argument('--spool-dir',
+                        help='Spool directory (default: WEBHOOK_SPOOL_DIR)')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='Seconds to wait when the spool is empty')
+    parser.add_argument('--once', action='store_true',
+                        help='Exit once the spool is empty')
+    parser.add_argument('--lease', type=float, default=CLAIM_LEASE,
+                        help='Seconds after which entries claimed by a '
+                             'worker that has not finished them are '
+                             'requeued (default %(default)s)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from wptdash.prodapp import prod_app
+    spool_dir = args.spool_dir or prod_app.config.get('WEBHOOK_SPOOL_DIR')
+    if not spool_dir:
+        parser.error('no spool directory configured')
+    work(prod_app, Spool(spool_dir, args.lease), args.interval, args.once)
+
+
+if __name__ == '__main__':
+    main()
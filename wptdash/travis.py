@@ -8,9 +8,12 @@ import base64
 import logging
 import json
 import re
+import threading
+import time
 from urllib.parse import urljoin
 
 import requests
+import requests_cache
 from OpenSSL.crypto import verify, load_publickey, FILETYPE_PEM, X509
 from OpenSSL.crypto import Error as SignatureError
 
@@ -19,16 +22,89 @@ CONFIG.readfp(open(r'config.txt'))
 TRAVIS_DOMAIN = CONFIG.get('Travis', 'TRAVIS_DOMAIN')
 COMMENT_ENV_VAR = CONFIG.get('Travis', 'COMMENT_ENV_VAR')
 
+# Seconds a fetched public key is trusted before it is fetched again
+PUBLIC_KEY_TTL = 24 * 60 * 60
+# Minimum seconds between fetches after a signature fails to verify, so
+# forged requests cannot make every request fetch the key
+PUBLIC_KEY_MIN_REFRESH = 60
+
+
+def load_certificate(public_key):
+    """Wrap a PEM-encoded public key in an X509 object for pyOpenSSL."""
+    pkey_public_key = load_publickey(FILETYPE_PEM, public_key)
+    certificate = X509()
+    certificate.set_pubkey(pkey_public_key)
+    return certificate
+
 
 def check_authorized(signature, public_key, payload):
     """Reformat PEM-encoded public key for pyOpenSSL, verify signature.
 
+    ``public_key`` may also be a certificate from ``load_certificate``.
+
     See: https://docs.travis-ci.com/user/notifications/#Verifying-Webhook-requests
     """
-    pkey_public_key = load_publickey(FILETYPE_PEM, public_key)
-    certificate = X509()
-    certificate.set_pubkey(pkey_public_key)
-    verify(certificate, signature, payload, str('sha1'))
+    if not isinstance(public_key, X509):
+        public_key = load_certificate(public_key)
+    verify(public_key, signature, payload, str('sha1'))
+
+
+class PublicKeyCache(object):
+
+    """
+    The parsed Travis CI public key, shared by all requests of a process.
+
+    The key is fetched on first use and again once ``ttl`` has passed, or
+    when a signature fails to verify against it. Concurrent refreshes are
+    collapsed into one fetch; the other callers wait for its result.
+    """
+
+    def __init__(self, ttl=PUBLIC_KEY_TTL,
+                 min_refresh=PUBLIC_KEY_MIN_REFRESH, clock=time.monotonic):
+        self.ttl = ttl
+        self.min_refresh = min_refresh
+        self.clock = clock
+        self.fetches = 0
+        self._certificate = None
+        self._fetched_at = None
+        self._lock = threading.Lock()
+
+    def get(self, fetch, stale=None):
+        """
+        Return the cached certificate, fetching the key if needed.
+
+        Arguments:
+        fetch -- Callable returning the PEM-encoded public key
+        stale -- A certificate that failed verification; it is replaced
+                 unless it was fetched less than ``min_refresh`` ago
+        """
+        certificate = self._current(stale)
+        if certificate is not None:
+            return certificate
+        with self._lock:
+            # Another caller may have refreshed while this one waited.
+            certificate = self._current(stale)
+            if certificate is not None:
+                return certificate
+            certificate = load_certificate(fetch())
+            self._certificate = certificate
+            self._fetched_at = self.clock()
+            self.fetches += 1
+            return certificate
+
+    def _current(self, stale):
+        certificate = self._certificate
+        if certificate is None:
+            return None
+        age = self.clock() - self._fetched_at
+        if age >= self.ttl:
+            return None
+        if certificate is stale and age >= self.min_refresh:
+            return None
+        return certificate
+
+
+PUBLIC_KEYS = PublicKeyCache()
 
 
 class Travis(object):
@@ -47,8 +123,10 @@ class Travis(object):
 
     def get_public_key(self):
         """Return PEM-encoded public key from Travis CI /config endpoint."""
-        response = requests.get(urljoin(self.base_url, '/config'),
-                                timeout=10.0)
+        # PUBLIC_KEYS decides when to refetch, so bypass the response cache.
+        with requests_cache.disabled():
+            response = requests.get(urljoin(self.base_url, '/config'),
+                                    timeout=10.0)
         response.raise_for_status()
         config = response.json()['config']
         public_key = config['notifications']['webhook']['public_key']
@@ -58,26 +136,34 @@ class Travis(object):
     def get_verified_payload(self, payload, signature):
         """Verify payload with Travis CI signature and public key."""
         decoded_signature = base64.b64decode(signature)
-        try:
-            public_key = self.get_public_key()
-        except requests.Timeout:
-            error_message = "Timed out retrieving Travis CI public key."
-            logging.error({"message": error_message})
-            return {"error": {"message": error_message, "code": 500}}
-        except requests.RequestException as err:
-            error_message = "Failed to retrieve Travis CI public key."
-            logging.error({
-                "message": error_message,
-                "error": err.message
-            })
-            return {"error": {"message": error_message, "code": 500}}
-        try:
-            check_authorized(decoded_signature, public_key, payload)
-        except SignatureError as err:
+        certificate = None
+        # A failed check is retried once with a refreshed key, in case
+        # Travis CI rotated it.
+        for attempt in range(2):
+            try:
+                certificate = PUBLIC_KEYS.get(self.get_public_key,
+                                              stale=certificate)
+            except requests.Timeout:
+                error_message = "Timed out retrieving Travis CI public key."
+                logging.error({"message": error_message})
+                return {"error": {"message": error_message, "code": 500}}
+            except (requests.RequestException, SignatureError) as err:
+                error_message = "Failed to retrieve Travis CI public key."
+                logging.error({
+                    "message": error_message,
+                    "error": str(err)
+                })
+                return {"error": {"message": error_message, "code": 500}}
+            try:
+                check_authorized(decoded_signature, certificate, payload)
+                break
+            except SignatureError as err:
+                signature_error = err
+        else:
             error_message = "Failed to confirm Travis CI Signature."
             logging.error({
                 "message": error_message,
-                "error": err.message
+                "error": str(signature_error)
             })
             return {"error": {"message": error_message, "code": 401}}
         return json.loads(payload)